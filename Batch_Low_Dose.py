@@ -0,0 +1,339 @@
+# --------------------
+# File: Batch_Low_Dose.py
+# Purpose: Headless generation of simulated low dose CT series. Every series found in the
+#          given folders is run through a noise model (the viewer's image noise or the
+#          sinogram simulation) at every exposure level on a pool of processes, a few slices
+#          per task, and written out as a new DICOM series or as a compressed numpy array.
+#          Slices are written as soon as they are done so memory use does not grow with the
+#          size of the series.
+# Author: Jacob Knop
+# Date: Summer 2020
+# --------------------
+
+# external dependencies
+import os
+import time
+import hashlib
+import zipfile
+import argparse
+import warnings
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pydicom
+from pydicom.uid import generate_uid, ExplicitVRLittleEndian
+
+# internal dependencies
+from Read_Dicom import scan_folder_series, sort_headers
+from Poisson_Noise import noisy_volume, NOISE_BOX_MULLER, NOISE_TABLE
+from Sinogram_Sim import sinogram_volume, DEFAULT_ANGLES, FILTERS
+
+# noise modes that can be picked on the command line
+NOISE_MODES = {"table": NOISE_TABLE, "box-muller": NOISE_BOX_MULLER}
+
+# elements whose value representation depends on the pixel representation (they would be wrong after
+# the pixels are written back as signed values)
+PIXEL_RANGE_TAGS = ["SmallestImagePixelValue", "LargestImagePixelValue", "SmallestPixelValueInSeries",
+                    "LargestPixelValueInSeries", "PixelPaddingValue", "PixelPaddingRangeLimit"]
+
+
+# ------------------------------------------------------------
+# function: bounded_imap
+# purpose: calls func on every item on a pool of processes and yields the
+#          results in the same order as the items. At most in_flight items
+#          are handed to the pool at once, so a slow consumer (ie. writing
+#          to disk) does not leave finished slices piling up in memory
+# parameters: func, items, workers, in_flight
+# 1. func      - function to call (must be importable by the processes)
+# 2. items     - iterable of arguments (read as the pool has room for them)
+# 3. workers   - how many processes to use (0 or 1 runs on the calling thread)
+# 4. in_flight - how many items can be queued or running at once
+# ------------------------------------------------------------
+def bounded_imap(func, items, workers=0, in_flight=0):
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    in_flight = max(in_flight, workers)
+    pending = collections.deque()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for item in items:
+            if len(pending) >= in_flight:
+                yield pending.popleft().result()
+            pending.append(pool.submit(func, item))
+        while pending:
+            yield pending.popleft().result()
+
+
+# ------------------------------------------------------------
+# function: low_dose_slices
+# purpose: (worker process) adds the noise to a run of slices. When the
+#          task has output files the slices are written there as DICOM and
+#          None is returned, otherwise the noisy stored values are returned
+# parameters: task - (first_index, filenames, out_files, job)
+# 1. first_index - slice number of the first file in the sorted series (the
+#                  noise depends on it the same way it does in the viewer)
+# 2. filenames   - the original DICOM files (all the same size)
+# 3. out_files   - DICOM files to write (None to return the pixels)
+# 4. job         - the series settings (see series_jobs)
+# ------------------------------------------------------------
+def low_dose_slices(task):
+    first_index, filenames, out_files, job = task
+    datasets = [pydicom.dcmread(filename) for filename in filenames]
+    slopes = [float(ds.get("RescaleSlope", 1) or 1) for ds in datasets]
+    intercepts = [float(ds.get("RescaleIntercept", 0) or 0) for ds in datasets]
+
+    if job["model"] == "image":
+        noisy = [noisy_volume(ds.pixel_array[None], job["exposure"], job["mode"], slope, intercept, first_index + i)[0]
+                 for i, (ds, slope, intercept) in enumerate(zip(datasets, slopes, intercepts))]
+    else:
+        hu = np.stack([ds.pixel_array * np.float32(slope) + np.float32(intercept)
+                       for ds, slope, intercept in zip(datasets, slopes, intercepts)])
+        spacing = datasets[0].get("PixelSpacing")
+        pixel_size = float(spacing[0]) if spacing else 1.0
+        hu = sinogram_volume(hu, job["exposure"], pixel_size, job["angles"], job["filter"], first_index,
+                             chunk=len(hu))
+        noisy = [np.clip(np.rint((hu[i] - intercept) / slope), -32768, 32767).astype(np.int16)
+                 for i, (slope, intercept) in enumerate(zip(slopes, intercepts))]
+    if out_files is None:
+        return noisy
+
+    for ds, pixelarray, out_file in zip(datasets, noisy, out_files):
+        write_low_dose_dicom(ds, pixelarray, out_file, job["series_uid"], job["description"])
+    return None
+
+
+# ------------------------------------------------------------
+# function: write_low_dose_dicom
+# purpose: writes a noisy slice as a DICOM file of the new series. The
+#          noisy values can go below 0 so they are always written as
+#          signed 16 bit
+# parameters: ds, pixelarray, out_file, series_uid, description
+# 1. ds          - the original slice's dataset (changed in place)
+# 2. pixelarray  - the noisy stored values (int16)
+# 3. out_file    - DICOM file to write
+# 4. series_uid  - SeriesInstanceUID of the new series
+# 5. description - SeriesDescription of the new series
+# ------------------------------------------------------------
+def write_low_dose_dicom(ds, pixelarray, out_file, series_uid, description):
+    ds.PixelData = pixelarray.astype("<i2", copy=False).tobytes()
+    ds["PixelData"].VR = "OW"
+    ds["PixelData"].is_undefined_length = False
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 1
+    for keyword in PIXEL_RANGE_TAGS:
+        if keyword in ds:
+            delattr(ds, keyword)
+
+    # same inputs, same UIDs - running the batch again replaces the series instead of adding a copy
+    sop_uid = generate_uid(entropy_srcs=[str(ds.SOPInstanceUID), series_uid])
+    ds.SOPInstanceUID = sop_uid
+    ds.SeriesInstanceUID = series_uid
+    ds.SeriesDescription = description[:64]
+    ds.file_meta.MediaStorageSOPInstanceUID = sop_uid
+    # the new pixel data is native little endian, so the file is always written as explicit VR little endian
+    # (compressed, big endian and implicit VR sources included). pydicom 3 takes the encoding from the
+    # transfer syntax and warns about the flags, which older versions need
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+    # dcmwrite rather than save_as, which refuses to change a big endian dataset to little endian
+    pydicom.dcmwrite(out_file, ds)
+
+
+# -----------------------------------------------------------------------
+# Class: NpzWriter
+# Purpose: Writes a .npz file (readable with np.load) one slice at a time.
+#          The "pixels" array header is written up front for the whole
+#          series and each slice is then compressed straight into the zip
+#          entry after it, so the series never has to be held in memory
+# Elements:
+#    path - the .npz file
+#    shape - (slices, rows, columns) of the pixels array
+# -----------------------------------------------------------------------
+class NpzWriter:
+    path = 0
+    shape = (0, 0, 0)
+
+    def __init__(self, path, shape):
+        self.path = path
+        self.shape = tuple(shape)
+        self.zip = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.entry = self.zip.open("pixels.npy", "w", force_zip64=True)
+        np.lib.format.write_array_header_2_0(self.entry, {"descr": np.dtype(np.int16).str,
+                                                          "fortran_order": False, "shape": self.shape})
+
+    # writes the next slice of the pixels array
+    def add_slice(self, pixelarray):
+        self.entry.write(np.ascontiguousarray(pixelarray, dtype=np.int16).tobytes())
+
+    # finishes the pixels array and adds the (small) arrays that describe it
+    def close(self, **arrays):
+        self.entry.close()
+        for name, array in arrays.items():
+            with self.zip.open(name + ".npy", "w") as fp:
+                np.lib.format.write_array(fp, np.asanyarray(array))
+        self.zip.close()
+
+
+# ------------------------------------------------------------
+# function: series_jobs
+# purpose: finds the series in the folders and returns one job (a
+#          dictionary) for every series at every exposure level. The
+#          slices are sorted and sized the same way the viewer loads them.
+#          Outputs are named after the folder, the series number and a
+#          short hash of the SeriesInstanceUID (series numbers repeat across
+#          studies). Jobs whose output already exists are left out so that
+#          nothing is overwritten
+# parameters: folders, exposures, settings, out_dir, out_format, workers
+# 1. folders   - folders of DICOM files
+# 2. exposures - slider values (image model) or incident photons per
+#                detector bin (sinogram model)
+# 3. settings  - the noise model settings every job gets (model, mode,
+#                angles, filter)
+# ------------------------------------------------------------
+def series_jobs(folders, exposures, settings, out_dir, out_format, workers):
+    jobs = []
+    out_paths = set()
+    for folder in folders:
+        for number, group in enumerate(scan_folder_series(folder, workers, "process")):
+            headers = sort_headers(group)
+            # like CTScan.allocate_volume, only the most common slice size is kept
+            shapes = [(header["rows"], header["columns"]) for header in headers]
+            shape = max(set(shapes), key=shapes.count)
+            kept = [header for header in headers if (header["rows"], header["columns"]) == shape]
+            if len(kept) < len(headers):
+                print("leaving out {} slices that are not {}x{}".format(len(headers) - len(kept), shape[0], shape[1]))
+
+            series_number = headers[0]["series_number"]
+            uid_hash = hashlib.sha1(str(headers[0]["series_uid"]).encode("utf-8")).hexdigest()[:8]
+            name = "{}_{}_{}".format(os.path.basename(os.path.normpath(folder)),
+                                     series_number if series_number is not None else number, uid_hash)
+            for exposure in exposures:
+                if settings["model"] == "image":
+                    level = "{}_{:g}".format(settings["mode_name"], exposure)
+                else:
+                    level = "sinogram_{:g}".format(exposure)
+                series_uid = generate_uid(entropy_srcs=[str(headers[0]["series_uid"]), level])
+                description = "{} (low dose {})".format(headers[0]["series_description"] or "", level).strip()
+                if out_format == "dicom":
+                    out_path = os.path.join(out_dir, name, level)
+                else:
+                    out_path = os.path.join(out_dir, "{}_{}.npz".format(name, level))
+                if os.path.exists(out_path) or out_path in out_paths:
+                    print("{} already exists, not overwriting it (skipping {} {})".format(out_path, name, level))
+                    continue
+                out_paths.add(out_path)
+                job = dict(settings)
+                job.update({"name": name, "level": level, "headers": kept, "shape": shape, "exposure": exposure,
+                            "out_path": out_path, "series_uid": series_uid, "description": description})
+                jobs.append(job)
+    return jobs
+
+
+# yields the tasks (see low_dose_slices) for chunk slices at a time of every job along with the job they belong to
+def job_tasks(jobs, out_format, chunk):
+    for job_number, job in enumerate(jobs):
+        # the headers stay behind - the workers only need the settings
+        settings = {key: value for key, value in job.items() if key != "headers"}
+        filenames = [header["filename"] for header in job["headers"]]
+        for first in range(0, len(filenames), chunk):
+            out_files = None
+            if out_format == "dicom":
+                out_files = [os.path.join(job["out_path"], "IM{:05d}.dcm".format(index))
+                             for index in range(first, min(first + chunk, len(filenames)))]
+            yield job_number, (first, filenames[first:first + chunk], out_files, settings)
+
+
+# runs low_dose_slices on a (job number, task) pair so the job number comes back with the result
+def run_task(numbered_task):
+    job_number, task = numbered_task
+    return job_number, len(task[1]), low_dose_slices(task)
+
+
+# ------------------------------------------------------------
+# function: run_batch
+# purpose: generates every job on a pool of processes and reports the
+#          throughput of each series and of the whole batch
+# parameters: jobs, out_format, workers, in_flight, chunk
+# ------------------------------------------------------------
+def run_batch(jobs, out_format, workers, in_flight, chunk):
+    total_slices = sum(len(job["headers"]) for job in jobs)
+    for job in jobs:
+        if out_format == "dicom":
+            os.makedirs(job["out_path"], exist_ok=True)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(job["out_path"])), exist_ok=True)
+
+    writer = None
+    done = 0
+    job_done = 0
+    start = time.perf_counter()
+    job_start = start
+    tasks = job_tasks(jobs, out_format, chunk)
+    for job_number, count, noisy in bounded_imap(run_task, tasks, workers, in_flight):
+        job = jobs[job_number]
+        if out_format == "npz":
+            if writer is None:
+                writer = NpzWriter(job["out_path"], (len(job["headers"]),) + job["shape"])
+            for pixelarray in noisy:
+                writer.add_slice(pixelarray)
+        done = done + count
+        job_done = job_done + count
+
+        if job_done == len(job["headers"]):
+            if writer is not None:
+                writer.close(slope=[header["RescaleSlope"] or 1.0 for header in job["headers"]],
+                             intercept=[header["RescaleIntercept"] or 0.0 for header in job["headers"]],
+                             exposure=job["exposure"])
+                writer = None
+            now = time.perf_counter()
+            print("{} {}: {} slices, {:.1f} slices/s -> {}".format(job["name"], job["level"], job_done,
+                                                                   job_done / max(now - job_start, 1e-9),
+                                                                   job["out_path"]))
+            print("  {}/{} slices done".format(done, total_slices))
+            job_done = 0
+            job_start = now
+
+    elapsed = time.perf_counter() - start
+    print("{} slices in {:.1f} s ({:.1f} slices/s)".format(done, elapsed, done / max(elapsed, 1e-9)))
+
+
+# usage: python Batch_Low_Dose.py <series folder> [<series folder> ...] --exposures 50 150 400 --out <folder>
+#        python Batch_Low_Dose.py <series folder> --model sinogram --exposures 1e4 1e5 --out <folder>
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates simulated low dose CT series.")
+    parser.add_argument("folders", nargs="+", help="folders of DICOM files (every series in them is used)")
+    parser.add_argument("--exposures", nargs="+", type=float, required=True,
+                        help="exposure levels - the viewer's slider values for the image model, photons per "
+                             "detector bin for the sinogram model (lower means more noise)")
+    parser.add_argument("--out", required=True, help="folder to write the generated series to")
+    parser.add_argument("--format", choices=["dicom", "npz"], default="dicom",
+                        help="DICOM series with new UIDs, or one compressed array per series")
+    parser.add_argument("--model", choices=["image", "sinogram"], default="image",
+                        help="noise added to the image like the viewer does, or to a simulated sinogram")
+    parser.add_argument("--mode", choices=sorted(NOISE_MODES), default="table", help="image noise mode")
+    parser.add_argument("--angles", type=int, default=DEFAULT_ANGLES, help="projection angles (sinogram model)")
+    parser.add_argument("--filter", choices=FILTERS, default="shepp-logan",
+                        help="reconstruction filter (sinogram model)")
+    parser.add_argument("--chunk", type=int, default=0,
+                        help="slices per task (default 1 for the image model, 8 for the sinogram model, "
+                             "which projects them together)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument("--in-flight", type=int, default=0,
+                        help="tasks handed to the workers at once (default 4 per worker)")
+    args = parser.parse_args()
+
+    exposures = [exposure for exposure in args.exposures if exposure > 0]
+    if len(exposures) < len(args.exposures):
+        print("leaving out exposure levels that are not above 0")
+    model_settings = {"model": args.model, "mode": NOISE_MODES[args.mode], "mode_name": args.mode,
+                      "angles": args.angles, "filter": args.filter}
+    batch_jobs = series_jobs(args.folders, exposures, model_settings, args.out, args.format, args.workers)
+    run_batch(batch_jobs, args.format, args.workers, args.in_flight or 4 * args.workers,
+              args.chunk or (1 if args.model == "image" else 8))
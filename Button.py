@@ -11,17 +11,96 @@ import glfw
 from OpenGL.GL import *
 from OpenGL.GL.shaders import compileProgram, compileShader
 import numpy as np
-import freetype
 import glm
 
 # internal dependencies
 import normalize
 from normalize import normalize_pixel
+from Texture_Manager import textures
+from Slice_Cache import LRUCache
+from Font_Cache import DEFAULT_FONT, load_font_atlas
+from Event_Log import log
+
+
+# -----------------------------------------------------------------------
+# Class: ShapeBatch
+# Purpose: Keeps the shapes of several widgets in one vertex array object
+#          (with its own vertex and element buffers) so they are drawn with a
+#          single call. Vertices are 5 floats - x, y (screen coordinates) and
+#          a color - the layout the button and slider shaders read. The
+#          buffers are only written when set_shapes is called
+# Elements:
+#    vao - the vertex array object
+#    vbo, ebo - its vertex and element buffers
+#    count - number of indices to draw
+# -----------------------------------------------------------------------
+class ShapeBatch:
+    vao = 0
+    vbo = 0
+    ebo = 0
+    count = 0
+
+    def __init__(self):
+        self.vao = glGenVertexArrays(1)
+        self.vbo = glGenBuffers(1)
+        self.ebo = glGenBuffers(1)
+        self.vertex_bytes = 0  # sizes of the buffers (they only grow)
+        self.index_bytes = 0
+
+        glBindVertexArray(self.vao)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.ebo)
+        glEnableVertexAttribArray(0)
+        glVertexAttribPointer(0, 2, GL_FLOAT, GL_FALSE, 20, ctypes.c_void_p(0))
+        glEnableVertexAttribArray(1)
+        glVertexAttribPointer(1, 3, GL_FLOAT, GL_FALSE, 20, ctypes.c_void_p(8))
+        glBindVertexArray(0)
+
+    # replaces what the batch draws with a list of (vertices, indices) shapes
+    def set_shapes(self, shapes):
+        vertex_list = []
+        index_list = []
+        first = 0
+        for vertices, indices in shapes:
+            vertex_list.append(vertices)
+            index_list.append(indices + first)
+            first = first + len(vertices) // 5
+        vertices = np.concatenate(vertex_list).astype(np.float32) if shapes else np.zeros(0, np.float32)
+        indices = np.concatenate(index_list).astype(np.uint32) if shapes else np.zeros(0, np.uint32)
+        self.count = len(indices)
+        if self.count == 0:
+            return
+
+        glBindVertexArray(self.vao)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        if vertices.nbytes > self.vertex_bytes:
+            glBufferData(GL_ARRAY_BUFFER, vertices.nbytes, vertices, GL_DYNAMIC_DRAW)
+            self.vertex_bytes = vertices.nbytes
+        else:
+            glBufferSubData(GL_ARRAY_BUFFER, 0, vertices.nbytes, vertices)
+        if indices.nbytes > self.index_bytes:
+            glBufferData(GL_ELEMENT_ARRAY_BUFFER, indices.nbytes, indices, GL_DYNAMIC_DRAW)
+            self.index_bytes = indices.nbytes
+        else:
+            glBufferSubData(GL_ELEMENT_ARRAY_BUFFER, 0, indices.nbytes, indices)
+        glBindVertexArray(0)
+
+    # draws every shape in the batch with a ShaderProgram
+    def draw(self, shader):
+        if self.count == 0:
+            return
+        shader.use()
+        glBindVertexArray(self.vao)
+        glDrawElements(GL_TRIANGLES, self.count, GL_UNSIGNED_INT, None)
+        glBindVertexArray(0)
 
 
 # -----------------------------------------------------------------------
 # Class: Panel
-# Purpose: Manages buttons given to it and displays a banner of buttons
+# Purpose: Manages buttons given to it and displays a banner of buttons.
+#          The shapes of all of the buttons are kept in one ShapeBatch that
+#          is only rebuilt when one of them changed (hovering, a menu opening
+#          or closing, or the window being resized) and drawn with one call
 # -----------------------------------------------------------------------
 class Panel:
     # variables that store where on the screen that a button is
@@ -30,11 +109,14 @@ class Panel:
     x1 = 0
     y1 = 0
     buttons = []
+    btn_shader = 0  # ShaderProgram the button shapes are drawn with
+    batch = 0  # ShapeBatch of every button's shapes (made on the first draw)
 
     # (x1, y1) upper left corner
-    def __init__(self, x1, y1, height, width):
+    def __init__(self, x1, y1, height, width, btn_shader=0):
         self.x1 = x1
         self.y1 = y1
+        self.btn_shader = btn_shader
         # for i in range(0, num_buttons):
         #     button = Button(x1, y1, x1 + 40, y1 + 20, height, width)
         #     x1 = x1 + 40
@@ -44,10 +126,25 @@ class Panel:
     def add_button(self, button):
         self.buttons.append(button)
 
-    # the panel will draw all of the button objects it is managing
+    # the panel will draw all of the button objects it is managing - the shapes in one call and
+    # then whatever each button draws on top of them (text and the slider)
     def draw(self, VBO, EBO):
+        if not self.batch:
+            self.batch = ShapeBatch()
+            self.build_batch()
+        elif any(button.has_changed() for button in self.buttons):
+            self.build_batch()
+        self.batch.draw(self.btn_shader)
+
         for i in range(len(self.buttons)):
-            self.buttons[i].draw(VBO, EBO)
+            self.buttons[i].draw_overlay(VBO, EBO)
+
+    # collects the shapes of every button into the batch
+    def build_batch(self):
+        shapes = []
+        for button in self.buttons:
+            shapes.extend(button.shapes())
+        self.batch.set_shapes(shapes)
 
     # the panel will check whether any of the buttons it is managing has been clicked
     def check_click(self, mouse_cx, mouse_cy):
@@ -93,11 +190,12 @@ class Button:
     function = 0
     btn_shader = 0
     color = [0.82, .82, 0.82]
+    changed = 1  # whether the vertices changed since the panel last collected them
 
     # (x1, y1) upper left corner
     # (x2, y2) lower right corner
     def __init__(self, x1, y1, height, width, window_height, window_width, btn_shader):
-        print("window height: " + str(window_height))
+        log.debug("ui", "window height: {}", window_height)
         self.x1 = x1
         self.y1 = y1
         self.x2 = x1 + width
@@ -125,6 +223,7 @@ class Button:
                          x1, y2, self.color[0], self.color[1], self.color[2],
                          x2, y2, self.color[0], self.color[1], self.color[2]]
         self.vertices = np.array(self.vertices, dtype=np.float32)
+        self.changed = 1
 
     # ------------------------------------------------------------------
     # Function: check_click
@@ -133,7 +232,7 @@ class Button:
     # -------------------------------------------------------------------
     def check_click(self, mouse_cx, mouse_cy):
         if self.x1 <= mouse_cx <= self.x2 and self.y1 <= mouse_cy <= self.y2:
-            print("button pressed")
+            log.debug("ui", "button pressed")
             # whether a button has a function assigned to it. If it it doesnt, do nothing
             if self.function:
                 # if button has function attributes, call the function with those attributes
@@ -154,7 +253,7 @@ class Button:
         if func_:
             self.function = func_
             self.attr = attributes
-            print("attributes: {}".format(self.attr))
+            log.debug("ui", "attributes: {}", self.attr)
 
     # resizes the button based on window size changes
     def resize(self, height, width):
@@ -163,37 +262,30 @@ class Button:
     # changes the buttons color when the button is hovered over
     def is_hovering(self, mouse_cx, mouse_cy):
         if self.x1 <= mouse_cx <= self.x2 and self.y1 <= mouse_cy <= self.y2:
-            self.color = [0.72, .72, 0.72]
+            color = [0.72, .72, 0.72]
         else:
-            self.color = [0.82, .82, 0.82]
+            color = [0.82, .82, 0.82]
+        if color == self.color:
+            return
+        self.color = color
         for i in range(4):
             self.vertices[5 * i + 2] = self.color[0]
             self.vertices[5 * i + 3] = self.color[1]
             self.vertices[5 * i + 4] = self.color[2]
+        self.changed = 1
 
-    # this function draws the button to the screen
-    def draw(self, VBO, EBO):
-        # binding shader for drawing
-        glUseProgram(self.btn_shader)
-
-        # binding buffers to overwrite for drawing to the screen
-        glBindBuffer(GL_ARRAY_BUFFER, VBO)
-        glBufferSubData(GL_ARRAY_BUFFER, 0, self.vertices)
+    # whether the shapes changed since shapes() was last called
+    def has_changed(self):
+        return self.changed
 
-        # Element Buffer Object
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, EBO)
-        glBufferSubData(GL_ELEMENT_ARRAY_BUFFER, 0, self.indices)
+    # returns the shapes to draw the button with, [(vertices, indices)] (see ShapeBatch)
+    def shapes(self):
+        self.changed = 0
+        return [(self.vertices, self.indices)]
 
-        # writing to vertex variable in shader
-        glEnableVertexAttribArray(0)
-        glVertexAttribPointer(0, 2, GL_FLOAT, GL_FALSE, 20, ctypes.c_void_p(0))
-
-        # writing to color variable in shader
-        glEnableVertexAttribArray(1)
-        glVertexAttribPointer(1, 3, GL_FLOAT, GL_FALSE, 20, ctypes.c_void_p(8))
-
-        # telling opengl to draw to the screen
-        glDrawElements(GL_TRIANGLES, len(self.indices), GL_UNSIGNED_INT, None)
+    # draws what goes on top of the button's shapes (a plain button has nothing)
+    def draw_overlay(self, VBO, EBO):
+        pass
 
 
 # -----------------------------------------------------------------------
@@ -226,26 +318,8 @@ class TextButton(Button):
         self.text = text
         self.set_alignment(alignment)
 
-    # draws the text button to the screen
-    def draw(self, VBO, EBO):
-        glUseProgram(self.btn_shader)
-        glBindBuffer(GL_ARRAY_BUFFER, VBO)
-        glBufferSubData(GL_ARRAY_BUFFER, 0, self.vertices)
-
-        # Element Buffer Object
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, EBO)
-        glBufferSubData(GL_ELEMENT_ARRAY_BUFFER, 0, self.indices)
-
-        glEnableVertexAttribArray(0)
-        glVertexAttribPointer(0, 2, GL_FLOAT, GL_FALSE, 20, ctypes.c_void_p(0))
-
-        glEnableVertexAttribArray(1)
-        glVertexAttribPointer(1, 3, GL_FLOAT, GL_FALSE, 20, ctypes.c_void_p(8))
-
-        glDrawElements(GL_TRIANGLES, len(self.indices), GL_UNSIGNED_INT, None)
-
-        glUseProgram(self.text_shader)
-
+    # draws the text on top of the button (render_text switches to the font's own shader)
+    def draw_overlay(self, VBO, EBO):
         self.font.render_text(self.text, self.x1 + self.alignx, self.y1 + self.aligny, VBO, EBO)
 
     # sets the alignment of the text on the button (default is set to the left edge of the button)
@@ -275,6 +349,9 @@ class PullDownMenu:
     window_height = 0
     window_width = 0
     btn_number = 0
+    changed = 1  # whether the menu opened or closed since the panel last collected the shapes
+    arrow_vertices = 0  # triangle drawn on the pull down button (see set_arrow)
+    arrow_indices = np.array([0, 1, 2], dtype=np.uint32)
 
     #
     def __init__(self, x1, y1, height, width, window_height, window_width, font, btn_shader, txt_shader):
@@ -292,19 +369,38 @@ class PullDownMenu:
         # generating button to function as pull down button
         self.buttons.append(Button(offset, y1, height, 10, window_height, window_width, btn_shader))
         self.buttons[1].set_function(do_nothing)
+        self.set_arrow()
 
-    # draw main button and pull down button
-    def draw(self, VBO, EBO):
-        if not self.menu_open:
-            self.buttons[0].draw(VBO, EBO)  # main button
-            self.buttons[1].draw(VBO, EBO)  # pull down button
-
-        # if the menu is open then continue drawing it else don't draw the menu
+    # the buttons showing - the main button and pull down button, and the menu's buttons when it is open
+    def visible_buttons(self):
         if self.menu_open:
-            for i in range(len(self.buttons)):
-                self.buttons[i].draw(VBO, EBO)
-
-        # draw arrow for the pull down button
+            return self.buttons
+        return self.buttons[:2]
+
+    # whether the menu or any of its buttons changed since shapes() was last called
+    def has_changed(self):
+        return self.changed or any(button.has_changed() for button in self.buttons)
+
+    # returns the shapes of the buttons showing and the arrow (see ShapeBatch)
+    def shapes(self):
+        visible = self.visible_buttons()
+        shapes = []
+        for button in self.buttons:
+            # the hidden buttons are asked too so their changes are not picked up again
+            button_shapes = button.shapes()
+            if button in visible:
+                shapes.extend(button_shapes)
+        shapes.append((self.arrow_vertices, self.arrow_indices))
+        self.changed = 0
+        return shapes
+
+    # draws the text of the buttons showing
+    def draw_overlay(self, VBO, EBO):
+        for button in self.visible_buttons():
+            button.draw_overlay(VBO, EBO)
+
+    # works out the arrow for the pull down button (only when the buttons are laid out again)
+    def set_arrow(self):
         # visual of button (coordinates as points)
         #  (s_x1, s_y1)----(s_x2, s_y1)
         #  \                          /
@@ -326,27 +422,8 @@ class PullDownMenu:
                  s_x2, s_y1, 0, 0, 0,
                  mid, s_y2, 0, 0, 0]
 
-        verts = np.array(verts, dtype=np.float32)
-        indices = np.array([0, 1, 2], dtype=np.uint32)
-
-        # binding shader to draw and binding VBO's and EBO's to overwrite shader/gpu memory
-        # to write to the screen
-        glUseProgram(self.btn_shader)
-        glBindBuffer(GL_ARRAY_BUFFER, VBO)
-        glBufferSubData(GL_ARRAY_BUFFER, 0, verts)
-
-        # Element Buffer Object
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, EBO)
-        glBufferSubData(GL_ELEMENT_ARRAY_BUFFER, 0, indices)
-
-        glEnableVertexAttribArray(0)
-        glVertexAttribPointer(0, 2, GL_FLOAT, GL_FALSE, 20, ctypes.c_void_p(0))
-
-        glEnableVertexAttribArray(1)
-        glVertexAttribPointer(1, 3, GL_FLOAT, GL_FALSE, 20, ctypes.c_void_p(8))
-
-        # draw arrow
-        glDrawElements(GL_TRIANGLES, len(indices), GL_UNSIGNED_INT, None)
+        self.arrow_vertices = np.array(verts, dtype=np.float32)
+        self.changed = 1
 
     def check_click(self, mouse_cx, mouse_cy):
         # checking whether to only check if the main button
@@ -366,11 +443,12 @@ class PullDownMenu:
                     # if the pull down button was pressed set the flag to draw the pull down menu
                     if start == 1:
                         self.menu_open = not self.menu_open
+                        self.changed = 1
                     if self.buttons[start].function:
 
                         # if button has function attributes, call the function with those attributes
                         if self.buttons[start].attr:
-                            print("calling function")
+                            log.debug("ui", "calling function")
                             self.buttons[start].function(self.buttons[start].attr)
 
                         # if the pull down menu is open then check if any of the pull down buttons were
@@ -389,6 +467,7 @@ class PullDownMenu:
                     count = 1
             if not count:
                 self.menu_open = 0
+                self.changed = 1
 
     def set_function(self, func_=None, attributes=None):
         # setting the function for the main button
@@ -405,6 +484,7 @@ class PullDownMenu:
         self.window_width = width
         for i in range(len(self.buttons)):
             self.buttons[i].resize(height, width)
+        self.set_arrow()
 
     def is_hovering(self, mouse_cx, mouse_cy):
         for i in range(len(self.buttons)):
@@ -450,33 +530,47 @@ class PullDownMenu:
 # Purpose: Stores all relevant information about loading a character bitmap to
 #          the screen
 # Elements:
-#    TextureID - holds the ID to grab the texture from memory
+#    TextureID - holds the ID to grab the texture from memory (the font's atlas)
 #    Size - holds the height and width of the bitmap
 #    Bearing - holds information relevant to aligning characters correctly
 #    Advance - holds the amount of between the current character and where the next one
 #              should be placed
+#    UV - where the bitmap is in the atlas (left, bottom, right, top) in the texture
+#         coordinates the text shader takes (it flips them vertically)
 # --------------------------------------------------------------------------------------
 class Character:
     TextureID = 0
     Size = glm.vec2(0, 0)
     Bearing = glm.vec2(0, 0)
     Advance = 0
+    UV = glm.vec4(0, 0, 0, 0)
 
-    def __init__(self, TextureID, Size, Bearing, Advance):
+    def __init__(self, TextureID, Size, Bearing, Advance, UV):
         self.TextureID = TextureID
         self.Size = Size
         self.Bearing = Bearing
         self.Advance = Advance
+        self.UV = UV
+
+
+# bytes of laid out strings each font keeps so labels that do not change are not laid out again
+LAYOUT_CACHE_BYTES = 256 * 1024
 
 
 # ------------------------------------------------------------------------------------------
 # Class: Text
 # Purpose: Allows the creation of text objects that can load a font (specified by the user),
-#          reads in the first 128 characters of the font, and draws a string of text to
-#          the screen
+#          reads in the first 128 characters of the font into one texture (the atlas), and
+#          draws a string of text to the screen. A string is laid out as one vertex array
+#          (a quad per character) and drawn with a single call, and the layouts of the last
+#          strings drawn are kept so that labels that do not change are not laid out again
 # Elements:
 #    text_array - used for storing the first 128 characters of the font
 #    indices - generic element for visualizing a character
+#    atlas - texture holding the bitmaps of every character
+#    vao, vbo, ebo - vertex array object and buffers strings are drawn from (the element
+#                    buffer holds the indices of max_chars quads)
+#    layouts - LRUCache of (text, x, y, color, window height) -> vertices
 # -------------------------------------------------------------------------------------------
 class Text:
     text_array = []
@@ -484,70 +578,93 @@ class Text:
     height = 0
     width = 0
     txt_shader = 0
+    atlas = 0
+    vao = 0
+    vbo = 0
+    ebo = 0
+    max_chars = 0
 
     def __init__(self, height, width, txt_shader):
         self.height = height
         self.width = width
         self.txt_shader = txt_shader
+        self.layouts = LRUCache(LAYOUT_CACHE_BYTES)
+        self.vertex_bytes = 0
+
+    # loading a font and reading in the first 128 characters (the bundled Arial unless another
+    # font is given). The characters are rasterized once per font and size and then loaded from
+    # the font cache (see Font_Cache) so only a single texture upload is needed
+    def load_font(self, font_path=DEFAULT_FONT, pixel_size=18, cache_dir=None):
+        atlas, metrics = load_font_atlas(font_path, pixel_size, cache_dir)
+
+        rows, cols = atlas.shape
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        self.atlas = textures.create(self, atlas.nbytes)
+        glBindTexture(GL_TEXTURE_2D, self.atlas)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RED, cols, rows, 0, GL_RED, GL_UNSIGNED_BYTE, atlas)
+        # Set the texture wrapping parameters
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+        # Set texture filtering parameters
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glBindTexture(GL_TEXTURE_2D, 0)  # unbinding the texture
+
+        # creating characters and storing them in the text array full of the first
+        # 128 characters of the font. The shader flips v so the top of a bitmap is at 1 - y / rows
+        self.text_array = []
+        for x, y, w, h, left, top, advance in metrics.tolist():
+            uv = glm.vec4(x / cols, 1 - (y + h) / rows, (x + w) / cols, 1 - y / rows)
+            self.text_array.append(Character(self.atlas, glm.vec2(w, h), glm.vec2(left, top), advance, uv))
+
+        # the same glyph information as arrays so whole strings are laid out at once
+        self.glyph_sizes = np.array([ch.Size.to_tuple() for ch in self.text_array], dtype=np.float64)
+        self.glyph_bearings = np.array([ch.Bearing.to_tuple() for ch in self.text_array], dtype=np.float64)
+        self.glyph_advances = np.array([ch.Advance / 64 for ch in self.text_array], dtype=np.float64)
+        self.glyph_uvs = np.array([ch.UV.to_tuple() for ch in self.text_array], dtype=np.float32)
+        self.layouts.clear()
+
+        self.vao = glGenVertexArrays(1)
+        self.vbo = glGenBuffers(1)
+        self.ebo = glGenBuffers(1)
+        glBindVertexArray(self.vao)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        # Vertices Element
+        glEnableVertexAttribArray(0)
+        glVertexAttribPointer(0, 2, GL_FLOAT, GL_FALSE, 28, ctypes.c_void_p(0))
+        # Color Element
+        glEnableVertexAttribArray(1)
+        glVertexAttribPointer(1, 3, GL_FLOAT, GL_FALSE, 28, ctypes.c_void_p(8))
+        # Texture Element
+        glEnableVertexAttribArray(2)
+        glVertexAttribPointer(2, 2, GL_FLOAT, GL_FALSE, 28, ctypes.c_void_p(20))
+        glBindVertexArray(0)
+        self.reserve(64)
+
+    # makes the element buffer hold the indices of at least count quads
+    def reserve(self, count):
+        if count <= self.max_chars:
+            return
+        while self.max_chars < count:
+            self.max_chars = max(2 * self.max_chars, 64)
+        indices = (self.indices + 4 * np.arange(self.max_chars, dtype=np.uint32)[:, None]).ravel()
+        glBindVertexArray(self.vao)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.ebo)
+        glBufferData(GL_ELEMENT_ARRAY_BUFFER, indices.nbytes, indices, GL_STATIC_DRAW)
+        glBindVertexArray(0)
 
-    # loading a font and reading in the first 128 characters (currently only supports Arial
-    # because it is hardcoded in - only requires a slight change to fix this)
-    def load_font(self):
-        # loading font
-        face = freetype.Face('C:/Windows/Fonts/Arial.ttf', 0)
-        # setting font size
-        face.set_pixel_sizes(0, 18)
-
-        # loading first 128 characters of the Font into memory with relevant information
-        # to display to the screen later
-        for i in range(0, 128):
-            glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
-            face.load_char(chr(i), freetype.FT_LOAD_RENDER)
-            # print("letter: {}, i: {}".format(chr(i), i))
-            # creating the texture binding and reading the bitmap in an OpenGL Friendly way
-            texture = glGenTextures(1)
-            glBindTexture(GL_TEXTURE_2D, texture)
-            glTexImage2D(GL_TEXTURE_2D,
-                         0,
-                         GL_RED,
-                         face.glyph.bitmap.width,
-                         face.glyph.bitmap.rows,
-                         0,
-                         GL_RED,
-                         GL_UNSIGNED_BYTE,
-                         face.glyph.bitmap.buffer)
-            # Set the texture wrapping parameters
-            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
-            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
-            # Set texture filtering parameters
-            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
-            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
-
-            # creating character and storing it in the text array full of the first
-            # 128 characters of the font
-            ch = Character(texture,
-                           glm.vec2(face.glyph.bitmap.width, face.glyph.bitmap.rows),
-                           glm.vec2(face.glyph.bitmap_left, face.glyph.bitmap_top),
-                           face.glyph.advance.x)
-            self.text_array.append(ch)
-
-            glBindTexture(GL_TEXTURE_2D, 0)  # unbinding the texture
-        face = 0  # not sure if this is right - documentation was bad
-
-    # add scaling later
-    # renders a string of text to the screen
-    def render_text(self, text, x, y, VBO, EBO, color_choice=None):
-        glUseProgram(self.txt_shader)
-        glEnable(GL_BLEND)
-        max_ = 0
-        # alignment for top (has issues with aligning to bottom might need more code for this)
-        # for i in range(len(text)):
-        #    if self.text_array[ord(text[i])].Size.y > max_:
-        max_ = self.text_array[65].Size.y
-        # print("word: {}, max: {}".format(text, max_))
-        y = self.height - y - max_  # + self.text_array[ord('A')].Size.y / 2
+    # ------------------------------------------------------------------
+    # Function: layout
+    # Purpose: returns the vertices (7 floats each - x, y, color, u, v) of
+    #          a quad for every character of text that has a bitmap, with
+    #          the top of an 'A' at y pixels from the top of the window
+    # ------------------------------------------------------------------
+    def layout(self, text, x, y, color_choice=None):
+        if len(text) == 0:
+            return np.empty((0, 4, 7), dtype=np.float32)
 
-        scale = 1.0  # must be between 0 and 1 - changes the size of the text
+        # alignment for top (has issues with aligning to bottom might need more code for this)
+        y = self.height - y - self.text_array[65].Size.y
 
         # default color is black
         color = [0, 0, 0]
@@ -556,64 +673,51 @@ class Text:
         elif color_choice == 'y':
             color = [1, 1, 0]
 
-        vertices = [0, 0, color[0], color[1], color[2], 0.0, 0.0,
-                    0, 0, color[0], color[1], color[2], 1.0, 0.0,
-                    0, 0, color[0], color[1], color[2], 1.0, 1.0,
-                    0, 0, color[0], color[1], color[2], 0.0, 1.0]
-
-        vertices = np.array(vertices, dtype=np.float32)
-        # rendering the given string 'text' to the screen
-        for i in range(len(text)):
-            # ord: char -> int
-            # chr: int -> char
-            letter = self.text_array[ord(text[i])]
-            # glyph 1
-            w = letter.Size.x * scale
-            h = letter.Size.y * scale
-
-            xpos = (x + letter.Bearing.x) * scale
-            ypos = (y - letter.Size.y + letter.Bearing.y) * scale
-            # vertices = [xpos, ypos,         1.0, 0.0, 0.0,  0.0, 0.0,
-            #             xpos + w, ypos,     1.0, 0.0, 0.0,  1.0, 0.0,
-            #             xpos + w, ypos + h, 1.0, 0.0, 0.0,  1.0, 1.0,
-            #             xpos, ypos + h,     1.0, 0.0, 0.0,  0.0, 1.0]
-            #
-            # vertices = np.array(vertices, dtype=np.float32)
-            # setting the vertices manually (this is probably bad?)
-            vertices[0] = xpos
-            vertices[1] = ypos
-            vertices[7] = xpos + w
-            vertices[8] = ypos
-            vertices[14] = xpos + w
-            vertices[15] = ypos + h
-            vertices[21] = xpos
-            vertices[22] = ypos + h
-
-            # binding texture
-            glBindTexture(GL_TEXTURE_2D, letter.TextureID)
-
-            # binding buffer and updating buffer array with new information from vertices
-            glBindBuffer(GL_ARRAY_BUFFER, VBO)
-            glBufferSubData(GL_ARRAY_BUFFER, 0, vertices.nbytes, vertices)
-
-            # binding buffer and updating buffer array with information from vertices
-            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, EBO)
-            glBufferSubData(GL_ELEMENT_ARRAY_BUFFER, 0, self.indices.nbytes, self.indices)
-
-            # Vertices Element
-            glEnableVertexAttribArray(0)
-            glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, vertices.itemsize * 7, ctypes.c_void_p(0))
-
-            # Color Element
-            glEnableVertexAttribArray(1)
-            glVertexAttribPointer(1, 3, GL_FLOAT, GL_FALSE, vertices.itemsize * 7, ctypes.c_void_p(8))
-
-            # Texture Element
-            glEnableVertexAttribArray(2)
-            glVertexAttribPointer(2, 2, GL_FLOAT, GL_FALSE, vertices.itemsize * 7, ctypes.c_void_p(20))
-
-            glDrawElements(GL_TRIANGLES, len(self.indices), GL_UNSIGNED_INT, None)
-            x = x + letter.Advance / 64
+        codes = np.array([ord(c) for c in text], dtype=np.intp)
+        # where each character starts (the advances are added up like a pen moving along the line)
+        pen = x + np.concatenate(([0], np.cumsum(self.glyph_advances[codes])[:-1]))
+        # characters like space have nothing to draw
+        drawn = self.glyph_sizes[codes].prod(axis=1) > 0
+        codes = codes[drawn]
+        pen = pen[drawn]
+
+        w, h = self.glyph_sizes[codes].T
+        xpos = pen + self.glyph_bearings[codes, 0]
+        ypos = y - h + self.glyph_bearings[codes, 1]
+        u0, v0, u1, v1 = self.glyph_uvs[codes].T
+
+        vertices = np.empty((len(codes), 4, 7), dtype=np.float32)
+        vertices[:, :, 2:5] = color
+        vertices[:, 0, 0], vertices[:, 0, 1], vertices[:, 0, 5], vertices[:, 0, 6] = xpos, ypos, u0, v0
+        vertices[:, 1, 0], vertices[:, 1, 1], vertices[:, 1, 5], vertices[:, 1, 6] = xpos + w, ypos, u1, v0
+        vertices[:, 2, 0], vertices[:, 2, 1], vertices[:, 2, 5], vertices[:, 2, 6] = xpos + w, ypos + h, u1, v1
+        vertices[:, 3, 0], vertices[:, 3, 1], vertices[:, 3, 5], vertices[:, 3, 6] = xpos, ypos + h, u0, v1
+        return vertices
+
+    # renders a string of text to the screen with one draw call (VBO and EBO are not used - the
+    # font has its own buffers - but are kept so the widgets can all be drawn the same way)
+    def render_text(self, text, x, y, VBO, EBO, color_choice=None):
+        key = (text, x, y, color_choice, self.height)
+        vertices = self.layouts.get(key)
+        if vertices is None:
+            vertices = self.layout(text, x, y, color_choice)
+            self.layouts.put(key, vertices, vertices.nbytes)
+        if len(vertices) == 0:
+            return
+
+        self.txt_shader.use()
+        glEnable(GL_BLEND)
+        glBindTexture(GL_TEXTURE_2D, self.atlas)
+        self.reserve(len(vertices))
+
+        glBindVertexArray(self.vao)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        if vertices.nbytes > self.vertex_bytes:
+            glBufferData(GL_ARRAY_BUFFER, 4 * self.max_chars * 28, None, GL_DYNAMIC_DRAW)
+            self.vertex_bytes = 4 * self.max_chars * 28
+        glBufferSubData(GL_ARRAY_BUFFER, 0, vertices.nbytes, vertices)
+        glDrawElements(GL_TRIANGLES, len(vertices) * len(self.indices), GL_UNSIGNED_INT, None)
+        glBindVertexArray(0)
         glDisable(GL_BLEND)
 
     # set/change the height and width (for use when the window changes sizes)
@@ -636,7 +740,7 @@ class InfoBanner:
         self.x1 = x1
         self.y1 = y1
         self.text_shader = txt_shader
-        print("initializing info banner")
+        log.debug("ui", "initializing info banner")
 
     def update_info(self, params):
         self.params = params
@@ -689,6 +793,9 @@ class SlideBar:
     thumb_vertices = 0  # corner vertices for drawing the thumb
     base_vertices = 0  # corner vertices for drawing the slider base
     slider_shader = 0  # will store the reference to the shader used for drawing
+    batch = 0  # ShapeBatch of the base and the thumb (made on the first draw)
+    changed = 1  # whether the vertices changed since the batch was last written
+    batch_translate = 0  # thumb_translate the batch was written with
 
     # initializing the object
     def __init__(self, x1, y1, s_height, s_width, window_height, window_width, rt, slider_shader):
@@ -737,6 +844,7 @@ class SlideBar:
                                x1, y2, 0.0, 0.0, 0.0,
                                x2, y2, 0.0, 0.0, 0.0]
         self.thumb_vertices = np.array(self.thumb_vertices, dtype=np.float32)
+        self.changed = 1
 
     def check_click(self, mouse_cx, mouse_cy):
         if self.currx1 <= mouse_cx <= self.currx2 and self.y1 <= mouse_cy <= self.y2:
@@ -759,8 +867,15 @@ class SlideBar:
             self.function = func_
             self.attr = attributes
 
+    # the slider is drawn with its own shader so it adds nothing to the panel's shapes
+    def has_changed(self):
+        return 0
+
+    def shapes(self):
+        return []
+
     # draws the object to the screen
-    def draw(self, VBO, EBO):
+    def draw_overlay(self, VBO, EBO):
         # drawing will consist of:
         #   drawing a rectangle as the slider base
         #   drawing the thumb
@@ -769,64 +884,38 @@ class SlideBar:
         #       thumb will be drawn green
 
         # loading shader for drawing
-        glUseProgram(self.slider_shader)
+        self.slider_shader.use()
 
-        # setting the model matrix and sending to the shader for drawing
-        model = glm.mat4(1)
-        model_loc = glGetUniformLocation(self.slider_shader, "model")
-        glUniformMatrix4fv(model_loc, 1, GL_FALSE, glm.value_ptr(model))
+        # the thumb's position is part of its vertices so nothing is moved by the model matrix
+        self.slider_shader.set_mat4("model", glm.mat4(1))
 
         # sending coordinate information about the thumb to the shader so that it
         # can draw the track green to the left of it and gray to the right of it
-        coordx_loc = glGetUniformLocation(self.slider_shader, "coordx")
         # print("length: {}, currx2: {}, x1: {}, sl_width: {}".format(self.currx2 - self.sliderbase_width * .025,
         #                                                             self.currx2, self.x1,
         #                                                             self.sx1 + self.sliderbase_width))
         coord = glm.vec4(self.currx2 - self.sliderbase_width * .025, self.currx2, self.x1,
                          self.sx1 + self.sliderbase_width * 0.975)
-        glUniform4fv(coordx_loc, 1, glm.value_ptr(coord))
+        self.slider_shader.set_vec4("coordx", coord)
 
         # sending coordinate information about the top and bottom of the thumb
         # to the shader so that it can draw the track
-        coordy_loc = glGetUniformLocation(self.slider_shader, "coordy")
         # print("y1: {}".format(self.window_height - self.y1))
-        coord = glm.vec2(self.window_height - self.y1, self.window_height - self.y2)
-        glUniform2fv(coordy_loc, 1, glm.value_ptr(coord))
-
-        # DRAWING SLIDER BASE -----
-        glBindBuffer(GL_ARRAY_BUFFER, VBO)
-        glBufferSubData(GL_ARRAY_BUFFER, 0, self.base_vertices)
-
-        # Element Buffer Object
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, EBO)
-        glBufferSubData(GL_ELEMENT_ARRAY_BUFFER, 0, self.indices)
-
-        glEnableVertexAttribArray(0)
-        glVertexAttribPointer(0, 2, GL_FLOAT, GL_FALSE, 20, ctypes.c_void_p(0))
-
-        glEnableVertexAttribArray(1)
-        glVertexAttribPointer(1, 3, GL_FLOAT, GL_FALSE, 20, ctypes.c_void_p(8))
-
-        glDrawElements(GL_TRIANGLES, len(self.indices), GL_UNSIGNED_INT, None)
-
-        model = glm.translate(model, self.thumb_translate)
-        glUniformMatrix4fv(model_loc, 1, GL_FALSE, glm.value_ptr(model))
-
-        # DRAWING THUMB ------
-        glBindBuffer(GL_ARRAY_BUFFER, VBO)
-        glBufferSubData(GL_ARRAY_BUFFER, 0, self.thumb_vertices)
-
-        # Element Buffer Object
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, EBO)
-        glBufferSubData(GL_ELEMENT_ARRAY_BUFFER, 0, self.indices)
-
-        glEnableVertexAttribArray(0)
-        glVertexAttribPointer(0, 2, GL_FLOAT, GL_FALSE, 20, ctypes.c_void_p(0))
-
-        glEnableVertexAttribArray(1)
-        glVertexAttribPointer(1, 3, GL_FLOAT, GL_FALSE, 20, ctypes.c_void_p(8))
-
-        glDrawElements(GL_TRIANGLES, len(self.indices), GL_UNSIGNED_INT, None)
+        self.slider_shader.set_vec2("coordy", self.window_height - self.y1, self.window_height - self.y2)
+
+        # DRAWING SLIDER BASE AND THUMB ----- (in one call - the buffers are only written again when the
+        # thumb moved or the window was resized)
+        if not self.batch:
+            self.batch = ShapeBatch()
+        translate = (self.thumb_translate.x, self.thumb_translate.y)
+        if self.changed or translate != self.batch_translate:
+            thumb = self.thumb_vertices.copy()
+            thumb[0::5] += translate[0]
+            thumb[1::5] += translate[1]
+            self.batch.set_shapes([(self.base_vertices, self.indices), (thumb, self.indices)])
+            self.batch_translate = translate
+            self.changed = 0
+        self.batch.draw(self.slider_shader)
 
         # calculating slider value based off starting pixel and where the left edge of the thumb is
         self.slider_value = self.currx2 - self.x2
@@ -0,0 +1,231 @@
+# --------------------
+# File: Dicom_Catalog.py
+# Purpose: A local SQLite index of the DICOM files in an archive (patients, studies, series
+#          and instances along with their file paths and header information). The archive is
+#          crawled once and then only files whose size or modification time changed are read
+#          again, so a series can be opened by its UID without walking the file system.
+# Author: Jacob Knop
+# Date: Summer 2020
+# --------------------
+
+# external dependencies
+import os
+import sys
+import json
+import sqlite3
+import threading
+
+# internal dependencies
+from Read_Dicom import read_dcm_header, pool_map, unique_headers
+from Volume_Cache import DEFAULT_CACHE_DIR
+from Event_Log import log
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime INTEGER,
+    is_image INTEGER
+);
+CREATE TABLE IF NOT EXISTS patients (
+    patient_id TEXT PRIMARY KEY,
+    patient_name TEXT
+);
+CREATE TABLE IF NOT EXISTS studies (
+    study_uid TEXT PRIMARY KEY,
+    patient_id TEXT,
+    study_date TEXT,
+    study_description TEXT
+);
+CREATE TABLE IF NOT EXISTS series (
+    series_uid TEXT PRIMARY KEY,
+    study_uid TEXT,
+    modality TEXT,
+    series_number INTEGER,
+    series_description TEXT
+);
+CREATE TABLE IF NOT EXISTS instances (
+    path TEXT PRIMARY KEY,
+    sop_uid TEXT,
+    series_uid TEXT,
+    instance_number INTEGER,
+    header TEXT
+);
+CREATE INDEX IF NOT EXISTS instances_series ON instances (series_uid);
+CREATE INDEX IF NOT EXISTS studies_patient ON studies (patient_id);
+CREATE INDEX IF NOT EXISTS series_study ON series (study_uid);
+"""
+
+
+# -----------------------------------------------------------------------
+# Class: DicomCatalog
+# Purpose: Crawls folders of DICOM files into an SQLite database and
+#          answers questions about what is in them. Every file that was
+#          looked at is kept in the files table (including files that are
+#          not DICOM images) so unchanged files are never read twice.
+# -----------------------------------------------------------------------
+class DicomCatalog:
+    db_path = 0
+    connection = 0
+
+    def __init__(self, db_path=None):
+        if db_path is None:
+            db_path = os.path.join(DEFAULT_CACHE_DIR, "catalog.sqlite")
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        self.connection.executescript(CATALOG_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    # ------------------------------------------------------------------
+    # Function: crawl
+    # Purpose: brings the catalog up to date with everything under root.
+    #          Only new files and files whose size or modification time
+    #          changed have their headers read (on a pool of workers), and
+    #          files that were removed are dropped. Returns
+    #          (files read, files removed)
+    # ------------------------------------------------------------------
+    def crawl(self, root, workers=0, pool_type="thread"):
+        root = os.path.abspath(root)
+        prefix = os.path.join(root, "")
+
+        known = {}
+        for path, size, mtime in self.connection.execute("SELECT path, size, mtime FROM files"):
+            if path.startswith(prefix):
+                known[path] = (size, mtime)
+
+        changed = []
+        stats = {}
+        for dirpath, dirs, files in os.walk(root):
+            for file in files:
+                path = os.path.join(dirpath, file)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                stats[path] = (st.st_size, st.st_mtime_ns)
+                if known.get(path) != stats[path]:
+                    changed.append(path)
+
+        removed = [path for path in known if path not in stats]
+        headers = pool_map(read_dcm_header, changed, workers, pool_type)
+
+        with self.connection:
+            for path in removed:
+                self.connection.execute("DELETE FROM files WHERE path = ?", (path,))
+                self.connection.execute("DELETE FROM instances WHERE path = ?", (path,))
+
+            for path, header in zip(changed, headers):
+                size, mtime = stats[path]
+                self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                                        (path, size, mtime, int(header is not None)))
+                if header is None:
+                    self.connection.execute("DELETE FROM instances WHERE path = ?", (path,))
+                    continue
+                self.add_instance(header)
+
+            # series, studies and patients that no longer have any instances (NOT EXISTS rather than NOT IN
+            # as headers without a UID leave NULLs, and NOT IN a list holding a NULL is never true)
+            self.connection.execute("DELETE FROM series WHERE NOT EXISTS "
+                                    "(SELECT 1 FROM instances i WHERE i.series_uid = series.series_uid)")
+            self.connection.execute("DELETE FROM studies WHERE NOT EXISTS "
+                                    "(SELECT 1 FROM series s WHERE s.study_uid = studies.study_uid)")
+            self.connection.execute("DELETE FROM patients WHERE NOT EXISTS "
+                                    "(SELECT 1 FROM studies s WHERE s.patient_id = patients.patient_id)")
+
+        log.info("cache", "catalog: read {} files, removed {} files under {}", len(changed), len(removed), root)
+        return len(changed), len(removed)
+
+    # writes the records for one image header (called inside crawl's transaction)
+    def add_instance(self, header):
+        self.connection.execute("INSERT OR REPLACE INTO patients VALUES (?, ?)",
+                                (header["patient_id"], header["patient_name"]))
+        self.connection.execute("INSERT OR REPLACE INTO studies VALUES (?, ?, ?, ?)",
+                                (header["study_uid"], header["patient_id"], header["study_date"],
+                                 header["study_description"]))
+        self.connection.execute("INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?, ?)",
+                                (header["series_uid"], header["study_uid"], header["modality"],
+                                 header["series_number"], header["series_description"]))
+        self.connection.execute("INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?, ?)",
+                                (header["filename"], header["sop_uid"], header["series_uid"],
+                                 header["instance_number"], json.dumps(header)))
+
+    # ------------------------------------------------------------------
+    # Function: list_series
+    # Purpose: returns a dictionary for every series in the catalog with
+    #          its patient, study and number of instances
+    # ------------------------------------------------------------------
+    def list_series(self, patient_id=None):
+        query = ("SELECT series.series_uid, patients.patient_id, patients.patient_name, studies.study_uid, "
+                 "studies.study_date, studies.study_description, series.modality, series.series_number, "
+                 "series.series_description, COUNT(DISTINCT COALESCE(instances.sop_uid, instances.path)) "
+                 "FROM series "
+                 "JOIN instances ON instances.series_uid = series.series_uid "
+                 "LEFT JOIN studies ON studies.study_uid = series.study_uid "
+                 "LEFT JOIN patients ON patients.patient_id = studies.patient_id ")
+        args = ()
+        if patient_id is not None:
+            query = query + "WHERE patients.patient_id = ? "
+            args = (patient_id,)
+        query = query + ("GROUP BY series.series_uid "
+                         "ORDER BY patients.patient_id, studies.study_date, series.series_number")
+
+        keys = ["series_uid", "patient_id", "patient_name", "study_uid", "study_date", "study_description",
+                "modality", "series_number", "series_description", "num_instances"]
+        return [dict(zip(keys, row)) for row in self.connection.execute(query, args)]
+
+    # returns the slice headers of a series (ready to hand to CTScan) without touching its files. An
+    # instance that is in the archive more than once (the same SOPInstanceUID) is only returned once
+    def series_headers(self, series_uid):
+        rows = self.connection.execute("SELECT header FROM instances WHERE series_uid = ? ORDER BY path",
+                                       (series_uid,))
+        return unique_headers([json.loads(row[0]) for row in rows])
+
+    # returns the file paths of a series (one file per instance)
+    def series_files(self, series_uid):
+        rows = self.connection.execute("SELECT MIN(path) FROM instances WHERE series_uid = ? "
+                                       "GROUP BY COALESCE(sop_uid, path) ORDER BY 1", (series_uid,))
+        return [row[0] for row in rows]
+
+
+# ------------------------------------------------------------
+# function: crawl_in_background
+# purpose: crawls root into the catalog at db_path on a background thread
+#          so the window keeps drawing, and returns the thread. SQLite
+#          connections only work on the thread that opened them so the
+#          thread opens its own. done is called (from that thread) with
+#          (files read, files removed) when it finishes, or not at all if
+#          the crawl failed
+# parameters: db_path, root, workers, pool_type, done
+# ------------------------------------------------------------
+def crawl_in_background(db_path, root, workers=0, pool_type="thread", done=None):
+    def crawl():
+        try:
+            catalog = DicomCatalog(db_path)
+            try:
+                result = catalog.crawl(root, workers, pool_type)
+            finally:
+                catalog.close()
+        except (sqlite3.Error, OSError) as e:
+            log.error("cache", "could not update the catalog with {}: {}", root, e)
+            return
+        if done:
+            done(*result)
+
+    thread = threading.Thread(target=crawl, daemon=True)
+    thread.start()
+    return thread
+
+
+# crawls the folders given on the command line into the default catalog
+# usage: python Dicom_Catalog.py <archive folder> [<archive folder> ...]
+if __name__ == "__main__":
+    catalog = DicomCatalog()
+    for folder in sys.argv[1:]:
+        catalog.crawl(folder, os.cpu_count() or 1)
+    for series in catalog.list_series():
+        print("{patient_id}  {study_date}  {modality}  {series_description}  ({num_instances} images)  "
+              "{series_uid}".format(**series))
+    catalog.close()
@@ -13,14 +13,14 @@ import numpy as np
 import sys  # used to terminate the program early
 import glm
 import pydicom  # used in reading dicom files
-import freetype  # used in text rendering
 
 # file dialog opening (seems to be included with Python)
 import tkinter as tk
 from tkinter import filedialog as fd
 
 # Standard Library Dependencies
-import time
+import os  # used to find how many cores are available for loading
+import atexit  # used to write the frame profile when the program closes
 
 # Internal File Dependencies
 import normalize
@@ -32,11 +32,29 @@ from Button import *
 import Read_Dicom  # used for reading and displaying dicom images
 from Read_Dicom import CTScan
 
+import Volume_Cache  # keeps loaded scans on disk so they open quickly the next time
+from Volume_Cache import VolumeCache
+
+import Dicom_Catalog  # index of the series in an archive
+from Dicom_Catalog import DicomCatalog
+
+import Texture_Manager  # creates, frees and keeps count of every texture
+
+import Poisson_Noise  # tables for the simulated low dose noise
+
+import Shader_Program  # shader programs with cached uniform locations and values
+from Shader_Program import ShaderProgram
+
+import Frame_Profiler  # times the phases of drawing a frame
+
+import Event_Log  # levels and categories for the messages the viewer prints
+from Event_Log import log
+
 import windowsWorkArea  # used for getting information about displaying to the screen
 from windowsWorkArea import *
 
 # START: global variables-----
-# mouse coordinates (mouse_x, mouse_y)
+# mouse coordinates (mouse_x, mouse_y) - where the mouse was when the input was last processed
 mouse_x = 0
 mouse_y = 0
 mouse_left_press = 0
@@ -50,6 +68,21 @@ slicenum = 0  # which slice the ct scan is on
 setting = 0  # 0 - do nothing, 1 - zoom, 2 - translate, 3 - use slider
 ff_flag = 0
 
+# how CT scans are decoded when loaded (see CTScan.load_workers and CTScan.load_pool)
+load_workers = os.cpu_count() or 1
+load_pool = "thread"  # "thread" or "process"
+# "eager", "stream" (show the middle slice while the rest loads in the background) or
+# "lazy" (decode slices as they are looked at - for series too large to keep in memory)
+load_mode = "stream"
+host_cache_budget = 1024 * 1024 * 1024  # bytes of decoded slices kept in memory (lazy mode)
+gpu_cache_budget = 512 * 1024 * 1024  # bytes of slice textures kept on the GPU (lazy mode)
+volume_cache = VolumeCache(max_bytes=8 * 1024 * 1024 * 1024)  # set to 0 to turn the on-disk cache off
+# bytes of textures to keep on the GPU - past this the least recently drawn slice textures are freed
+texture_budget = 2 * 1024 * 1024 * 1024
+catalog = 0  # DicomCatalog - opened the first time the catalog is used
+catalog_crawl = 0  # thread bringing the catalog up to date with an archive (the window keeps drawing meanwhile)
+catalog_crawled = 0  # set by that thread when it is done so the main loop shows the series to pick from
+
 # used for scene manipulation (need a better solution for this)
 zoom = 1
 mod = glm.vec2(0, 0)
@@ -59,8 +92,35 @@ trans = glm.vec2(0, 0)
 slider_t = 0
 slider_mod = 0
 
-# FOR TESTING
-start_time = time.time()
+# simulated low dose noise (the slider sets the dose) - N switches between the modes in Poisson_Noise
+noise_mode = Poisson_Noise.NOISE_OFF
+noise_table = 0  # inverse-CDF table texture (created in init)
+
+# times each phase of drawing a frame on the CPU and GPU. Timing is off unless profile_frames is 1 or the
+# times are shown on screen with P. The report is written to profile_report when the program closes (set
+# it to 0 to not write one)
+profile_frames = 0
+profiler = Frame_Profiler.FrameProfiler()
+profile_report = os.path.join(Volume_Cache.DEFAULT_CACHE_DIR, "frame_profile.json")
+
+# messages below this level are not printed (Event_Log.DEBUG shows every input event). When trace_size is
+# not 0 the last trace_size messages of any level are kept in memory and written to trace_file when the
+# program closes or T is pressed
+log_level = Event_Log.INFO
+trace_size = 0
+trace_file = os.path.join(Volume_Cache.DEFAULT_CACHE_DIR, "trace.txt")
+
+# input coalescing - the glfw callbacks only record the input and process_input applies it once per
+# frame, so several mouse moves in a frame are handled as one move to where the mouse ended up
+cursor_x = 0  # latest mouse position reported by glfw
+cursor_y = 0
+input_events = []  # (kind, cursor x, cursor y, arguments) of the button presses and keys not processed yet
+scroll_offset = 0  # scroll wheel movement not applied yet (a slice per whole step)
+
+# render on demand - a frame is only drawn when something changed (see request_redraw). Otherwise
+# the main loop sleeps until there is input or a background load wakes it up
+redraw = 1
+idle_timeout = 0.5  # longest the main loop sleeps for before checking for work again (seconds)
 
 # height and width of the glfw window - determined at run-time
 width = 0
@@ -107,7 +167,7 @@ void main()
 """
 
 fragment_dcm_src = """
-# version 330
+# version 420
 
 in vec3 v_color; //not useful in this shader
 in vec2 v_texture;
@@ -116,10 +176,23 @@ out vec4 out_color;
 uniform int sliceNumber;
 uniform float sliderVal;
 uniform sampler2D s_texture;
+uniform vec2 rescale;           // RescaleSlope, RescaleIntercept of the slice
+
+// multi-planar reconstruction (the coronal and sagittal views are sampled from the whole volume)
+uniform int mprView;            // 1 - axial, 2 - coronal, 3 - sagittal
+uniform int useVolume;          // 1 when volume_texture holds the scan
+uniform float slicePosition;    // (slice + 0.5) / number of slices in the current view
+layout(binding = 1) uniform sampler3D volume_texture;  // bound to texture unit 1
+
+// simulated low dose noise (see Poisson_Noise.py)
+uniform int noiseMode;          // 0 - off, 1 - Box-Muller (Gaussian approximation), 2 - inverse-CDF table
+uniform ivec2 viewSize;         // columns and rows of the image being shown
+uniform vec2 tableShape;        // table rows per unit of lambda, largest lambda with its own row
+layout(binding = 2) uniform sampler2D poisson_table;  // bound to texture unit 2
 
 
 // hash table
-uint S[256] = { 0x29, 0x2E, 0x43, 0xC9, 0xA2, 0xD8, 0x7C, 0x01, 0x3D, 0x36, 0x54, 0xA1, 0xEC, 0xF0, 0x06, 0x13, 
+const uint S[256] = { 0x29, 0x2E, 0x43, 0xC9, 0xA2, 0xD8, 0x7C, 0x01, 0x3D, 0x36, 0x54, 0xA1, 0xEC, 0xF0, 0x06, 0x13, 
   0x62, 0xA7, 0x05, 0xF3, 0xC0, 0xC7, 0x73, 0x8C, 0x98, 0x93, 0x2B, 0xD9, 0xBC, 0x4C, 0x82, 0xCA, 
   0x1E, 0x9B, 0x57, 0x3C, 0xFD, 0xD4, 0xE0, 0x16, 0x67, 0x42, 0x6F, 0x18, 0x8A, 0x17, 0xE5, 0x12, 
   0xBE, 0x4E, 0xC4, 0xD6, 0xDA, 0x9E, 0xDE, 0x49, 0xA0, 0xFB, 0xF5, 0x8E, 0xBB, 0x2F, 0xEE, 0x7A, 
@@ -154,6 +227,16 @@ float random (vec2 st) {
         43758.5453123);
 }
 
+// integer hash (lowbias32) used for picking a column of the poisson table
+uint hash(uint x){
+    x ^= x >> 16;
+    x *= 0x7feb352du;
+    x ^= x >> 15;
+    x *= 0x846ca68bu;
+    x ^= x >> 16;
+    return x;
+}
+
 int factorial(int val){
     int fact = 1;
     while(val > 1){
@@ -166,7 +249,28 @@ int factorial(int val){
 void main()
 {
     //swizzling to get a single color channel to be in type: Monochrome
-    float a = texture(s_texture, v_texture).r; // getting color at a given texture coordinate
+    float a;
+    if(useVolume == 1){
+        // the volume texture is (columns, rows, slices). The coronal and sagittal planes are turned
+        // so the head is at the top of the screen
+        vec3 coord;
+        if(mprView == 2){
+            coord = vec3(v_texture.x, 1 - slicePosition, 1 - v_texture.y);
+        }
+        else if(mprView == 3){
+            coord = vec3(slicePosition, v_texture.x, 1 - v_texture.y);
+        }
+        else{
+            coord = vec3(v_texture.x, v_texture.y, slicePosition);
+        }
+        a = texture(volume_texture, coord).r;
+    }
+    else{
+        a = texture(s_texture, v_texture).r; // getting color at a given texture coordinate
+    }
+    // the textures hold the stored 16 bit values as signed normalized numbers (value / 32767) so
+    // they are scaled back and converted to Hounsfield units
+    a = a * 32767.0 * rescale.x + rescale.y;
     
     //normalizing pixel values between 0 and 1
     if(a <= 6000/*normalization_values.x*/){
@@ -179,30 +283,55 @@ void main()
         a = 1;
     }
     
-    // Calculate randum number
-    uint ix = uint(v_texture.x * 512.0);
-    uint iy = uint(v_texture.y * 512.0);
-    uint iz = uint(sliceNumber);
-    uint pos = ix + (iy<<9) + (iz<<18);
-    
-    uint ia = pos & uint(0xff);
-    uint ib = (pos>>8)  & uint(0xff);
-    uint ic = (pos>>16) & uint(0xff);
-    uint id = (pos>>24) & uint(0xff);
-    
-    //uint ran1 = S[S[S[S[ia]^ib]^ic]^id];
-    uint ran =  S[S[S[S[S[0] ^ ia]^ib]^ic]^id];
-    uint ran1 = S[S[S[S[S[1] ^ ia]^ib]^ic]^id];
-    uint ran2 = S[S[S[S[S[2] ^ ia]^ib]^ic]^id];
-    uint ran3 = S[S[S[S[S[3] ^ ia]^ib]^ic]^id];
-    
-    float U1 = (ran + (ran1 << 8)) /  65536.0;
-    float U2 = (ran2 + (ran3 << 8)) / 65536.0;
-    
-    float lambda = a * (sliderVal);
-    // to sample a poisson distribution from a normal distribution, do Z0 * sqrt(LAMBDA) + LAMBDA
-    float Z0 = sqrt(-2 * log(U1)) * cos(2 * PI * U2);
-    Z0 = Z0 * sqrt(lambda) + lambda;
+    if(noiseMode == 1 && sliderVal > 0){
+        // Calculate randum number
+        uint ix = uint(v_texture.x * 512.0);
+        uint iy = uint(v_texture.y * 512.0);
+        uint iz = uint(sliceNumber);
+        uint pos = ix + (iy<<9) + (iz<<18);
+        
+        uint ia = pos & uint(0xff);
+        uint ib = (pos>>8)  & uint(0xff);
+        uint ic = (pos>>16) & uint(0xff);
+        uint id = (pos>>24) & uint(0xff);
+        
+        //uint ran1 = S[S[S[S[ia]^ib]^ic]^id];
+        uint ran =  S[S[S[S[S[0] ^ ia]^ib]^ic]^id];
+        uint ran1 = S[S[S[S[S[1] ^ ia]^ib]^ic]^id];
+        uint ran2 = S[S[S[S[S[2] ^ ia]^ib]^ic]^id];
+        uint ran3 = S[S[S[S[S[3] ^ ia]^ib]^ic]^id];
+        
+        float U1 = (ran + (ran1 << 8)) /  65536.0;
+        float U2 = (ran2 + (ran3 << 8)) / 65536.0;
+        
+        float lambda = a * (sliderVal);
+        // to sample a poisson distribution from a normal distribution, do Z0 * sqrt(LAMBDA) + LAMBDA
+        float Z0 = sqrt(-2 * log(U1)) * cos(2 * PI * U2);
+        Z0 = Z0 * sqrt(lambda) + lambda;
+        a = Z0 / sliderVal;
+    }
+    else if(noiseMode == 2 && sliderVal > 0){
+        // one random number per image pixel (rather than per screen pixel) picks the table column
+        ivec2 texel = clamp(ivec2(v_texture * vec2(viewSize)), ivec2(0), viewSize - 1);
+        uint h = hash(uint(texel.x) ^ hash(uint(texel.y) ^ hash(uint(sliceNumber))));
+        int column = int(h >> 21);  // top 11 bits - the table has 2048 columns
+        
+        float lambda = max(a * sliderVal, 0.0);
+        float count;
+        if(lambda <= tableShape.y){
+            // randomly picking one of the two nearest rows so the mean count is exactly lambda
+            float row = lambda * tableShape.x;
+            float pick = float(hash(h) >> 8) / 16777216.0;
+            int r = int(row) + int(fract(row) > pick);
+            count = texelFetch(poisson_table, ivec2(column, r), 0).r;
+        }
+        else{
+            // the last row holds the inverse CDF of the standard normal distribution
+            float z = texelFetch(poisson_table, ivec2(column, textureSize(poisson_table, 0).y - 1), 0).r;
+            count = max(floor(lambda + z * sqrt(lambda) + 0.5), 0.0);
+        }
+        a = count / sliderVal;
+    }
    
    
     // test for noise
@@ -221,7 +350,6 @@ void main()
     a = b.y;
     */
         
-    //a = Z0 / sliderVal; // uncomment me for noise
     // setting the color to display
     vec4 col_ = vec4(a, a, a, 1);
     out_color = col_;
@@ -371,32 +499,41 @@ void main()
 # END: global variables-----
 
 
+# marks the scene as changed so the main loop draws a new frame. Input callbacks call it, and so
+# should anything that animates (call it again every frame until the animation is over)
+def request_redraw():
+    global redraw
+    redraw = 1
+
+
 # START: Button functions --------------------------------------------------------------/
 # sets a flag to start the ability to zoom
 def zoom_in():
     global setting
-    print('zooming')
+    log.debug("ui", "zooming")
     setting = 1
 
 
 # sets a flag to start the ability to translate
 def translate():
-    print('translate')
+    log.debug("ui", "translate")
     global setting
     setting = 2
 
 
 def slide():
     global setting
-    print("i can slide now")
+    log.debug("ui", "sliding")
     setting = 3
 
 
 def set_mpr(view):
-    print("view: {}".format(view))
-    global ct_slice
+    log.debug("ui", "view: {}", view)
+    global ct_slice, slicenum
     if ct_slice:
         ct_slice.change_view(view)
+        # the new view can have fewer slices than the old one
+        slicenum = ct_slice.curr_slice
         #ct_slice.mpr_view = view
 
 
@@ -410,7 +547,7 @@ def set_mpr(view):
 #     print(ff_flag)
 
 def open_folder():
-    global ct_slice, height, width
+    global ct_slice, height, width, slicenum
     tk.Tk().withdraw()
     # checking whether the user opened a file/folder. If they did, then load a CT Scan and center it - Else do nothing
     # opened = 0
@@ -430,9 +567,26 @@ def open_folder():
 
     name_ = fd.askdirectory()
     if name_:
+        # reading the headers of the folder to find the series in it (no pixels are decoded yet) and
+        # letting the user pick one if there are several
+        groups = Read_Dicom.scan_folder_series(name_, load_workers, load_pool)
+        if len(groups) == 0:
+            log.warning("load", "no DICOM images found in {}", name_)
+            return
+        picked = 0
+        if len(groups) > 1:
+            picked = pick_from_list("Series in " + name_, [Read_Dicom.describe_series(group) for group in groups])
+            if picked < 0:
+                return
+
+        if ct_slice:
+            ct_slice.close()
         del ct_slice
-        ct_slice = CTScan(name_, shader, 0)
+        ct_slice = CTScan(name_, shader, 0, load_workers, load_pool, load_mode, host_cache_budget,
+                          gpu_cache_budget, volume_cache, groups[picked])
         ct_slice.set_alignment("center", height, width)
+        # streamed scans start on their middle slice
+        slicenum = ct_slice.curr_slice
 
         # checking to see if a file/folder was opened - if no folder/file was opened then delete the object
         # so the program does not attempt to draw it
@@ -441,16 +595,98 @@ def open_folder():
             ct_slice = 0
 
 
+# shows a list of choices in a dialog and returns the index of the one picked (-1 if none was picked)
+def pick_from_list(title, choices):
+    root = tk.Tk()
+    root.title(title)
+    listbox = tk.Listbox(root, width=120, height=min(25, max(5, len(choices))))
+    for choice in choices:
+        listbox.insert(tk.END, choice)
+    listbox.pack(fill=tk.BOTH, expand=True)
+
+    picked = []
+
+    def on_open(event=None):
+        selection = listbox.curselection()
+        if selection:
+            picked.append(selection[0])
+        root.destroy()
+
+    listbox.bind("<Double-Button-1>", on_open)
+    tk.Button(root, text="Open", command=on_open).pack()
+    root.mainloop()
+
+    if picked:
+        return picked[0]
+    return -1
+
+
+# opens a series from the catalog. Choosing an archive folder brings the catalog up to date with it first
+# on a background thread (only new or changed files are read) and the series are shown once it is done,
+# cancelling goes straight to the series already in the catalog
+def open_catalog():
+    global catalog, catalog_crawl
+    if not catalog:
+        catalog = DicomCatalog()
+
+    tk.Tk().withdraw()
+    name_ = fd.askdirectory(title="Archive to index (cancel to use the existing catalog)")
+    if name_:
+        if catalog_crawl and catalog_crawl.is_alive():
+            log.warning("cache", "the catalog is still being updated")
+            return
+        log.info("cache", "updating the catalog with {}", name_)
+        catalog_crawl = Dicom_Catalog.crawl_in_background(catalog.db_path, name_, load_workers, load_pool,
+                                                          on_catalog_crawled)
+        return
+    pick_catalog_series()
+
+
+# called on the crawl thread when it is done - the series picker has to be shown on the main thread
+def on_catalog_crawled(files_read, files_removed):
+    global catalog_crawled
+    catalog_crawled = 1
+    Read_Dicom.notify_background_load()
+
+
+# shows the series in the catalog and opens the one picked
+def pick_catalog_series():
+    global ct_slice, height, width, slicenum
+    series = catalog.list_series()
+    choices = ["{}  {}  {}  {}  {} ({} images)".format(s["patient_id"], s["study_date"], s["modality"],
+                                                      s["series_number"], s["series_description"],
+                                                      s["num_instances"]) for s in series]
+    picked = pick_from_list("Catalog", choices)
+    if picked < 0:
+        return
+
+    # the headers come from the catalog so nothing has to be searched or read before decoding
+    headers = catalog.series_headers(series[picked]["series_uid"])
+    if ct_slice:
+        ct_slice.close()
+    del ct_slice
+    ct_slice = CTScan(series[picked]["series_uid"], shader, 0, load_workers, load_pool, load_mode,
+                      host_cache_budget, gpu_cache_budget, volume_cache, headers)
+    ct_slice.set_alignment("center", height, width)
+    slicenum = ct_slice.curr_slice
+    if ct_slice.num_slices == 0:
+        del ct_slice
+        ct_slice = 0
+
+
 def open_file():
-    global ct_slice, height, width
+    global ct_slice, height, width, slicenum
     tk.Tk().withdraw()
     name_ = tk.filedialog.askopenfilename(initialdir="/", title="Select file",
                                           filetypes=(("Dicom Files", "*.dcm"), ("all files", "*.*")))
     # checking whether the user opened a file/folder. If they did, then load a CT Scan and center it - Else do nothing
     if name_:
+        if ct_slice:
+            ct_slice.close()
         del ct_slice
         ct_slice = CTScan(name_, shader, 1)
         ct_slice.set_alignment("center", height, width)
+        slicenum = 0
 
 
 # used to open a folder
@@ -467,6 +703,8 @@ def open_ff():
                                               filetypes=(("Dicom Files", "*.dcm"), ("all files", "*.*")))
     # checking whether the user opened a file/folder. If they did, then load a CT Scan and center it - Else do nothing
     if name_:
+        if ct_slice:
+            ct_slice.close()
         del ct_slice
         # ct_slice = 0
         ct_slice = CTScan(name_, shader, ff_flag)
@@ -492,8 +730,9 @@ def do_nothing():
 
 # resizes the opengl context allowing for the image on the window to change sizes as well
 def window_resize(window, width, height):
+    request_redraw()
     # prevents crashing when minimizing the window
-    print("width: {}, height: {}".format(width, height))
+    log.debug("view", "width: {}, height: {}", width, height)
     if width == 0 or height == 0:
         return 0
 
@@ -506,26 +745,80 @@ def window_resize(window, width, height):
 
     # passing parameters to the text object and text_shader to ensure that the size remains correct with window resizing
     global rnd
-    glUseProgram(text_shader)
-    proj_loc = glGetUniformLocation(text_shader, "projection")
-    projection = glm.ortho(0, width, 0, height)
-    glUniformMatrix4fv(proj_loc, 1, GL_FALSE, glm.value_ptr(projection))
+    text_shader.set_mat4("projection", glm.ortho(0, width, 0, height))
     rnd.set_hw(height, width)
 
-    print("width: {}, height: {}".format(width, height))  # remove me at some point
-
     # re-centering the ct-slice on the screen
     global ct_slice
     if ct_slice:
         ct_slice.set_alignment('center', height, width)
 
 
-# setting the function for glfw to call when the mouses cursor position changes
+# setting the function for glfw to call when the mouses cursor position changes (the move is
+# applied by process_input)
 def cursor_position_callback(window, xpos, ypos):
+    global cursor_x, cursor_y
+    log.debug("input", "({}, {})", xpos, ypos)
+    cursor_x = xpos
+    cursor_y = ypos
+    # the hover highlights and the information banner follow the mouse
+    request_redraw()
+
+
+# setting the function to receive mouse button presses
+def mouse_button_callback(window, button, action, mods):
+    input_events.append(("button", cursor_x, cursor_y, (button, action, mods)))
+    request_redraw()
+
+
+def key_callback(window, key, scancode, action, mods):
+    input_events.append(("key", cursor_x, cursor_y, (key, scancode, action, mods)))
+    request_redraw()
+
+
+# callback for the scrollwheel - the wheel steps add up until the input is processed
+def scroll_callback(window, xoffset, yoffset):
+    global scroll_offset
+    scroll_offset = scroll_offset + yoffset
+    request_redraw()
+
+
+# the window has to be drawn again (ie. it was uncovered)
+def window_refresh_callback(window):
+    request_redraw()
+
+
+# ------------------------------------------------------------
+# function: process_input
+# purpose: applies the input recorded by the callbacks since the last
+#          frame. Button presses and keys are handled in the order they
+#          came in, each after moving the mouse to where it was at the
+#          time, then the mouse is moved to its latest position once and
+#          the scroll wheel steps are applied in one jump. Called once
+#          per frame by the main loop
+# ------------------------------------------------------------
+def process_input():
+    global input_events
+    events = input_events
+    input_events = []
+    for kind, x, y, args in events:
+        if x != mouse_x or y != mouse_y:
+            apply_cursor(x, y)
+        if kind == "button":
+            apply_mouse_button(*args)
+        else:
+            apply_key(*args)
+
+    if cursor_x != mouse_x or cursor_y != mouse_y:
+        apply_cursor(cursor_x, cursor_y)
+    apply_scroll()
+
+
+# moves the mouse - hovering, and zooming, panning or sliding when the mouse is held down
+def apply_cursor(xpos, ypos):
     global mouse_x, mouse_y, setting, ct_slice, mouse_left_press
     global start_mouse_x, start_mouse_y, height, width, act
     global buttoni
-    print("({}, {})".format(xpos, ypos))
 
     # setting global mouse coordinates
     mouse_x = xpos
@@ -539,16 +832,14 @@ def cursor_position_callback(window, xpos, ypos):
         # zoom setting - zooming on the scene with the mouse (vertical only)
         global zoom
         if setting == 1 and ct_slice:
-            print('zoom: {}'.format(zoom))
             # zooming in based on how far the mouse has moved from the original clicked area
             modifier = (mouse_y - start_mouse_y) * (2 / height)
             if zoom + modifier >= 1:
                 ct_slice.zoom = zoom + modifier  # abs(mouse_y - start_mouse_y)
-            print("zoom: {}".format(ct_slice.zoom))
+            log.debug("view", "zoom: {}", ct_slice.zoom)
         # panning/translation setting - translating scene with the mouse
         elif setting == 2 and ct_slice:
             global mod, trans
-            print("x: {}, y: {}".format(ct_slice.translation.x, ct_slice.translation.y))
 
             # moving image based on how far the mouse has moved from the original clicked area
             # 2 / (width or height) / zoom is pixel normalization to ensure translation occurs properly
@@ -556,6 +847,7 @@ def cursor_position_callback(window, xpos, ypos):
             mod.y = (mouse_y - start_mouse_y) * (2 / height) / zoom
             ct_slice.translation.x = -mod.x + trans.x
             ct_slice.translation.y = mod.y + trans.y
+            log.debug("view", "x: {}, y: {}", ct_slice.translation.x, ct_slice.translation.y)
 
         # slider setting
         elif setting == 3:
@@ -582,8 +874,8 @@ def cursor_position_callback(window, xpos, ypos):
                 buttoni.buttons[btn_num].currx2 = buttoni.buttons[btn_num].x2 + (slider_t + slider_mod) * width / 2
 
 
-# setting the function to receive mouse button presses
-def mouse_button_callback(window, button, action, mods):
+# handles a mouse button press or release
+def apply_mouse_button(button, action, mods):
     global mouse_x, mouse_y, mouse_left_press, buttoni, act, setting, start_mouse_x, start_mouse_y
     if action == glfw.PRESS:
         if button == glfw.MOUSE_BUTTON_LEFT:
@@ -602,18 +894,18 @@ def mouse_button_callback(window, button, action, mods):
                 mouse_left_press = 1
                 start_mouse_x = mouse_x
                 start_mouse_y = mouse_y
-                print("left button")
+                log.debug("input", "left button")
                 # print("cursor location: ({}, {})".format(mouse_x, mouse_y))
 
         elif button == glfw.MOUSE_BUTTON_RIGHT:
-            print("right button")
+            log.debug("input", "right button")
         elif button == glfw.MOUSE_BUTTON_MIDDLE:
-            print("middle button")
+            log.debug("input", "middle button")
 
     elif action == glfw.RELEASE:
         mouse_left_press = 0
         buttoni.check_unclick(mouse_x, mouse_y)
-        print("Released")
+        log.debug("input", "released")
         if act:
             # this is really tacky and should hopefully have a better solution
             global ct_slice, zoom, trans, mod
@@ -632,10 +924,11 @@ def mouse_button_callback(window, button, action, mods):
                 slider_mod = 0
         act = 0
     else:
-        print(mouse_x, mouse_y)
+        log.debug("input", "{} {}", mouse_x, mouse_y)
 
 
-def key_callback(window, key, scancode, action, mods):
+# handles a key press, repeat or release
+def apply_key(key, scancode, action, mods):
     # reset scene to how it was at the beginning
     if key == glfw.KEY_R:
         global ct_slice, zoom, mod, trans
@@ -646,31 +939,61 @@ def key_callback(window, key, scancode, action, mods):
             mod = glm.vec2(0, 0)
             trans = glm.vec2(0, 0)
 
+    # switch between no noise, the Box-Muller noise and the inverse-CDF table noise
+    if key == glfw.KEY_N and action == glfw.PRESS:
+        global noise_mode
+        noise_mode = (noise_mode + 1) % len(Poisson_Noise.NOISE_MODE_NAMES)
+        log.info("view", "noise: {}", Poisson_Noise.NOISE_MODE_NAMES[noise_mode])
+
+    # print how much GPU memory the textures are using
+    if key == glfw.KEY_M and action == glfw.PRESS:
+        Texture_Manager.textures.print_report()
+
+    # print how many shader state changes the last frame made
+    if key == glfw.KEY_S and action == glfw.PRESS:
+        Shader_Program.state.print_report()
+
+    # show or hide the frame times (frames are timed while they are shown)
+    if key == glfw.KEY_P and action == glfw.PRESS:
+        profiler.toggle_overlay()
+        profiler.enabled = profile_frames or profiler.show_overlay
+
+    # write the trace of the last messages (when tracing)
+    if key == glfw.KEY_T and action == glfw.PRESS:
+        log.dump_trace(trace_file)
+
     # close the program
     if key == glfw.KEY_ESCAPE:
         glfw.terminate()
         sys.exit("Program Exited on Escape")
 
 
-# callback for the scrollwheel
-def scroll_callback(window, xoffset, yoffset):
-    global slicenum, ct_slice
+# moves through the slices by the whole scroll wheel steps that have added up (the rest is kept for
+# the next frame, so touchpads that scroll in fractions of a step still get there)
+def apply_scroll():
+    global slicenum, ct_slice, scroll_offset
+    steps = int(scroll_offset)
+    if not ct_slice:
+        scroll_offset = 0
+        return
+    if steps == 0:
+        return
+    scroll_offset = scroll_offset - steps
 
     # scrolling between slice 1 and slice N --> N = ct_slice.num_slices - 1
-    if ct_slice:
-        # if scrolling down and slice num is greater than 0 don't go to previous slice
-        if yoffset < 0 and slicenum > 0:
-            slicenum = slicenum - 1
-        # if scrolling up and slicenum is less than the maximum slice, proceed to the next slice
-        elif yoffset > 0 and slicenum < ct_slice.num_slices - 1:
-            slicenum = slicenum + 1
-        # if attempting to go to previous slice on slice 0 go to last slice
-        # and if attempting to go to next slice on max slice go to first slice
-        else:
-            slicenum = abs(slicenum + 1 - ct_slice.num_slices)
+    # scrolling up goes to the next slice and scrolling down to the previous one. Going past
+    # either end wraps around to the other end and slices that are still loading are skipped
+    if steps > 0:
+        direction = 1
+    else:
+        direction = -1
+    for i in range(min(abs(steps), ct_slice.num_slices)):
+        slicenum = ct_slice.step_slice(slicenum, direction)
 
-        ct_slice.curr_slice = slicenum
-        print(slicenum)
+    # only the slice scrolled to is shown (and the direction lets lazily loaded scans prefetch the
+    # slices that are coming up)
+    ct_slice.set_slice(slicenum, direction)
+    log.debug("view", "slice: {}", slicenum)
 
 
 # END--------------------------------------------------------------------------------------*
@@ -681,21 +1004,23 @@ def init():
     # setting blend function for text rendering
     glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
 
+    Texture_Manager.textures.budget = texture_budget
+
     # Compiling shader's to allow manipulation of the graphical pipeline --------------
     global shader, generalshader, text_shader, slider_shader, VBO, EBO
-    shader = compileProgram(compileShader(vertex_dcm_src, GL_VERTEX_SHADER),
-                            compileShader(fragment_dcm_src, GL_FRAGMENT_SHADER))
+    shader = ShaderProgram(vertex_dcm_src, fragment_dcm_src, "dicom")
     # plots generic things like rectangles
-    generalshader = compileProgram(compileShader(vertex_src, GL_VERTEX_SHADER),
-                                   compileShader(fragment_src, GL_FRAGMENT_SHADER))
+    generalshader = ShaderProgram(vertex_src, fragment_src, "general")
     # allows for generation of text on screen
-    text_shader = compileProgram(compileShader(text_vs, GL_VERTEX_SHADER),
-                                 compileShader(text_fs, GL_FRAGMENT_SHADER))
+    text_shader = ShaderProgram(text_vs, text_fs, "text")
 
-    slider_shader = compileProgram(compileShader(slider_vertex_src, GL_VERTEX_SHADER),
-                                   compileShader(slider_fragment_src, GL_FRAGMENT_SHADER))
+    slider_shader = ShaderProgram(slider_vertex_src, slider_fragment_src, "slider")
     # ----------------------------------------------------------------------------------
 
+    # table the shader samples the Poisson noise from
+    global noise_table
+    noise_table = Poisson_Noise.create_poisson_texture()
+
     # vertex + element buffer object + texture object ----------------------------------
     VBO = glGenBuffers(1)
     EBO = glGenBuffers(1)
@@ -732,6 +1057,10 @@ def init():
     button1.set_text("Load File", "center")
     button1.set_function(open_file)
     button.add_pull_down_button(button1)
+    button1 = TextButton(0, 75, 25, 100, height, width, rnd, generalshader, shader)
+    button1.set_text("Catalog", "center")
+    button1.set_function(open_catalog)
+    button.add_pull_down_button(button1)
 
     # load button for file opening
     # button = TextButton(0, 0, 25, 50, height, width, rnd, generalshader, shader)
@@ -773,7 +1102,7 @@ def init():
     slidebar.set_function(slide)
 
     # making a Panel and attaching buttons
-    buttoni = Panel(0, 0, height, width)
+    buttoni = Panel(0, 0, height, width, generalshader)
     buttoni.add_button(button)
     buttoni.add_button(button_zoom)
     buttoni.add_button(button_translate)
@@ -787,18 +1116,11 @@ def init():
     infobanner = InfoBanner(0, 850, 100, 100, height, width, txt, rnd, text_shader)
 
     # used to map window size to pixels (1:1)
-    glUseProgram(text_shader)
-    proj_loc = glGetUniformLocation(text_shader, "projection")
-    projection = glm.ortho(0, width, 0, height)
-    glUniformMatrix4fv(proj_loc, 1, GL_FALSE, glm.value_ptr(projection))
+    text_shader.set_mat4("projection", glm.ortho(0, width, 0, height))
 
 
 # draw function: used to draw to the screen every frame
 def draw():
-    #global start_time
-    #new_time = time.time()
-    #print("Time Elapsed: {}".format(new_time - start_time))
-
     # Setting Background Color to Black (Medical Standard) for Drawing
     glClearColor(0, 0, 0, 1)
 
@@ -806,12 +1128,19 @@ def draw():
     global ct_slice, VBO, EBO
     global buttoni
     if ct_slice:
+        # uploading any slices that finished loading in the background
+        with profiler.phase("CTScan.update"):
+            ct_slice.update()
         ct_slice.exposure = buttoni.buttons[4].slider_value
-        ct_slice.draw(VBO, EBO)
+        ct_slice.noise_mode = noise_mode
+        ct_slice.noise_table = noise_table
+        with profiler.phase("CTScan.draw"):
+            ct_slice.draw(VBO, EBO)
 
     # LOADING PANEL OF BUTTONS --
     global height, width
-    buttoni.draw(VBO, EBO)
+    with profiler.phase("Panel.draw"):
+        buttoni.draw(VBO, EBO)
 
     # DEPRECATED CODE - KEPT AS REFERENCE **************************
     # ATTEMPTING TO DRAW TEXT OVER A BUTTON
@@ -828,13 +1157,15 @@ def draw():
 
         # checking whether the mouse location is within the area of the ct-slice area and then converting
         # the pixel found at that location to Hounsfield units
-        if ct_slice.mpr_view == 1 and ct_slice.x1 <= mouse_x < ct_slice.x2 and ct_slice.y1 <= mouse_y <= ct_slice.y2:
+        if ct_slice.mpr_view == 1 and ct_slice.is_slice_loaded(slicenum) and ct_slice.x1 <= mouse_x < ct_slice.x2 and ct_slice.y1 <= mouse_y <= ct_slice.y2:
             # getting pixel data at point row: mouse_y - ct_slice.y1, column: mouse_x - ct_slice.x1
-            info = ct_slice.ct_slices[slicenum].pixelarray[int(mouse_y - ct_slice.y1)][
-                int(mouse_x - ct_slice.x1)]
+            info = ct_slice.get_pixels(slicenum)[int(mouse_y - ct_slice.y1)][int(mouse_x - ct_slice.x1)]
 
             # converting grabbed pixel to Hounsfield units: formula = slope * pixel + rescale_intercept
-            info = info * ct_slice.ct_slices[slicenum].RescaleSlope + ct_slice.ct_slices[slicenum].RescaleIntercept
+            # (headers without a rescale are stored values already, like in CTScan.draw)
+            slope = ct_slice.ct_slices[slicenum].RescaleSlope
+            intercept = ct_slice.ct_slices[slicenum].RescaleIntercept
+            info = info * (slope if slope is not None else 1) + (intercept if intercept is not None else 0)
 
             # setting mouse info to print
             mx = int(mouse_x - ct_slice.x1)
@@ -845,15 +1176,29 @@ def draw():
             mx = 'x'
             my = 'x'
 
+        # current slice number being displayed (and how far along a streaming load is)
+        slice_info = str(slicenum + 1) + '/' + str(ct_slice.num_slices)
+        if ct_slice.is_loading():
+            slice_info = slice_info + ' (loading ' + str(ct_slice.num_loaded) + '/' + str(ct_slice.num_slices) + ')'
+
+        # the date and patient ID can be missing from the header
+        study_date = ct_slice.ct_slices[0].study_date or ''
+        patient_id = ct_slice.ct_slices[0].patient_id
+        if patient_id is None:
+            patient_id = ''
+
         # Displaying Information: (X,Y, SLICE NUMBER, DATE TAKEN, HOUNSFIELD UNITS, PATIENT ID)
         params = [str(mx) + ", Y:" + str(my),  # x and y mouse coordinates
-                  str(slicenum + 1) + '/' + str(ct_slice.num_slices),  # current slice number being displayed
-                  str(ct_slice.ct_slices[0].study_date[4:6] + '/' + ct_slice.ct_slices[0].study_date[6:8]
-                      + '/' + ct_slice.ct_slices[0].study_date[0:4]),
+                  slice_info,
+                  str(study_date[4:6] + '/' + study_date[6:8] + '/' + study_date[0:4]),
                   str(info),  # HOUNSFIELD UNITS
-                  str(ct_slice.ct_slices[0].patient_id)]  # patient id
+                  str(patient_id)]  # patient id
         infobanner.update_info(params)
-        infobanner.draw(VBO, EBO)
+        with profiler.phase("InfoBanner.draw"):
+            infobanner.draw(VBO, EBO)
+
+    # frame times (when turned on with P) in the top right corner
+    profiler.draw_overlay(rnd, width - 360, 35, VBO, EBO)
 
     # global ch_view
     # if ct_slice and not ch_view:
@@ -863,60 +1208,100 @@ def draw():
     #     ct_slice.draw_new_view(VBO, EBO)
 
 
-# initializing glfw library
-if not glfw.init():
-    raise Exception("glfw can not be initialized!")
+# the program is only started when run directly so that the loading worker processes
+# can import this file without opening a window
+if __name__ == "__main__":
+    log.set_level(log_level)
+    profiler.enabled = profile_frames
+    if trace_size:
+        log.start_trace(trace_size)
+        atexit.register(log.dump_trace, trace_file)
 
-workArea = getWorkArea()
-print("right: {}, bottom: {}".format(workArea.right, workArea.bottom))
-# creating the window
-# doing roundabout thing to get title bar size because Windows 10 is stupid and decorations
-# are not accounted for
+    # initializing glfw library
+    if not glfw.init():
+        raise Exception("glfw can not be initialized!")
 
-# setting a garbage window size as the window is required to get the title bar size
-window = glfw.create_window(workArea.right, workArea.bottom, "Dicom Viewer", None, None)
-# getting title bar size
-frameSize = glfw.get_window_frame_size(window)  # frameSize[1] is the height of the title bar
+    workArea = getWorkArea()
+    log.debug("ui", "right: {}, bottom: {}", workArea.right, workArea.bottom)
+    # creating the window
+    # doing roundabout thing to get title bar size because Windows 10 is stupid and decorations
+    # are not accounted for
 
-# getting actual height and width of the window
+    # setting a garbage window size as the window is required to get the title bar size
+    window = glfw.create_window(workArea.right, workArea.bottom, "Dicom Viewer", None, None)
+    # getting title bar size
+    frameSize = glfw.get_window_frame_size(window)  # frameSize[1] is the height of the title bar
 
-height = workArea.bottom - frameSize[1]
-width = workArea.right
+    # getting actual height and width of the window
 
-# setting correct window size
-glfw.set_window_size(window, width, height)  # causes issues if the original set size isn't set
+    height = workArea.bottom - frameSize[1]
+    width = workArea.right
 
-glfw.window_hint(glfw.SCALE_TO_MONITOR, glfw.TRUE)
+    # setting correct window size
+    glfw.set_window_size(window, width, height)  # causes issues if the original set size isn't set
 
-# check if window was created
-if not window:
+    glfw.window_hint(glfw.SCALE_TO_MONITOR, glfw.TRUE)
+
+    # check if window was created
+    if not window:
+        glfw.terminate()
+        raise Exception("glfw window can not be created!")
+
+    # set window's position (should probably be dynamic)
+    glfw.set_window_pos(window, 0, frameSize[1])
+
+    # setting callback functions to get mouse button, cursor, and keyboard information in real time
+    glfw.set_window_size_callback(window, window_resize)  # set the callback function for window resize
+    glfw.set_cursor_pos_callback(window, cursor_position_callback)  # setting cursor callback to get mouse information
+    glfw.set_mouse_button_callback(window, mouse_button_callback)
+    glfw.set_key_callback(window, key_callback)
+    glfw.set_scroll_callback(window, scroll_callback)
+    glfw.set_window_refresh_callback(window, window_refresh_callback)
+    # slices that finish loading in the background wake the main loop up to be drawn
+    Read_Dicom.on_background_load = glfw.post_empty_event
+    # the frame profile is written however the program closes (escape calls sys.exit)
+    if profile_report:
+        atexit.register(profiler.dump, profile_report)
+    # make the context current
+    glfw.make_context_current(window)
+
+    # initialize variables for the start of the program
+    init()
+    # fixing gl size after doing roundabout things to set the right window size
+    glViewport(0, 0, width, height)
+
+    # the main application loop - sleeps until there is input or a slice has loaded in the background
+    # and only draws when something changed
+    while not glfw.window_should_close(window):
+        # slices still waiting to be uploaded (ie. ones that did not fit in the last frame's upload
+        # budget after the workers finished) need a frame now, not after the next wake up
+        if ct_slice and ct_slice.has_updates():
+            redraw = 1
+        if redraw:
+            glfw.poll_events()
+        else:
+            glfw.wait_events_timeout(idle_timeout)
+        process_input()
+
+        # a catalog update finished in the background
+        if catalog_crawled:
+            catalog_crawled = 0
+            pick_catalog_series()
+            redraw = 1
+
+        if ct_slice and ct_slice.has_updates():
+            redraw = 1
+        if not redraw:
+            continue
+        redraw = 0
+
+        with profiler.phase("frame", gpu=0):
+            glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+            draw()
+        with profiler.phase("swap_buffers", gpu=0):
+            glfw.swap_buffers(window)
+        Shader_Program.state.end_frame()
+        profiler.end_frame()
+
+    # terminate glfw, free up allocated resources
     glfw.terminate()
-    raise Exception("glfw window can not be created!")
-
-# set window's position (should probably be dynamic)
-glfw.set_window_pos(window, 0, frameSize[1])
-
-# setting callback functions to get mouse button, cursor, and keyboard information in real time
-glfw.set_window_size_callback(window, window_resize)  # set the callback function for window resize
-glfw.set_cursor_pos_callback(window, cursor_position_callback)  # setting cursor callback to get mouse information
-glfw.set_mouse_button_callback(window, mouse_button_callback)
-glfw.set_key_callback(window, key_callback)
-glfw.set_scroll_callback(window, scroll_callback)
-# make the context current
-glfw.make_context_current(window)
-
-# initialize variables for the start of the program
-init()
-# fixing gl size after doing roundabout things to set the right window size
-glViewport(0, 0, width, height)
-
-# the main application loop
-while not glfw.window_should_close(window):
-    glfw.poll_events()
-
-    glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-    draw()
-    glfw.swap_buffers(window)
-
-# terminate glfw, free up allocated resources
-glfw.terminate()
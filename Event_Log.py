@@ -0,0 +1,153 @@
+# --------------------
+# File: Event_Log.py
+# Purpose: Logging for the viewer. Messages have a level (debug, info, warning, error) and a
+#          category (the part of the viewer they come from) and are only printed when their
+#          level is at or above the one set for their category. A message that is not wanted
+#          costs a dictionary lookup - it is never formatted - so debug messages can be left in
+#          the input callbacks. The log can also keep the last events in memory (a trace) without
+#          printing them, to be written out after something went wrong.
+# Author: Jacob Knop
+# Date: Summer 2020
+# --------------------
+
+# external dependencies
+import os
+import time
+from collections import deque
+
+# levels
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+OFF = 50
+
+LEVEL_NAMES = {DEBUG: "debug", INFO: "info", WARNING: "warning", ERROR: "error"}
+
+# categories the viewer logs under
+# input - mouse, keyboard and scroll events       ui - buttons and menus
+# view - zoom, pan, slices and window size         load - reading and decoding scans
+# cache - the volume, font and catalog caches      profile - the frame profiler
+CATEGORIES = ["input", "ui", "view", "load", "cache", "profile"]
+
+
+# -----------------------------------------------------------------------
+# Class: EventLog
+# Purpose: Decides which messages are printed or traced and prints them as
+#          "[category] message". Messages are format strings with their
+#          arguments passed separately, ie.
+#              log.debug("input", "({}, {})", xpos, ypos)
+#          so they are only formatted when they are printed or the trace is
+#          written (arguments should be values that do not change later).
+#          The trace is a deque so threads can add to it without a lock
+# Elements:
+#    level - level printed for categories that have not been given one
+#    levels - category -> level printed
+#    trace - deque of the last (time, level, category, message, args) events
+#            or 0 when not tracing
+#    trace_level - lowest level traced
+#    threshold, thresholds - lowest level anything is done with (printing or
+#                            tracing), for every category and by category
+# -----------------------------------------------------------------------
+class EventLog:
+    level = INFO
+    trace = 0
+    trace_level = DEBUG
+    threshold = INFO
+
+    def __init__(self, level=INFO):
+        self.level = level
+        self.levels = {}
+        self.trace = 0
+        self.thresholds = {}
+        self.start = time.perf_counter()
+        self.update_thresholds()
+
+    def update_thresholds(self):
+        traced = self.trace_level if self.trace != 0 else OFF
+        self.threshold = min(self.level, traced)
+        self.thresholds = {category: min(level, traced) for category, level in self.levels.items()}
+
+    # sets the level printed for a category (or for every category when none is given)
+    def set_level(self, level, category=None):
+        if category is None:
+            self.level = level
+            self.levels = {}
+        else:
+            self.levels[category] = level
+        self.update_thresholds()
+
+    # starts keeping the last size events at or above level in memory
+    def start_trace(self, size=10000, level=DEBUG):
+        self.trace = deque(maxlen=size)
+        self.trace_level = level
+        self.update_thresholds()
+
+    def stop_trace(self):
+        self.trace = 0
+        self.update_thresholds()
+
+    # ------------------------------------------------------------------
+    # Function: log
+    # Purpose: traces and/or prints a message if its category wants it
+    #          (debug, info, warning and error below call this)
+    # ------------------------------------------------------------------
+    def log(self, level, category, message, *args):
+        if level < self.thresholds.get(category, self.threshold):
+            return
+        trace = self.trace
+        if trace != 0 and level >= self.trace_level:
+            trace.append((time.perf_counter(), level, category, message, args))
+        if level >= self.levels.get(category, self.level):
+            print(self.format(level, category, message, args))
+
+    def debug(self, category, message, *args):
+        if DEBUG >= self.thresholds.get(category, self.threshold):
+            self.log(DEBUG, category, message, *args)
+
+    def info(self, category, message, *args):
+        self.log(INFO, category, message, *args)
+
+    def warning(self, category, message, *args):
+        self.log(WARNING, category, message, *args)
+
+    def error(self, category, message, *args):
+        self.log(ERROR, category, message, *args)
+
+    # returns the line printed for a message
+    def format(self, level, category, message, args):
+        if args:
+            message = message.format(*args)
+        if level >= WARNING:
+            return "[{}] {}: {}".format(category, LEVEL_NAMES[level], message)
+        return "[{}] {}".format(category, message)
+
+    # ------------------------------------------------------------------
+    # Function: dump_trace
+    # Purpose: writes the traced events (oldest first, with the seconds
+    #          since the log was made) to a file, or prints them if no path
+    #          is given. Nothing is done when not tracing
+    # ------------------------------------------------------------------
+    def dump_trace(self, path=None):
+        if self.trace == 0:
+            return
+        events = self.trace.copy()
+        lines = ["{:12.6f} {}".format(t - self.start, self.format(level, category, message, args))
+                 for t, level, category, message, args in events]
+        if path is None:
+            for line in lines:
+                print(line)
+            return
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(path, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            print("trace of {} events written to {}".format(len(lines), path))
+        except OSError as e:
+            print("could not write trace: {}".format(e))
+
+
+# the log everything in the viewer uses
+log = EventLog()
@@ -0,0 +1,160 @@
+# --------------------
+# File: Font_Cache.py
+# Purpose: Rasterizes the first 128 characters of a font into one atlas image (with the size,
+#          bearing and advance of each character) and keeps it on disk, so the viewer only
+#          needs freetype the first time a font is used at a given size. Later startups load
+#          the atlas and upload it as a single texture.
+# Author: Jacob Knop
+# Date: Summer 2020
+# --------------------
+
+# external dependencies
+import os
+import json
+import hashlib
+import numpy as np
+
+# internal dependencies
+from Volume_Cache import DEFAULT_CACHE_DIR
+from Event_Log import log
+
+# the font that ships with the viewer (used when no other font is given)
+DEFAULT_FONT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "arial.ttf")
+
+# width of the glyph atlas in pixels (its height is whatever the glyphs need)
+ATLAS_WIDTH = 256
+
+# number of characters rasterized (ASCII)
+CHARACTERS = 128
+
+# bumped whenever the way atlases are made changes so old cache entries are not used
+ATLAS_VERSION = 1
+
+
+# ------------------------------------------------------------
+# function: pack_glyphs
+# purpose: places bitmaps in rows (shelves) of an atlas with a pixel of
+#          empty space around each one so that linear filtering never
+#          picks up a neighbour. Returns the atlas (uint8, rows x width)
+#          and the (x, y) of the top left of each bitmap in it
+# parameters: bitmaps, width
+# 1. bitmaps - list of 2D uint8 arrays (rows x columns)
+# 2. width   - width of the atlas
+# ------------------------------------------------------------
+def pack_glyphs(bitmaps, width=ATLAS_WIDTH):
+    positions = []
+    x = 1
+    y = 1
+    shelf_height = 0
+    for bitmap in bitmaps:
+        rows, cols = bitmap.shape
+        if x + cols + 1 > width:
+            x = 1
+            y = y + shelf_height + 1
+            shelf_height = 0
+        positions.append((x, y))
+        x = x + cols + 1
+        shelf_height = max(shelf_height, rows)
+
+    atlas = np.zeros((y + shelf_height + 1, width), dtype=np.uint8)
+    for bitmap, (x, y) in zip(bitmaps, positions):
+        atlas[y:y + bitmap.shape[0], x:x + bitmap.shape[1]] = bitmap
+    return atlas, positions
+
+
+# ------------------------------------------------------------
+# function: rasterize_font
+# purpose: renders the first 128 characters of a font with freetype and
+#          packs them into an atlas. Returns (atlas, metrics) where metrics
+#          has a row per character - atlas x, atlas y, width, rows,
+#          bearing x, bearing y, advance (in 1/64 pixels)
+# parameters: font_path, pixel_size
+# 1. font_path  - path to the font file
+# 2. pixel_size - height of the font in pixels
+# ------------------------------------------------------------
+def rasterize_font(font_path, pixel_size):
+    # only needed when the atlas is not cached
+    import freetype
+
+    face = freetype.Face(font_path, 0)
+    face.set_pixel_sizes(0, pixel_size)
+
+    bitmaps = []
+    metrics = []
+    for i in range(0, CHARACTERS):
+        face.load_char(chr(i), freetype.FT_LOAD_RENDER)
+        bitmap = face.glyph.bitmap
+        # rows of the bitmap can be padded out to pitch bytes
+        pixels = np.array(bitmap.buffer, dtype=np.uint8).reshape(bitmap.rows, bitmap.pitch)
+        bitmaps.append(pixels[:, :bitmap.width])
+        metrics.append([bitmap.width, bitmap.rows, face.glyph.bitmap_left, face.glyph.bitmap_top,
+                        face.glyph.advance.x])
+
+    atlas, positions = pack_glyphs(bitmaps)
+    metrics = [[x, y] + m for (x, y), m in zip(positions, metrics)]
+    return atlas, np.array(metrics, dtype=np.int32)
+
+
+# ------------------------------------------------------------
+# function: font_key
+# purpose: builds the cache key of a font at a pixel size from the font
+#          file's path, size and modification time, so a changed font file
+#          is rasterized again
+# parameters: font_path, pixel_size
+# ------------------------------------------------------------
+def font_key(font_path, pixel_size):
+    st = os.stat(font_path)
+    sha = hashlib.sha1()
+    sha.update("{}|{}|{}|{}|{}|{}".format(os.path.abspath(font_path), st.st_size, st.st_mtime_ns, pixel_size,
+                                          CHARACTERS, ATLAS_VERSION).encode("utf-8"))
+    return sha.hexdigest()
+
+
+# ------------------------------------------------------------
+# function: load_font_atlas
+# purpose: returns (atlas, metrics) (see rasterize_font) for a font at a
+#          pixel size, from <cache_dir>/<key>.npy and <key>.json when they
+#          exist and otherwise by rasterizing it and writing those files.
+#          Like the volume cache the .json file is written last so an
+#          entry only exists once it is complete. Problems with the cache
+#          are logged and the font is used without it
+# parameters: font_path, pixel_size, cache_dir
+# 1. font_path  - path to the font file (the bundled Arial by default)
+# 2. pixel_size - height of the font in pixels
+# 3. cache_dir  - where atlases are kept (DEFAULT_CACHE_DIR/fonts by default)
+# ------------------------------------------------------------
+def load_font_atlas(font_path=DEFAULT_FONT, pixel_size=18, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = os.path.join(DEFAULT_CACHE_DIR, "fonts")
+    key = font_key(font_path, pixel_size)
+    atlas_path = os.path.join(cache_dir, key + ".npy")
+    info_path = os.path.join(cache_dir, key + ".json")
+
+    try:
+        with open(info_path) as f:
+            metrics = np.array(json.load(f)["metrics"], dtype=np.int32)
+        atlas = np.load(atlas_path)
+        if metrics.shape == (CHARACTERS, 7) and atlas.dtype == np.uint8 and atlas.ndim == 2:
+            return atlas, metrics
+    except (OSError, ValueError, KeyError):
+        pass
+
+    atlas, metrics = rasterize_font(font_path, pixel_size)
+
+    tmp_atlas = atlas_path + ".tmp"
+    tmp_info = info_path + ".tmp"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(tmp_atlas, "wb") as f:
+            np.save(f, atlas)
+        with open(tmp_info, "w") as f:
+            json.dump({"font": os.path.abspath(font_path), "pixel_size": pixel_size,
+                       "metrics": metrics.tolist()}, f)
+        os.replace(tmp_atlas, atlas_path)
+        os.replace(tmp_info, info_path)
+    except (OSError, ValueError) as e:
+        log.warning("cache", "could not write font cache: {}", e)
+        for path in (tmp_atlas, tmp_info):
+            if os.path.exists(path):
+                os.remove(path)
+    return atlas, metrics
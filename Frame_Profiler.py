@@ -0,0 +1,236 @@
+# --------------------
+# File: Frame_Profiler.py
+# Purpose: Times each phase of drawing a frame (ie. the CT slice, the button panel and the
+#          information banner) on the CPU with perf_counter and on the GPU with GL_TIME_ELAPSED
+#          queries, keeps the times of the last few hundred frames for rolling percentiles,
+#          can show them on screen with the Text renderer and writes a JSON report.
+# Author: Jacob Knop
+# Date: Summer 2020
+# --------------------
+
+# external dependencies
+from OpenGL.GL import *
+from OpenGL.raw.GL.VERSION.GL_3_3 import glGetQueryObjectui64v
+import ctypes
+import numpy as np
+import json
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import nullcontext
+
+# internal dependencies
+from Event_Log import log
+
+# number of frames the percentiles are taken over
+ROLLING_FRAMES = 240
+
+# GPU timer queries each phase cycles through. A query is read a few frames after it was made
+# so the CPU never has to wait for the GPU to catch up
+QUERY_FRAMES = 4
+
+# GPU times (ns) at or above this are from a broken query (some drivers return garbage for the first
+# query made) and are dropped, as are times of 0
+MAX_GPU_NS = 10 ** 9
+
+# percentiles reported for every phase
+PERCENTILES = [50, 95, 99]
+
+
+# returns {"p50": .., "p95": .., "p99": .., "mean": .., "max": .., "count": ..} of times in ms
+def summarize(times):
+    if len(times) == 0:
+        return {"count": 0}
+    times = np.array(times)
+    summary = {"p{}".format(p): round(float(v), 4) for p, v in zip(PERCENTILES, np.percentile(times, PERCENTILES))}
+    summary["mean"] = round(float(times.mean()), 4)
+    summary["max"] = round(float(times.max()), 4)
+    summary["count"] = len(times)
+    return summary
+
+
+# -----------------------------------------------------------------------
+# Class: PhaseTimer
+# Purpose: What FrameProfiler.phase returns - times the code in a with
+#          block (and starts and stops its GPU query)
+# -----------------------------------------------------------------------
+class PhaseTimer:
+    profiler = 0
+    name = 0
+    gpu = 0
+    start = 0
+
+    def __init__(self, profiler, name, gpu):
+        self.profiler = profiler
+        self.name = name
+        self.gpu = gpu
+
+    def __enter__(self):
+        if self.gpu:
+            self.gpu = self.profiler.begin_query(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.add_cpu_time(self.name, (time.perf_counter() - self.start) * 1000)
+        if self.gpu:
+            glEndQuery(GL_TIME_ELAPSED)
+        return False
+
+
+# -----------------------------------------------------------------------
+# Class: FrameProfiler
+# Purpose: Collects the CPU and GPU time of the named phases of every frame.
+#          Phases are timed with
+#              with profiler.phase("Panel.draw"):
+#                  buttoni.draw(VBO, EBO)
+#          and end_frame is called once the frame is swapped. GPU phases
+#          can not be nested (OpenGL only runs one GL_TIME_ELAPSED query at a
+#          time) so phases that hold other phases pass gpu=0. When the
+#          profiler is turned off (the default, as timer queries are not
+#          free) phase returns a with block that does nothing
+# Elements:
+#    enabled - whether phases are timed
+#    show_overlay - whether draw_overlay shows the times
+#    frames - number of frames finished with end_frame
+#    cpu_times, gpu_times - phase name -> times (ms) of the last ROLLING_FRAMES frames
+#    overlay_lines - the text draw_overlay shows (updated every overlay_interval frames so
+#                    the text renderer can reuse its layouts in between)
+# -----------------------------------------------------------------------
+class FrameProfiler:
+    enabled = 0
+    show_overlay = 0
+    frames = 0
+    overlay_interval = 30
+    overlay_lines = []
+
+    def __init__(self, enabled=0):
+        self.enabled = enabled
+        self.frames = 0
+        self.cpu_times = OrderedDict()
+        self.gpu_times = OrderedDict()
+        self.queries = {}  # phase name -> QUERY_FRAMES query IDs
+        self.pending = deque()  # (phase name, query ID, frame) in the order they were made, waiting for the GPU
+        self.waiting = set()  # query IDs in pending
+        self.overlay_lines = []
+
+    # returns a with block that times a phase of the frame (on the GPU too unless gpu is 0)
+    def phase(self, name, gpu=1):
+        if not self.enabled:
+            return nullcontext()
+        return PhaseTimer(self, name, gpu)
+
+    def add_cpu_time(self, name, ms):
+        if name not in self.cpu_times:
+            self.cpu_times[name] = deque(maxlen=ROLLING_FRAMES)
+        self.cpu_times[name].append(ms)
+
+    def add_gpu_time(self, name, ms):
+        if name not in self.gpu_times:
+            self.gpu_times[name] = deque(maxlen=ROLLING_FRAMES)
+        self.gpu_times[name].append(ms)
+
+    # starts the GPU timer of a phase and returns 1, or returns 0 if every query of the phase is
+    # still waiting on the GPU (the phase is then only timed on the CPU this frame)
+    def begin_query(self, name):
+        if name not in self.queries:
+            self.queries[name] = [int(query) for query in np.atleast_1d(glGenQueries(QUERY_FRAMES))]
+        query = self.queries[name][self.frames % QUERY_FRAMES]
+        if query in self.waiting:
+            return 0
+        glBeginQuery(GL_TIME_ELAPSED, query)
+        self.pending.append((name, query, self.frames))
+        self.waiting.add(query)
+        return 1
+
+    # reads the GPU times of earlier frames that are ready (oldest first, stopping at the first that
+    # is not). Results of 0 or MAX_GPU_NS and over are dropped
+    def collect_queries(self):
+        result = ctypes.c_uint64(0)
+        while self.pending:
+            name, query, frame = self.pending[0]
+            if frame >= self.frames or not glGetQueryObjectiv(query, GL_QUERY_RESULT_AVAILABLE):
+                break
+            self.pending.popleft()
+            self.waiting.discard(query)
+            # in ns - read as 64 bits through the raw function (the wrapped one can not size the result
+            # and the 32 bit glGetQueryObjectuiv clamps at 2^32 - 1)
+            glGetQueryObjectui64v(query, GL_QUERY_RESULT, ctypes.byref(result))
+            if 0 < result.value < MAX_GPU_NS:
+                self.add_gpu_time(name, result.value / 1e6)
+            else:
+                log.debug("profile", "dropped GPU time of {} ({} ns)", name, result.value)
+
+    # called once the frame has been swapped
+    def end_frame(self):
+        if not self.enabled:
+            return
+        self.collect_queries()
+        self.frames = self.frames + 1
+        if self.show_overlay and (self.frames % self.overlay_interval == 1 or not self.overlay_lines):
+            self.update_overlay()
+
+    # ------------------------------------------------------------------
+    # Function: report
+    # Purpose: returns the number of frames and, for every phase, the
+    #          percentiles, mean and max of its CPU and GPU times over the
+    #          last ROLLING_FRAMES frames (in ms)
+    # ------------------------------------------------------------------
+    def report(self):
+        phases = OrderedDict()
+        for name in self.cpu_times:
+            phases[name] = {"cpu_ms": summarize(self.cpu_times[name]),
+                            "gpu_ms": summarize(self.gpu_times.get(name, []))}
+        return {"frames": self.frames, "rolling_frames": ROLLING_FRAMES, "phases": phases}
+
+    # prints the report
+    def print_report(self):
+        print("frame profile ({} frames)".format(self.frames))
+        for line in self.report_lines():
+            print("  " + line)
+
+    # one line per phase with its median and 95th percentile CPU and GPU times
+    def report_lines(self):
+        lines = []
+        for name, times in self.report()["phases"].items():
+            line = "{}: cpu {:.2f}/{:.2f}".format(name, times["cpu_ms"]["p50"], times["cpu_ms"]["p95"])
+            if times["gpu_ms"]["count"]:
+                line = line + " gpu {:.2f}/{:.2f}".format(times["gpu_ms"]["p50"], times["gpu_ms"]["p95"])
+            lines.append(line + " ms")
+        return lines
+
+    # writes the report to a JSON file (nothing is written if no frames were profiled)
+    def dump(self, path):
+        if self.frames == 0:
+            return
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(path, "w") as f:
+                json.dump(self.report(), f, indent=2)
+            log.info("profile", "frame profile written to {}", path)
+        except OSError as e:
+            log.warning("profile", "could not write frame profile: {}", e)
+
+    # turns the overlay on or off
+    def toggle_overlay(self):
+        self.show_overlay = not self.show_overlay
+        self.overlay_lines = []
+        if self.show_overlay:
+            self.update_overlay()
+
+    def update_overlay(self):
+        self.overlay_lines = ["p50/p95 over {} frames".format(ROLLING_FRAMES)] + self.report_lines()
+
+    # ------------------------------------------------------------------
+    # Function: draw_overlay
+    # Purpose: shows the times with a Text object, a line at a time going
+    #          down from (x, y) (pixels from the top left of the window)
+    # ------------------------------------------------------------------
+    def draw_overlay(self, text, x, y, VBO, EBO):
+        if not self.show_overlay:
+            return
+        line_height = text.text_array[65].Size.y * 1.5
+        for i in range(len(self.overlay_lines)):
+            text.render_text(self.overlay_lines[i], x, y + i * line_height, VBO, EBO, 'y')
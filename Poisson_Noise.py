@@ -0,0 +1,239 @@
+# --------------------
+# File: Poisson_Noise.py
+# Purpose: Tables for simulating low dose (Poisson) noise on CT images in the DICOM shader.
+#          Instead of approximating every count with a Gaussian, the shader looks the count
+#          up in a precomputed inverse cumulative distribution (inverse-CDF) table of the
+#          Poisson distribution, which is exact at the low counts low dose images have.
+# Author: Jacob Knop
+# Date: Summer 2020
+# --------------------
+
+# external dependencies
+from OpenGL.GL import *
+import numpy as np
+from statistics import NormalDist
+
+# internal dependencies
+from Texture_Manager import textures
+
+# noise_mode values (the noiseMode uniform of the DICOM shader)
+NOISE_OFF = 0
+NOISE_BOX_MULLER = 1  # the original Gaussian approximation (S-box hash and Box-Muller transform)
+NOISE_TABLE = 2  # exact Poisson sampling from the inverse-CDF table
+NOISE_MODE_NAMES = ["off", "Box-Muller", "inverse-CDF table"]
+
+# table layout: one row per lambda from 0 to TABLE_MAX_LAMBDA in steps of 1 / TABLE_STEPS, plus a
+# last row holding the inverse CDF of the standard normal distribution (used above TABLE_MAX_LAMBDA
+# where the Gaussian approximation of the Poisson distribution is good). Column j is the value at
+# probability (j + 0.5) / TABLE_COLUMNS
+TABLE_MAX_LAMBDA = 64
+TABLE_STEPS = 8
+TABLE_COLUMNS = 2048
+
+
+# ------------------------------------------------------------
+# function: poisson_table
+# purpose: builds the inverse-CDF table (float32, rows x columns). Each
+#          Poisson row holds the smallest count k whose cumulative
+#          probability reaches the column's probability
+# parameters: max_lambda, steps, columns
+# 1. max_lambda - largest lambda with its own row
+# 2. steps      - rows per unit of lambda
+# 3. columns    - number of probabilities each row is sampled at
+# ------------------------------------------------------------
+def poisson_table(max_lambda=TABLE_MAX_LAMBDA, steps=TABLE_STEPS, columns=TABLE_COLUMNS):
+    lambdas = np.arange(max_lambda * steps + 1, dtype=np.float64) / steps
+    probabilities = (np.arange(columns, dtype=np.float64) + 0.5) / columns
+
+    # probability of each count (far enough past max_lambda that the rest of the tail is negligible)
+    max_count = int(max_lambda + 12 * np.sqrt(max_lambda) + 12)
+    pmf = np.empty((len(lambdas), max_count + 1), dtype=np.float64)
+    pmf[:, 0] = np.exp(-lambdas)
+    for k in range(1, max_count + 1):
+        pmf[:, k] = pmf[:, k - 1] * lambdas / k
+    cdf = np.cumsum(pmf, axis=1)
+
+    table = np.empty((len(lambdas) + 1, columns), dtype=np.float32)
+    for row in range(len(lambdas)):
+        table[row] = np.minimum(np.searchsorted(cdf[row], probabilities), max_count)
+    normal = NormalDist()
+    table[-1] = [normal.inv_cdf(p) for p in probabilities]
+    return table
+
+
+# ------------------------------------------------------------
+# function: create_poisson_texture
+# purpose: uploads the inverse-CDF table as a GL_R32F texture (read with
+#          texelFetch so it is never filtered) and returns its ID (must be
+#          called on the OpenGL thread)
+# parameters: owner
+# 1. owner - object the texture is freed with (see Texture_Manager)
+# ------------------------------------------------------------
+def create_poisson_texture(owner=0):
+    table = poisson_table()
+    texture = textures.create(owner, table.nbytes)
+    glBindTexture(GL_TEXTURE_2D, texture)
+    glPixelStorei(GL_UNPACK_ALIGNMENT, 4)
+    glTexImage2D(GL_TEXTURE_2D, 0, GL_R32F, table.shape[1], table.shape[0], 0, GL_RED, GL_FLOAT, table)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+    glBindTexture(GL_TEXTURE_2D, 0)
+    return texture
+
+
+# ------------------------------------------------------------------------------------------
+# CPU noise engine
+# The functions below repeat the DICOM shader's noise with numpy so noisy images can be made
+# without a window. Every step is done with float32 and uint32 values in the same order as
+# the shader. The table mode (integer hashes and table lookups) matches what is drawn on the
+# screen bit for bit. The Box-Muller mode uses the same uniform numbers as the shader, but
+# the GPU's log, cos and sqrt are not exactly numpy's, so it only matches to within
+# BOX_MULLER_TOLERANCE (a few ulps - most pixels are exact, and the relative error can be a
+# few percent where the noisy value is close to 0)
+# ------------------------------------------------------------------------------------------
+
+# largest difference (in display values, 1 is 5119 HU) between the Box-Muller mode and the shader,
+# about 0.05 HU (the largest seen against offscreen renders was 0.02 HU)
+BOX_MULLER_TOLERANCE = 1e-5
+
+# the shader's S table (must match the S array in fragment_dcm_src in Dicom_Program.py)
+S_BOX = np.array([
+    0x29, 0x2E, 0x43, 0xC9, 0xA2, 0xD8, 0x7C, 0x01, 0x3D, 0x36, 0x54, 0xA1, 0xEC, 0xF0, 0x06, 0x13,
+    0x62, 0xA7, 0x05, 0xF3, 0xC0, 0xC7, 0x73, 0x8C, 0x98, 0x93, 0x2B, 0xD9, 0xBC, 0x4C, 0x82, 0xCA,
+    0x1E, 0x9B, 0x57, 0x3C, 0xFD, 0xD4, 0xE0, 0x16, 0x67, 0x42, 0x6F, 0x18, 0x8A, 0x17, 0xE5, 0x12,
+    0xBE, 0x4E, 0xC4, 0xD6, 0xDA, 0x9E, 0xDE, 0x49, 0xA0, 0xFB, 0xF5, 0x8E, 0xBB, 0x2F, 0xEE, 0x7A,
+    0xA9, 0x68, 0x79, 0x91, 0x15, 0xB2, 0x07, 0x3F, 0x94, 0xC2, 0x10, 0x89, 0x0B, 0x22, 0x5F, 0x21,
+    0x80, 0x7F, 0x5D, 0x9A, 0x5A, 0x90, 0x32, 0x27, 0x35, 0x3E, 0xCC, 0xE7, 0xBF, 0xF7, 0x97, 0x03,
+    0xFF, 0x19, 0x30, 0xB3, 0x48, 0xA5, 0xB5, 0xD1, 0xD7, 0x5E, 0x92, 0x2A, 0xAC, 0x56, 0xAA, 0xC6,
+    0x4F, 0xB8, 0x38, 0xD2, 0x96, 0xA4, 0x7D, 0xB6, 0x76, 0xFC, 0x6B, 0xE2, 0x9C, 0x74, 0x04, 0xF1,
+    0x45, 0x9D, 0x70, 0x59, 0x64, 0x71, 0x87, 0x20, 0x86, 0x5B, 0xCF, 0x65, 0xE6, 0x2D, 0xA8, 0x02,
+    0x1B, 0x60, 0x25, 0xAD, 0xAE, 0xB0, 0xB9, 0xF6, 0x1C, 0x46, 0x61, 0x69, 0x34, 0x40, 0x7E, 0x0F,
+    0x55, 0x47, 0xA3, 0x23, 0xDD, 0x51, 0xAF, 0x3A, 0xC3, 0x5C, 0xF9, 0xCE, 0xBA, 0xC5, 0xEA, 0x26,
+    0x2C, 0x53, 0x0D, 0x6E, 0x85, 0x28, 0x84, 0x09, 0xD3, 0xDF, 0xCD, 0xF4, 0x41, 0x81, 0x4D, 0x52,
+    0x6A, 0xDC, 0x37, 0xC8, 0x6C, 0xC1, 0xAB, 0xFA, 0x24, 0xE1, 0x7B, 0x08, 0x0C, 0xBD, 0xB1, 0x4A,
+    0x78, 0x88, 0x95, 0x8B, 0xE3, 0x63, 0xE8, 0x6D, 0xE9, 0xCB, 0xD5, 0xFE, 0x3B, 0x00, 0x1D, 0x39,
+    0xF2, 0xEF, 0xB7, 0x0E, 0x66, 0x58, 0xD0, 0xE4, 0xA6, 0x77, 0x72, 0xF8, 0xEB, 0x75, 0x4B, 0x0A,
+    0x31, 0x44, 0x50, 0xB4, 0x8F, 0xED, 0x1F, 0x1A, 0xDB, 0x99, 0x8D, 0x33, 0x9F, 0x11, 0x83, 0x14], dtype=np.uint32)
+
+# size (in screen pixels) slices are drawn at - the Box-Muller hash counts screen pixels
+DISPLAY_SIZE = 512
+
+cpu_table = None  # inverse-CDF table (built the first time the CPU engine needs it)
+
+
+# returns the inverse-CDF table for the CPU engine
+def get_table():
+    global cpu_table
+    if cpu_table is None:
+        cpu_table = poisson_table()
+    return cpu_table
+
+
+# the shader's integer hash (lowbias32) on uint32 arrays
+def hash32(x):
+    x = x ^ (x >> np.uint32(16))
+    x = x * np.uint32(0x7FEB352D)
+    x = x ^ (x >> np.uint32(15))
+    x = x * np.uint32(0x846CA68B)
+    x = x ^ (x >> np.uint32(16))
+    return x
+
+
+# ------------------------------------------------------------
+# function: sbox_uniforms
+# purpose: the shader's S-box hash - returns the two uniform numbers
+#          (U1, U2) the Box-Muller transform uses for each pixel
+# parameters: ix, iy, iz
+# 1. ix, iy - screen pixel the image pixel is drawn at (uint32 arrays)
+# 2. iz     - slice number
+# ------------------------------------------------------------
+def sbox_uniforms(ix, iy, iz):
+    pos = ix + (iy << np.uint32(9)) + (iz << np.uint32(18))
+    ia = pos & np.uint32(0xFF)
+    ib = (pos >> np.uint32(8)) & np.uint32(0xFF)
+    ic = (pos >> np.uint32(16)) & np.uint32(0xFF)
+    id = (pos >> np.uint32(24)) & np.uint32(0xFF)
+
+    ran = [S_BOX[S_BOX[S_BOX[S_BOX[S_BOX[i] ^ ia] ^ ib] ^ ic] ^ id] for i in range(4)]
+    u1 = (ran[0] + (ran[1] << np.uint32(8))).astype(np.float32) / np.float32(65536.0)
+    u2 = (ran[2] + (ran[3] << np.uint32(8))).astype(np.float32) / np.float32(65536.0)
+    return u1, u2
+
+
+# the shader's display value (0 - air, 1 - 4095 HU and above 6000 HU) of stored pixel values
+def display_values(stored, slope=1.0, intercept=0.0):
+    hu = stored.astype(np.float32) * np.float32(slope) + np.float32(intercept)
+    return np.where(hu <= np.float32(6000), (hu + np.float32(1024)) / np.float32(5119), np.float32(1))
+
+
+# ------------------------------------------------------------
+# function: noisy_display
+# purpose: returns what the DICOM shader draws for a block of axial
+#          slices (display values, see display_values) with the noise of
+#          the given mode and slider value added
+# parameters: stored, first_slice, slider, mode, slope, intercept
+# 1. stored      - (slices, rows, columns) stored pixel values
+# 2. first_slice - slice number of stored[0] in the scan (the noise
+#                  depends on it)
+# 3. slider      - the exposure slider value (lambda = display value * slider)
+# 4. mode        - NOISE_OFF, NOISE_BOX_MULLER or NOISE_TABLE
+# ------------------------------------------------------------
+def noisy_display(stored, first_slice, slider, mode, slope=1.0, intercept=0.0):
+    a = display_values(stored, slope, intercept)
+    if mode == NOISE_OFF or slider <= 0:
+        return a
+    slices, rows, cols = stored.shape
+    slider = np.float32(slider)
+    iz = (first_slice + np.arange(slices, dtype=np.uint32))[:, None, None]
+
+    if mode == NOISE_BOX_MULLER:
+        # the screen pixel at the center of every image pixel (the same as the pixel when it is 512 x 512)
+        ix = np.floor((np.arange(cols) + 0.5) * DISPLAY_SIZE / cols).astype(np.uint32)[None, None, :]
+        iy = np.floor((np.arange(rows) + 0.5) * DISPLAY_SIZE / rows).astype(np.uint32)[None, :, None]
+        u1, u2 = sbox_uniforms(ix, iy, iz)
+        lam = a * slider
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z0 = np.sqrt(np.float32(-2) * np.log(u1)) * np.cos(np.float32(2 * np.pi) * u2)
+            z0 = z0 * np.sqrt(lam) + lam
+        return z0 / slider
+
+    table = get_table()
+    ix = np.arange(cols, dtype=np.uint32)[None, None, :]
+    iy = np.arange(rows, dtype=np.uint32)[None, :, None]
+    h = hash32(ix ^ hash32(iy ^ hash32(iz)))
+    column = (h >> np.uint32(21)).astype(np.intp)
+    lam = np.maximum(a * slider, np.float32(0))
+
+    # lambdas with their own rows - picking randomly between the two nearest ones
+    row = lam * np.float32(TABLE_STEPS)
+    pick = (hash32(h) >> np.uint32(8)).astype(np.float32) / np.float32(16777216.0)
+    whole = np.floor(row)
+    r = np.minimum(whole.astype(np.intp) + ((row - whole) > pick), table.shape[0] - 2)
+    count = table[r, column]
+
+    # larger lambdas use the normal distribution
+    large = lam > np.float32(TABLE_MAX_LAMBDA)
+    if large.any():
+        z = table[-1][column[large]]
+        count[large] = np.maximum(np.floor(lam[large] + z * np.sqrt(lam[large]) + np.float32(0.5)), np.float32(0))
+    return count / slider
+
+
+# ------------------------------------------------------------
+# function: noisy_volume
+# purpose: adds simulated low dose noise to a volume of stored pixel values
+#          (chunk slices at a time to keep the temporary arrays small) and
+#          returns the noisy stored values as int16. Values the viewer
+#          shows as white (above 6000 HU) come back as 4095 HU
+# parameters: volume, slider, mode, slope, intercept, first_slice, chunk
+# ------------------------------------------------------------
+def noisy_volume(volume, slider, mode=NOISE_TABLE, slope=1.0, intercept=0.0, first_slice=0, chunk=16):
+    noisy = np.empty(volume.shape, dtype=np.int16)
+    for z in range(0, volume.shape[0], chunk):
+        a = noisy_display(volume[z:z + chunk], first_slice + z, slider, mode, slope, intercept)
+        hu = a.astype(np.float64) * 5119 - 1024
+        stored = np.rint((hu - intercept) / slope)
+        noisy[z:z + chunk] = np.clip(np.nan_to_num(stored), -32768, 32767)
+    return noisy
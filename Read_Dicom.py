@@ -11,18 +11,29 @@ import glfw
 from OpenGL.GL import *
 from OpenGL.GL.shaders import compileProgram, compileShader
 import numpy as np
-import freetype
 import glm
 import os  # used for searching a file directory in one of the code snippets below
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor  # used for decoding slices in parallel
+import threading  # used for streaming slices in the background
+import queue  # hands slices decoded in the background back to the OpenGL thread
+import struct  # used for reading the pixel data element header
+import time  # used for limiting how long texture uploads take each frame
 
 import pydicom
 from pydicom.data import get_testdata_files
 from pydicom.tag import Tag
+from pydicom.errors import InvalidDicomError
+from pydicom.uid import ImplicitVRLittleEndian, ExplicitVRLittleEndian
 
 # internal dependencies
 import normalize
+from Slice_Cache import LRUCache
+from Texture_Manager import textures
+from Upload_Ring import UploadRing
+from Poisson_Noise import TABLE_STEPS, TABLE_MAX_LAMBDA, NOISE_TABLE
 from normalize import normalize_dcm
 from normalize import normalize_pixel
+from Event_Log import log
 
 import matplotlib.pyplot as plt
 
@@ -112,16 +123,473 @@ import matplotlib.pyplot as plt
 #         glDrawElements(GL_TRIANGLES, len(self.indices), GL_UNSIGNED_INT, None)
 
 
+# tags read during the header-only pass over a folder (the pixel data is never read)
+HEADER_TAGS = ["SOPInstanceUID", "SeriesInstanceUID", "StudyInstanceUID", "Rows", "Columns", "SliceLocation",
+               "ImagePositionPatient", "ImageOrientationPatient", "InstanceNumber", "PatientID", "PatientName",
+               "StudyDate", "StudyDescription", "Modality", "SeriesNumber", "SeriesDescription",
+               "RescaleSlope", "RescaleIntercept"]
+
+
+# ------------------------------------------------------------
+# function: header_from_dataset
+# purpose: pulls the information the viewer needs out of a pydicom
+#          dataset into a plain dictionary (plain types so that it can
+#          be sent between processes)
+# parameters: ds, filename
+# 1. ds       - a pydicom dataset (with or without pixel data)
+# 2. filename - the file the dataset was read from
+# ------------------------------------------------------------
+def header_from_dataset(ds, filename):
+    def as_float(value):
+        return None if value is None or value == "" else float(value)
+
+    def as_floats(value):
+        return None if value is None or len(value) == 0 else [float(v) for v in value]
+
+    def as_str(value):
+        return None if value is None else str(value)
+
+    def as_int(value):
+        return None if value is None or value == "" else int(value)
+
+    return {"filename": filename,
+            "sop_uid": as_str(ds.get("SOPInstanceUID")),
+            "series_uid": as_str(ds.get("SeriesInstanceUID")),
+            "study_uid": as_str(ds.get("StudyInstanceUID")),
+            "rows": ds.get("Rows"),
+            "columns": ds.get("Columns"),
+            "slice_location": as_float(ds.get("SliceLocation")),
+            "position": as_floats(ds.get("ImagePositionPatient")),
+            "orientation": as_floats(ds.get("ImageOrientationPatient")),
+            "instance_number": as_int(ds.get("InstanceNumber")),
+            "patient_id": as_str(ds.get("PatientID")),
+            "patient_name": as_str(ds.get("PatientName")),
+            "study_date": as_str(ds.get("StudyDate")),
+            "study_description": as_str(ds.get("StudyDescription")),
+            "modality": as_str(ds.get("Modality")),
+            "series_number": as_int(ds.get("SeriesNumber")),
+            "series_description": as_str(ds.get("SeriesDescription")),
+            "RescaleSlope": as_float(ds.get("RescaleSlope")),
+            "RescaleIntercept": as_float(ds.get("RescaleIntercept"))}
+
+
+# ------------------------------------------------------------
+# function: read_dcm_header
+# purpose: reads only the header of a DICOM file (stops before the
+#          pixel data). Returns None for files that are not DICOM
+#          images so they can be skipped before any pixel decoding, and
+#          for images whose header can not be read (ie. a malformed DS or
+#          IS value) so one bad file does not stop a folder or archive
+# parameters: filename
+# 1. filename - the file name of a given DICOM file to read
+# ------------------------------------------------------------
+def read_dcm_header(filename):
+    try:
+        ds = pydicom.dcmread(filename, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+    except (InvalidDicomError, OSError):
+        return None
+
+    try:
+        # files without an image size (structured reports, presentation states...) are not images
+        if ds.get("Rows") is None or ds.get("Columns") is None:
+            return None
+        return header_from_dataset(ds, filename)
+    except (ValueError, struct.error) as e:
+        log.warning("load", "skipping {}: bad header ({})", filename, e)
+        return None
+
+
+# ------------------------------------------------------------
+# function: map_dcm_pixels
+# purpose: for uncompressed little endian single frame images, returns the
+#          pixel data as a read only np.memmap straight onto the file (no
+#          decoding or copying - the OS pages it in when it is used).
+#          Returns None for anything else so the caller can fall back to
+#          pydicom's pixel_array
+# parameters: filename
+# 1. filename - the file name of a given DICOM file to read
+# ------------------------------------------------------------
+def map_dcm_pixels(filename):
+    with open(filename, "rb") as fp:
+        # pydicom leaves the file positioned at the start of the pixel data element
+        ds = pydicom.dcmread(fp, stop_before_pixels=True)
+        element_start = fp.tell()
+        element = fp.read(12)
+
+    file_meta = getattr(ds, "file_meta", None)
+    syntax = None
+    if file_meta is not None:
+        syntax = file_meta.get("TransferSyntaxUID")
+    if syntax not in (ImplicitVRLittleEndian, ExplicitVRLittleEndian):
+        return None
+    if int(ds.get("NumberOfFrames", 1) or 1) != 1 or ds.get("SamplesPerPixel", 1) != 1:
+        return None
+    bits_allocated = ds.get("BitsAllocated")
+    bits_stored = ds.get("BitsStored", bits_allocated)
+    signed = ds.get("PixelRepresentation", 0) == 1
+    # signed values stored in fewer bits than allocated have to be sign extended (a copy)
+    if bits_allocated not in (8, 16) or (signed and bits_stored != bits_allocated):
+        return None
+
+    if len(element) < 12 or struct.unpack("<HH", element[:4]) != (0x7FE0, 0x0010):
+        return None
+    if syntax == ExplicitVRLittleEndian:
+        length = struct.unpack("<I", element[8:12])[0]
+        offset = element_start + 12
+    else:
+        length = struct.unpack("<I", element[4:8])[0]
+        offset = element_start + 8
+
+    rows = ds.get("Rows")
+    columns = ds.get("Columns")
+    dtype = np.dtype(("<i" if signed else "<u") + str(bits_allocated // 8))
+    if length == 0xFFFFFFFF or length < rows * columns * dtype.itemsize:
+        return None
+    return np.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=(rows, columns))
+
+
+# ------------------------------------------------------------
+# function: read_dcm_pixels
+# purpose: returns the pixel data of a DICOM file, memory mapped when
+#          the file is uncompressed (see map_dcm_pixels) and decoded by
+#          pydicom otherwise. This does not touch OpenGL so it is safe to
+#          run on a worker thread or process
+# parameters: filename
+# 1. filename - the file name of a given DICOM file to read
+# ------------------------------------------------------------
+def read_dcm_pixels(filename):
+    try:
+        pixelarray = map_dcm_pixels(filename)
+    except (OSError, ValueError, struct.error):
+        # ie. running out of file handles for the maps - decoding still works
+        pixelarray = None
+    if pixelarray is None:
+        pixelarray = pydicom.dcmread(filename).pixel_array
+    return pixelarray
+
+
+# ------------------------------------------------------------
+# function: as_int16
+# purpose: returns stored pixel values as int16 (what volumes and slice
+#          textures hold), or writes them into out. Values outside the
+#          int16 range (ie. unsigned 16 bit values above 32767, which
+#          would wrap around to negative values) are clipped - they are
+#          far above the 6000 HU the viewer shows as white
+# parameters: pixelarray, out
+# 1. pixelarray - stored values of a slice (any integer type)
+# 2. out        - int16 array to write into (ie. a plane of a volume)
+# ------------------------------------------------------------
+def as_int16(pixelarray, out=None):
+    if pixelarray.dtype.itemsize < 2 or pixelarray.dtype == np.int16:
+        if out is None:
+            return pixelarray.astype(np.int16, copy=False)
+        out[...] = pixelarray
+        return out
+    if out is None:
+        out = np.empty(pixelarray.shape, dtype=np.int16)
+    # one pass straight into the int16 array (np.int32 bounds so unsigned values are compared as numbers)
+    np.clip(pixelarray, np.int32(-32768), np.int32(32767), out=out, casting="unsafe")
+    return out
+
+
+# ------------------------------------------------------------
+# function: read_dcm
+# purpose: reads a DICOM file and returns its header information along
+#          with the decoded pixel array
+# parameters: filename
+# 1. filename - the file name of a given DICOM file to read
+# ------------------------------------------------------------
+def read_dcm(filename):
+    ds = pydicom.dcmread(filename)
+    return header_from_dataset(ds, filename), ds.pixel_array
+
+
+# ------------------------------------------------------------
+# function: pool_map
+# purpose: calls func on every item on a pool of workers and returns
+#          the results in the same order as the items
+# parameters: func, items, workers, pool_type
+# 1. func      - function to call (must be importable when using processes)
+# 2. items     - list of arguments (ie. file names)
+# 3. workers   - how many workers to use (0 or 1 runs on the calling thread)
+# 4. pool_type - "thread" or "process". Threads share memory with the viewer,
+#                processes avoid the GIL but have to send each result back
+# ------------------------------------------------------------
+def pool_map(func, items, workers=0, pool_type="thread"):
+    return list(pool_imap(func, items, workers, pool_type))
+
+
+# same as pool_map but yields the results (in order) as they finish so the caller can put each one
+# where it belongs without holding on to all of them
+def pool_imap(func, items, workers=0, pool_type="thread"):
+    if workers <= 1 or len(items) <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    if pool_type == "process":
+        # handing each process a batch of files keeps the inter-process overhead down
+        chunksize = max(1, len(items) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            yield from pool.map(func, items, chunksize=chunksize)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(func, items)
+
+
+# ------------------------------------------------------------
+# function: scan_headers
+# purpose: header-only pass over a list of files. Drops files that are
+#          not DICOM images and duplicate instances (same SOPInstanceUID)
+# parameters: filenames, workers, pool_type (see pool_map)
+# ------------------------------------------------------------
+def scan_headers(filenames, workers=0, pool_type="thread"):
+    headers = [header for header in pool_map(read_dcm_header, filenames, workers, pool_type) if header is not None]
+    return unique_headers(headers)
+
+
+# drops the headers of instances that were already seen (the same SOPInstanceUID in another file - ie. a
+# backup or second copy of a series), keeping the first of each
+def unique_headers(headers):
+    unique = []
+    seen = set()
+    for header in headers:
+        if header["sop_uid"] is not None:
+            if header["sop_uid"] in seen:
+                continue
+            seen.add(header["sop_uid"])
+        unique.append(header)
+    return unique
+
+
+# returns every .dcm file in a folder and its sub folders
+def find_dicom_files(folder):
+    filenames = []
+    for root, dirs, files in os.walk(folder):
+        for file in files:
+            if file.lower().endswith('.dcm'):
+                filenames.append(os.path.join(root, file))
+    filenames.sort()
+    return filenames
+
+
+# ------------------------------------------------------------
+# function: group_series
+# purpose: splits slice headers up by SeriesInstanceUID. Returns a list
+#          of header lists, one per series, ordered by series number
+# parameters: headers
+# 1. headers - list of dictionaries from scan_headers
+# ------------------------------------------------------------
+def group_series(headers):
+    groups = {}
+    for header in headers:
+        groups.setdefault(header["series_uid"], []).append(header)
+    return sorted(groups.values(), key=lambda group: (group[0]["series_number"] is None,
+                                                      group[0]["series_number"] or 0))
+
+
+# ------------------------------------------------------------
+# function: scan_folder_series
+# purpose: header-only pass over every DICOM file in a folder that
+#          returns the series found in it (see group_series). No pixel
+#          data is read so this is cheap even for very large folders
+# parameters: folder, workers, pool_type (see pool_map)
+# ------------------------------------------------------------
+def scan_folder_series(folder, workers=0, pool_type="thread"):
+    return group_series(scan_headers(find_dicom_files(folder), workers, pool_type))
+
+
+# describes a series (one of the groups from group_series) for showing to the user
+def describe_series(group):
+    header = group[0]
+    return "Series {}: {} ({}) - {} images".format(header["series_number"], header["series_description"] or "",
+                                                   header["modality"] or "", len(group))
+
+
+# ------------------------------------------------------------
+# function: sort_headers
+# purpose: orders slice headers along the slice normal (from
+#          ImageOrientationPatient and ImagePositionPatient) with a
+#          single argsort. Falls back to SliceLocation and then
+#          InstanceNumber when the position information is missing.
+#          Slices are ordered from the highest location to the lowest
+# parameters: headers
+# 1. headers - list of dictionaries from scan_headers
+# ------------------------------------------------------------
+def sort_headers(headers):
+    if len(headers) <= 1:
+        return list(headers)
+
+    if all(h["position"] is not None and h["orientation"] is not None for h in headers):
+        orientation = np.array(headers[0]["orientation"], dtype=np.float64)
+        normal = np.cross(orientation[:3], orientation[3:])
+        positions = np.array([h["position"] for h in headers], dtype=np.float64)
+        location = positions @ normal
+    elif all(h["slice_location"] is not None for h in headers):
+        location = np.array([h["slice_location"] for h in headers], dtype=np.float64)
+    else:
+        # instance numbers count up through the series so the lowest number goes first
+        location = -np.array([h["instance_number"] or 0 for h in headers], dtype=np.float64)
+
+    order = np.argsort(-location, kind="stable")
+    return [headers[i] for i in order]
+
+
+# ------------------------------------------------------------
+# function: create_slice_texture
+# purpose: creates an OpenGL texture from a slice's pixel array and
+#          returns its ID (must be called on the OpenGL thread). The
+#          stored 16 bit values are sent as they are (GL_R16_SNORM) and
+#          turned back into Hounsfield units by the DICOM shader
+# parameters: pixelarray, owner, evictable, on_evict
+# 1. pixelarray - 2D array of a slice's stored pixel values
+# 2. owner      - object the texture is freed with (see Texture_Manager)
+# 3. evictable  - whether the texture manager may delete it to stay within
+#                 its budget (on_evict is then called with the texture ID)
+# 4. from_pbo   - the pixels are already in the pixel buffer object bound to
+#                 GL_PIXEL_UNPACK_BUFFER (see Upload_Ring) and pixelarray is
+#                 only used for its size
+# ------------------------------------------------------------
+def create_slice_texture(pixelarray, owner=0, evictable=0, on_evict=None, from_pbo=0):
+    normal = pixelarray
+    # print("rows: {}, col: {}".format(normal.shape[0], normal.shape[1]))
+    texture = textures.create(owner, slice_texture_bytes(pixelarray), evictable, on_evict)
+    glBindTexture(GL_TEXTURE_2D, texture)
+    # width is the number of columns and height the number of rows (rows of 16 bit pixels are only
+    # 2 byte aligned when there is an odd number of columns)
+    glPixelStorei(GL_UNPACK_ALIGNMENT, 2)
+    if from_pbo:
+        data = None  # offset 0 into the bound buffer
+    else:
+        data = np.ascontiguousarray(normal, dtype=np.int16)
+    glTexImage2D(GL_TEXTURE_2D, 0, GL_R16_SNORM, normal.shape[1], normal.shape[0], 0, GL_RED, GL_SHORT, data)
+
+    # Set the texture wrapping parameters
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)
+    # Set texture filtering parameters
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+
+    glBindTexture(GL_TEXTURE_2D, 0)
+    return texture
+
+
+# ------------------------------------------------------------
+# function: create_volume_texture
+# purpose: uploads a whole (slices, rows, columns) volume as one 3D
+#          texture so every MPR view can be sampled from it in the shader.
+#          It is sent a slab of slices at a time (as 16 bit values like the
+#          slice textures). Returns 0 when the volume is bigger than the
+#          GPU allows (must be called on the OpenGL thread)
+# parameters: volume, owner
+# 1. volume - 3D array of the scan's stored pixel values
+# 2. owner  - object the texture is freed with (see Texture_Manager)
+# ------------------------------------------------------------
+def create_volume_texture(volume, owner=0, slab=32):
+    depth, rows, cols = volume.shape
+    max_size = glGetIntegerv(GL_MAX_3D_TEXTURE_SIZE)
+    if max(depth, rows, cols) > max_size:
+        log.warning("view", "volume {}x{}x{} is larger than the 3D texture limit ({})", cols, rows, depth, max_size)
+        return 0
+
+    texture = textures.create(owner, depth * rows * cols * 2)
+    glBindTexture(GL_TEXTURE_3D, texture)
+    glTexImage3D(GL_TEXTURE_3D, 0, GL_R16_SNORM, cols, rows, depth, 0, GL_RED, GL_SHORT, None)
+    glPixelStorei(GL_UNPACK_ALIGNMENT, 2)
+    for z in range(0, depth, slab):
+        count = min(slab, depth - z)
+        glTexSubImage3D(GL_TEXTURE_3D, 0, 0, 0, z, cols, rows, count, GL_RED, GL_SHORT,
+                        np.ascontiguousarray(volume[z:z + count], dtype=np.int16))
+
+    # clamping so the views do not bleed into the opposite side of the volume at the edges
+    glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+    glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+    glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_WRAP_R, GL_CLAMP_TO_EDGE)
+    glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+    glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+    glBindTexture(GL_TEXTURE_3D, 0)
+    return texture
+
+
+# number of bytes a slice texture takes up on the GPU (GL_R16_SNORM - 2 bytes a pixel)
+def slice_texture_bytes(pixelarray):
+    return pixelarray.shape[0] * pixelarray.shape[1] * 2
+
+
+# frees a slice texture when it is evicted from a texture cache
+def delete_slice_texture(index, texture):
+    textures.delete(texture)
+
+
+# function called (from any thread) when a slice finished loading in the background and is ready
+# to be drawn. The viewer sets it to glfw.post_empty_event so its main loop, which sleeps until
+# something changes, wakes up and draws the slice
+on_background_load = None
+
+
+# calls on_background_load if it is set (extra arguments are ignored so it can be a future's done callback)
+def notify_background_load(*args):
+    if on_background_load:
+        on_background_load()
+
+
 class CTScan:
     curr_folder = 0  # the folder the slices are derived from
     curr_slice = 0  # the slice the viewer is currently displaying
     num_slices = 0  # how many slices are loaded
     ct_slices = []  # stores all of the loaded ct slices
-    dcm_shader = 0  # shader to visualize a given CT Slice
+    dcm_shader = 0  # ShaderProgram to visualize a given CT Slice
     translation = glm.vec3(0, 0, 0)  # used in translating the image
     zoom = 1  # used for zooming in on the image
     ff_flag = 0  # open file or folder flag: 0 - open folder, 1 - open file
     exposure = 0
+    noise_mode = 0  # simulated low dose noise (see Poisson_Noise.py for the modes)
+    noise_table = 0  # inverse-CDF table texture from Poisson_Noise.create_poisson_texture
+
+    # how the slices are decoded (only the texture upload has to stay on the OpenGL thread)
+    load_workers = 0  # number of workers decoding slices (0 - decode on the calling thread)
+    load_pool = "thread"  # "thread" or "process"
+
+    # "eager"  - every slice is decoded before the constructor returns
+    # "stream" - only the headers are read up front, the pixels are decoded by background threads
+    #            starting at the middle slice and fanning out from curr_slice (see update())
+    # "lazy"   - only the headers are kept for every slice. Pixels and textures are created when a
+    #            slice is looked at and held in LRU caches limited to host_budget and gpu_budget bytes
+    load_mode = "eager"
+    num_loaded = 0  # how many slices have their texture (equals num_slices once loading is done)
+    num_failed = 0  # slices that could not be decoded while streaming
+    upload_budget = 0.004  # seconds of texture uploads update() may do each frame (at least one is done)
+    upload_ring = 0  # UploadRing the background threads copy decoded slices into (stream and lazy)
+    upload_ring_size = 8  # number of pixel buffer objects in the ring
+    requested = 0  # (stream) which slices have been handed to a background thread
+    decoded = 0  # (stream) queue of (slice index, decoded flag) waiting for a texture upload
+    stream_lock = 0
+    stop_event = 0
+    stream_threads = []
+
+    # lazy loading
+    host_budget = 1024 * 1024 * 1024  # bytes of decoded pixel arrays to keep in memory
+    gpu_budget = 512 * 1024 * 1024  # bytes of slice textures to keep on the GPU
+    prefetch_count = 4  # how many slices ahead (in the scroll direction) to decode in the background
+    host_cache = 0  # slice index -> pixel array
+    texture_cache = 0  # slice index -> texture ID
+    prefetch_pool = 0
+    pending = {}  # slice index -> future of a prefetch that has not been moved into host_cache yet
+
+    # every slice's pixels live in one C-contiguous int16 (slices, rows, columns) array that the
+    # loader fills in place - each CT_Slice only holds a view of its plane. It is memory mapped
+    # when the scan came from the volume cache and is not used in lazy mode
+    volume = None
+    from_cache = 0  # whether volume is the (read only) memory mapped cache entry
+
+    # on-disk volume cache (see Volume_Cache.py)
+    volume_cache = 0
+    series_uid = 0
+    source_files = []  # the files the scan was made from (part of the cache key)
+    headers = []  # slice headers in display order
+    cache_stored = 0  # whether this scan has been written to the cache
 
     # these variables will store information about normalizing the CT Scan (mx + b format)
     # when drawing
@@ -145,16 +613,31 @@ class CTScan:
     vertices = np.array(vertices, dtype=np.float32)
     indices = np.array(indices, dtype=np.uint32)
 
+    # multi-planar reconstruction: 1 - axial, 2 - coronal, 3 - sagittal. The other views are
+    # sampled from volume_texture by the shader, so switching views does not upload anything
     mpr_view = 1
-    new_texture_list = []
+    volume_texture = 0  # 3D texture of the whole scan (created the first time the view is changed)
+    new_texture_list = []  # per slice 2D textures of the view, only used when the volume is too big for a 3D texture
 
-    def __init__(self, folder, shader, ff_flag):
-        print("loading new CT_Scan")
-        print(folder)
+    def __init__(self, folder, shader, ff_flag, workers=0, pool_type="thread", load_mode="eager",
+                 host_budget=None, gpu_budget=None, volume_cache=None, headers=None):
+        log.info("load", "loading {}", folder)
         self.ct_slices = []
         self.curr_folder = folder
         self.dcm_shader = shader
         self.ff_flag = ff_flag
+        self.load_workers = workers
+        self.load_pool = pool_type
+        self.load_mode = load_mode
+        if host_budget is not None:
+            self.host_budget = host_budget
+        if gpu_budget is not None:
+            self.gpu_budget = gpu_budget
+        if volume_cache is not None:
+            self.volume_cache = volume_cache
+        # slice headers that were already read elsewhere (ie. from the catalog) - the folder is not searched
+        if headers:
+            self.headers = headers
         self.load()
 
     def load(self):
@@ -171,35 +654,419 @@ class CTScan:
         # files within a folder similar to the project of Summer 2019
         # getting directory path name (this will need error checking later)
 
-        dir_path = os.path.dirname(self.curr_folder)
-        for root, dirs, files in os.walk(dir_path):
-            for file in files:
-                if file.endswith('.dcm'):
-                    self.num_slices = self.num_slices + 1
-                    slice = CT_Slice(self.curr_folder + '/' + file)
-                    self.ct_slices.append(slice)
-
-        # sorting slices (might want to see about implementing this using numpy functions
-        swapped = 1
-        while swapped:
-            swapped = 0
-            for i in range(len(self.ct_slices) - 1):
-                if self.ct_slices[i].slice_location < self.ct_slices[i + 1].slice_location:
-                    swapped = 1
-                    swap_var = self.ct_slices[i]
-                    self.ct_slices[i] = self.ct_slices[i + 1]
-                    self.ct_slices[i + 1] = swap_var
+        # first pass: read only the headers so the slices can be ordered (and anything that is
+        # not an image or is a duplicate thrown out) before paying for any pixel decoding
+        if not self.headers:
+            # a folder can hold several series (scouts, reformats...) and mixing them together does not
+            # make sense. Without being told which one to use (see scan_folder_series) the largest is loaded.
+            # The series has to be picked before the volume cache is checked so the cache is asked for
+            # the series that is loaded and not whichever series the first file is in
+            groups = scan_folder_series(self.curr_folder, self.load_workers, self.load_pool)
+            self.headers = []
+            if groups:
+                self.headers = max(groups, key=len)
+                if len(groups) > 1:
+                    log.info("load", "{} series found, loading {}", len(groups), describe_series(self.headers))
+
+        # headers from elsewhere (ie. the catalog) can hold several copies of the same instance
+        self.headers = unique_headers(self.headers)
+        filenames = [header["filename"] for header in self.headers]
+        if self.headers:
+            self.series_uid = self.headers[0]["series_uid"]
+
+        # checking the volume cache - a hit skips reading the pixels of the DICOM files entirely
+        self.source_files = filenames
+        if self.volume_cache and self.series_uid:
+            cached = self.volume_cache.lookup(self.series_uid, filenames)
+            if cached:
+                self.load_cached(cached[0], cached[1])
+                return
+
+        headers = sort_headers(self.headers)
+
+        if self.load_mode == "lazy":
+            self.headers = headers
+            self.start_lazy(headers)
+            return
+
+        headers = self.allocate_volume(headers)
+        self.headers = headers
+        if self.load_mode == "stream":
+            self.start_stream(headers)
+            return
+
+        # second pass: decode the pixels of the ordered files on the worker pool straight into their
+        # planes of the volume. The textures are uploaded here as OpenGL calls have to be made from
+        # the thread that owns the context
+        indices = list(range(len(headers)))
+        if self.load_pool == "process":
+            # the results come back from the other processes anyway, so they are copied in as they arrive
+            filenames = [header["filename"] for header in headers]
+            for i, pixelarray in zip(indices, pool_imap(read_dcm_pixels, filenames, self.load_workers, "process")):
+                as_int16(pixelarray, self.volume[i])
+        else:
+            pool_map(self.fill_slice, indices, self.load_workers, "thread")
+        for i in indices:
+            slice = CT_Slice(headers[i]["filename"], headers[i], self.volume[i], self)
+            self.ct_slices.append(slice)
+        self.num_slices = len(self.ct_slices)
+        self.num_loaded = self.num_slices
+        self.store_in_cache()
+
+    # ------------------------------------------------------------------
+    # Function: allocate_volume
+    # Purpose: creates the (slices, rows, columns) volume for the sorted
+    #          headers. Slices that are not the size of most of the series
+    #          can not be part of the volume and are left out. Returns the
+    #          headers that were kept
+    # ------------------------------------------------------------------
+    def allocate_volume(self, headers):
+        shapes = [(header["rows"], header["columns"]) for header in headers]
+        shape = max(set(shapes), key=shapes.count) if shapes else (0, 0)
+        kept = [header for header in headers if (header["rows"], header["columns"]) == shape]
+        if len(kept) < len(headers):
+            log.warning("load", "leaving out {} slices that are not {}x{}", len(headers) - len(kept), shape[0], shape[1])
+
+        # zeros rather than empty so a slice that fails to decode shows up black instead of as garbage
+        self.volume = np.zeros((len(kept), shape[0], shape[1]), dtype=np.int16)
+        self.from_cache = 0
+        return kept
+
+    # decodes a slice into its plane of the volume (safe to call from a background thread). A cached
+    # volume is already filled in so its pages are only read in from the disk
+    def fill_slice(self, index):
+        if self.from_cache:
+            self.volume[index].sum()
+        else:
+            as_int16(read_dcm_pixels(self.headers[index]["filename"]), self.volume[index])
+        return index
+
+    # sets up the scan from a cached volume (the slices are views of the memory mapped volume)
+    def load_cached(self, volume, headers):
+        log.info("cache", "loading {} slices from the volume cache", len(headers))
+        self.volume = volume
+        self.from_cache = 1
+        self.headers = headers
+        self.cache_stored = 1
+        if self.load_mode == "stream":
+            self.start_stream(headers)
+            return
+        if self.load_mode == "lazy":
+            self.start_lazy(headers)
+            return
+
+        for i in range(len(headers)):
+            slice = CT_Slice(headers[i]["filename"], headers[i], volume[i], self)
+            self.ct_slices.append(slice)
+        self.num_slices = len(self.ct_slices)
+        self.num_loaded = self.num_slices
+
+    # writes the fully loaded scan to the volume cache on a background thread
+    def store_in_cache(self):
+        if not self.volume_cache or self.cache_stored or not self.series_uid:
+            return
+        self.cache_stored = 1
+        thread = threading.Thread(target=self.volume_cache.store,
+                                  args=(self.series_uid, self.source_files, self.headers, self.volume),
+                                  daemon=True)
+        thread.start()
+
+    # (lazy) reads the pixels of a slice from the cached volume or from its DICOM file (safe to
+    # call from a background thread)
+    def read_pixels(self, index):
+        if self.volume is not None:
+            pixelarray = self.volume[index]
+        else:
+            pixelarray = as_int16(read_dcm_pixels(self.ct_slices[index].filename))
+        if isinstance(pixelarray, np.memmap):
+            # touching the mapped pages so the disk reads happen on the calling (background) thread
+            # instead of during the texture upload
+            pixelarray.sum()
+        return pixelarray
 
     def load_file(self):
-        slice = CT_Slice(self.curr_folder)
+        # a single file is a volume of one slice
+        header, pixelarray = read_dcm(self.curr_folder)
+        self.volume = np.zeros((1,) + pixelarray.shape, dtype=np.int16)
+        as_int16(pixelarray, self.volume[0])
+        slice = CT_Slice(self.curr_folder, header, self.volume[0], self)
         self.ct_slices.append(slice)
         self.num_slices = 1
+        self.num_loaded = 1
+
+    # creates a slice for every header and starts the background threads that decode them
+    def start_stream(self, headers):
+        self.ct_slices = [CT_Slice(header["filename"], header) for header in headers]
+        self.num_slices = len(self.ct_slices)
+        self.num_loaded = 0
+        self.num_failed = 0
+        # starting in the middle of the series as it is the slice most likely to be looked at first
+        self.curr_slice = self.num_slices // 2
+
+        self.requested = np.zeros(self.num_slices, dtype=bool)
+        self.decoded = queue.Queue()
+        self.stream_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.stream_threads = []
+        if self.num_slices > 0:
+            self.upload_ring = UploadRing(self.volume.shape[1:], self.upload_ring_size)
+        for i in range(max(1, self.load_workers)):
+            thread = threading.Thread(target=self.stream_worker, daemon=True)
+            thread.start()
+            self.stream_threads.append(thread)
+
+    # creates a slice for every header and the caches that the pixels and textures are loaded into
+    def start_lazy(self, headers):
+        self.ct_slices = [CT_Slice(header["filename"], header) for header in headers]
+        self.num_slices = len(self.ct_slices)
+        # every slice can be drawn (it is decoded when it is needed)
+        self.num_loaded = self.num_slices
+        self.num_failed = 0
+
+        self.host_cache = LRUCache(self.host_budget)
+        self.texture_cache = LRUCache(self.gpu_budget, delete_slice_texture)
+        self.pending = {}
+        self.prefetch_pool = ThreadPoolExecutor(max_workers=max(1, self.load_workers))
+        if headers:
+            # slices that are not this size are uploaded directly instead of through the ring
+            self.upload_ring = UploadRing((headers[0]["rows"], headers[0]["columns"]), self.upload_ring_size)
+        self.prefetch(self.curr_slice, 1)
+
+    # returns the pixel array of a slice (in lazy mode it is decoded if it is not cached)
+    def get_pixels(self, index):
+        if self.load_mode != "lazy":
+            return self.volume[index]
+
+        pixelarray = self.host_cache.get(index)
+        if pixelarray is None:
+            # waiting on the prefetch if one was already started for this slice
+            future = self.pending.pop(index, None)
+            pixelarray = None
+            if future:
+                try:
+                    pixelarray, slot = future.result()
+                    if slot is not None:
+                        self.upload_ring.release(slot)
+                except Exception as e:
+                    # a failed prefetch must not take the viewer down from the draw - the file is read again
+                    log.warning("load", "prefetch of {} failed: {}", self.ct_slices[index].filename, e)
+            if pixelarray is None:
+                try:
+                    pixelarray = self.read_pixels(index)
+                except Exception as e:
+                    # kept in the cache as a black slice so it is not tried again every frame
+                    log.error("load", "could not decode {}: {}", self.ct_slices[index].filename, e)
+                    header = self.headers[index]
+                    pixelarray = np.zeros((header["rows"], header["columns"]), dtype=np.int16)
+            self.host_cache.put(index, pixelarray, pixelarray.nbytes)
+        return pixelarray
+
+    # returns the texture of a slice to draw it. Textures the texture manager evicted (or in lazy
+    # mode, textures that are not cached) are created again from the slice's pixels
+    def get_texture(self, index):
+        if self.load_mode != "lazy":
+            slice = self.ct_slices[index]
+            if not slice.TextureID:
+                slice.upload_texture()
+            textures.touch(slice.TextureID)
+            return slice.TextureID
+
+        texture = self.texture_cache.get(index)
+        if texture is None:
+            texture = self.create_lazy_texture(index, self.get_pixels(index))
+        textures.touch(texture)
+        return texture
+
+    # (lazy) creates a slice's texture and puts it in the texture cache. slot is a ring buffer the
+    # pixels were already copied into by a prefetch
+    def create_lazy_texture(self, index, pixelarray, slot=None):
+        def on_evict(texture):
+            self.texture_cache.pop(index)
+
+        if slot is not None:
+            texture = self.upload_ring.upload(slot, lambda pbo: create_slice_texture(pixelarray, self, 1, on_evict, 1))
+        else:
+            texture = create_slice_texture(pixelarray, self, 1, on_evict)
+        self.texture_cache.put(index, texture, slice_texture_bytes(pixelarray))
+        return texture
+
+    # (lazy, background thread) decodes a slice and copies it into a ring buffer if one is free
+    # so its texture can be uploaded without stalling the frame. Returns (pixels, buffer or None)
+    def prefetch_pixels(self, index):
+        pixelarray = self.read_pixels(index)
+        slot = None
+        if self.upload_ring and pixelarray.shape == self.upload_ring.shape:
+            slot = self.upload_ring.acquire()
+            if slot is not None:
+                self.upload_ring.write(slot, pixelarray)
+        return pixelarray, slot
+
+    # (lazy) starts decoding the next prefetch_count slices in the scroll direction in the background
+    def prefetch(self, index, direction):
+        if self.load_mode != "lazy" or self.num_slices == 0:
+            return
+        for i in range(1, min(self.prefetch_count, self.num_slices - 1) + 1):
+            next_index = (index + direction * i) % self.num_slices
+            if next_index in self.host_cache or next_index in self.pending:
+                continue
+            future = self.prefetch_pool.submit(self.prefetch_pixels, next_index)
+            future.add_done_callback(notify_background_load)
+            self.pending[next_index] = future
+
+    # moves to a slice. direction (1 or -1) is the way the user is scrolling and is used to
+    # prefetch the slices they are likely to look at next
+    def set_slice(self, index, direction=1):
+        self.curr_slice = index
+        if self.mpr_view == 1:
+            self.prefetch(index, direction)
+
+    # picks the slice closest to the one being viewed that has not been decoded yet (-1 when done)
+    def next_stream_index(self):
+        with self.stream_lock:
+            remaining = np.flatnonzero(~self.requested)
+            if len(remaining) == 0:
+                return -1
+            index = remaining[np.argmin(np.abs(remaining - self.curr_slice))]
+            self.requested[index] = True
+            return int(index)
+
+    # background thread: decodes slices until every slice is decoded or the scan is closed
+    def stream_worker(self):
+        while not self.stop_event.is_set():
+            index = self.next_stream_index()
+            if index < 0:
+                return
+            slot = None
+            try:
+                self.fill_slice(index)
+                ok = 1
+                # copying the slice into a ring buffer here so the OpenGL thread only has to start the upload
+                slot = self.upload_ring.acquire()
+                if slot is not None:
+                    self.upload_ring.write(slot, self.volume[index])
+            except Exception as e:
+                log.error("load", "could not decode {}: {}", self.ct_slices[index].filename, e)
+                ok = 0
+            self.decoded.put((index, ok, slot))
+            notify_background_load()
+
+    # -----------------------------------------------------------------
+    # Function: update
+    # Purpose: called once a frame from the OpenGL thread. Creates the
+    #          textures for slices that finished decoding in the
+    #          background (for at most upload_budget seconds) and returns
+    #          how many it uploaded. Slices that were copied into a ring
+    #          buffer are uploaded asynchronously from it
+    # -----------------------------------------------------------------
+    def update(self):
+        if self.load_mode == "lazy":
+            return self.update_lazy()
+        if not self.decoded:
+            return 0
+        if self.upload_ring:
+            self.upload_ring.refill()
+        uploaded = 0
+        start = time.perf_counter()
+        while uploaded == 0 or time.perf_counter() - start < self.upload_budget:
+            try:
+                index, ok, slot = self.decoded.get_nowait()
+            except queue.Empty:
+                break
+            if not ok:
+                self.num_failed = self.num_failed + 1
+                continue
+            self.ct_slices[index].set_pixels(self.volume[index], self, self.upload_ring, slot)
+            self.num_loaded = self.num_loaded + 1
+            uploaded = uploaded + 1
+
+        if not self.is_loading():
+            # every slice has streamed in so the ring is not needed any more
+            if self.upload_ring:
+                self.upload_ring.close()
+                self.upload_ring = 0
+            # caching the scan once every slice has streamed in
+            if self.num_loaded == len(self.ct_slices):
+                self.store_in_cache()
+        return uploaded
+
+    # (lazy) moves finished prefetches into the host cache and creates their textures ahead of time
+    # so that scrolling onto them does not have to wait
+    def update_lazy(self):
+        if self.upload_ring:
+            self.upload_ring.refill()
+        uploaded = 0
+        start = time.perf_counter()
+        for index in [i for i, future in self.pending.items() if future.done()]:
+            future = self.pending.pop(index)
+            try:
+                pixelarray, slot = future.result()
+            except Exception as e:
+                log.error("load", "could not decode {}: {}", self.ct_slices[index].filename, e)
+                continue
+            self.host_cache.put(index, pixelarray, pixelarray.nbytes)
+            if index not in self.texture_cache and (uploaded == 0 or time.perf_counter() - start < self.upload_budget):
+                self.create_lazy_texture(index, pixelarray, slot)
+                uploaded = uploaded + 1
+            elif slot is not None:
+                self.upload_ring.release(slot)
+        return uploaded
+
+    # whether update has something to upload (slices that finished loading in the background since
+    # the last frame) - the viewer only draws a new frame when something changed
+    def has_updates(self):
+        if self.load_mode == "lazy":
+            return any(future.done() for future in self.pending.values())
+        return bool(self.decoded) and not self.decoded.empty()
+
+    # whether slices are still being decoded in the background (num_slices is the number of slices
+    # in the current view so the axial slices are counted instead)
+    def is_loading(self):
+        return self.num_loaded + self.num_failed < len(self.ct_slices)
+
+    # whether a given slice can be drawn in the current view
+    def is_slice_loaded(self, index):
+        if self.mpr_view != 1 or self.load_mode == "lazy":
+            return 1
+        return self.ct_slices[index].loaded
+
+    # returns the next slice (step = 1 or -1) that can be drawn, wrapping around at either end
+    # of the scan. Slices that are still streaming in are skipped
+    def step_slice(self, index, step):
+        for i in range(1, self.num_slices + 1):
+            next_index = (index + step * i) % self.num_slices
+            if self.is_slice_loaded(next_index):
+                return next_index
+        return index
+
+    # stops any background loading and frees the lazy caches and every texture of the scan (call
+    # before replacing the scan)
+    def close(self):
+        if self.stop_event:
+            self.stop_event.set()
+        if self.prefetch_pool:
+            for future in self.pending.values():
+                future.cancel()
+            # the ring buffers can only be freed once nothing is writing into them
+            self.prefetch_pool.shutdown(wait=bool(self.upload_ring))
+            self.pending = {}
+        if self.upload_ring:
+            for thread in self.stream_threads:
+                thread.join()
+            self.upload_ring.close()
+            self.upload_ring = 0
+        if self.texture_cache:
+            self.texture_cache.clear()
+        if self.host_cache:
+            self.host_cache.clear()
+        textures.free_owner(self)
+        self.volume_texture = 0
+        self.new_texture_list = []
 
     # height and width of screen to align the CT Screen too
     def set_alignment(self, alignment, height, width):
         # aligning the dicom image to the center of the screen
         if alignment == "center":
-            print("centering")
+            log.debug("view", "centering")
             size = 512  # consider changing
             a1 = (width - size) / 2
             a2 = (width + size) / 2
@@ -220,20 +1087,21 @@ class CTScan:
             self.vertices = np.array(self.vertices, dtype=np.float32)
 
     def draw(self, VBO, EBO):
-        glUseProgram(self.dcm_shader)
-        model_loc = glGetUniformLocation(self.dcm_shader, "model")
-        proj_loc = glGetUniformLocation(self.dcm_shader, "projection")
-        normalization_val_loc = glGetUniformLocation(self.dcm_shader, "normalization_values")
-        slice_loc = glGetUniformLocation(self.dcm_shader, "sliceNumber")
-        exposure_loc = glGetUniformLocation(self.dcm_shader, "sliderVal")
+        # nothing to draw until the slice being viewed has streamed in
+        if not self.is_slice_loaded(self.curr_slice):
+            return
+
+        # the uniforms are only uploaded when their value changed (see Shader_Program)
+        shader = self.dcm_shader
+        shader.use()
         # translating image if necessary
         model = glm.mat4(1)
         model = glm.translate(model, self.translation)  # self.translation)
 
         # used for zooming (need to create panel for button functionality)
         projection = glm.scale(glm.mat4(1), glm.vec3(-self.zoom, -self.zoom, 1))  # used for zooming in and out
-        glUniformMatrix4fv(model_loc, 1, GL_FALSE, glm.value_ptr(model))
-        glUniformMatrix4fv(proj_loc, 1, GL_FALSE, glm.value_ptr(projection))
+        shader.set_mat4("model", model)
+        shader.set_mat4("projection", projection)
 
         # calculating max, slope, and x-intercept for normalization of the image
         # pixArray = self.ct_slices[self.curr_slice].pixelarray
@@ -247,10 +1115,30 @@ class CTScan:
         #glUniform3fv(normalization_val_loc, 1, glm.value_ptr(normalization_val))
 
         # sending slope to shader
-        glUniform1i(slice_loc, self.curr_slice)
+        shader.set_int("sliceNumber", self.curr_slice)
 
         # sending exposure to shader
-        glUniform1f(exposure_loc, self.exposure)
+        shader.set_float("sliderVal", self.exposure)
+
+        # sending the rescale slope and intercept so the shader can convert the stored values to
+        # Hounsfield units (the other views use the first slice's as they cut across every slice)
+        if self.mpr_view == 1:
+            slice = self.ct_slices[self.curr_slice]
+        else:
+            slice = self.ct_slices[0]
+        slope = slice.RescaleSlope if slice.RescaleSlope is not None else 1
+        intercept = slice.RescaleIntercept if slice.RescaleIntercept is not None else 0
+        shader.set_vec2("rescale", slope, intercept)
+
+        # simulated noise (the table is only needed by the inverse-CDF mode and lives on texture unit 2)
+        shader.set_int("noiseMode", self.noise_mode)
+        view_size = self.view_size()
+        shader.set_ivec2("viewSize", view_size[0], view_size[1])
+        shader.set_vec2("tableShape", TABLE_STEPS, TABLE_MAX_LAMBDA)
+        if self.noise_mode == NOISE_TABLE and self.noise_table:
+            glActiveTexture(GL_TEXTURE2)
+            glBindTexture(GL_TEXTURE_2D, self.noise_table)
+            glActiveTexture(GL_TEXTURE0)
 
         # ------------
         # Binding Vertex Buffer Object
@@ -274,83 +1162,91 @@ class CTScan:
         glVertexAttribPointer(2, 2, GL_FLOAT, GL_FALSE, self.vertices.itemsize * 7, ctypes.c_void_p(20))
 
         # binding the texture
-
-        if self.mpr_view == 1:
-            glBindTexture(GL_TEXTURE_2D, self.ct_slices[self.curr_slice].TextureID)
+        shader.set_int("mprView", self.mpr_view)
+        if self.mpr_view != 1 and self.volume_texture:
+            # the shader picks the plane out of the 3D texture (on texture unit 1)
+            shader.set_int("useVolume", 1)
+            shader.set_float("slicePosition", (self.curr_slice + 0.5) / self.num_slices)
+            glActiveTexture(GL_TEXTURE1)
+            glBindTexture(GL_TEXTURE_3D, self.volume_texture)
+            glActiveTexture(GL_TEXTURE0)
         else:
-            glBindTexture(GL_TEXTURE_2D, self.new_texture_list[self.curr_slice])
+            shader.set_int("useVolume", 0)
+            if self.mpr_view == 1:
+                glBindTexture(GL_TEXTURE_2D, self.get_texture(self.curr_slice))
+            else:
+                glBindTexture(GL_TEXTURE_2D, self.new_texture_list[self.curr_slice])
         # ------------
         # drawing to the screen
         glDrawElements(GL_TRIANGLES, len(self.indices), GL_UNSIGNED_INT, None)
 
-    def change_view(self, view=1):
-        print("changing view from {} to {}".format(self.mpr_view, view))
-        self.mpr_view = view
-        arr1 = []
+    # -----------------------------------------------------------------
+    # Function: change_view
+    # Purpose: switches between the axial (1), coronal (2) and sagittal
+    #          (3) views. The first switch uploads the volume as a 3D
+    #          texture, after that changing views only changes what the
+    #          shader samples. curr_slice is kept within the new view
+    # -----------------------------------------------------------------
+    # returns (columns, rows) of the image shown in the current view
+    def view_size(self):
+        if self.volume is not None:
+            depth, rows, cols = self.volume.shape
+        else:
+            depth, rows, cols = len(self.ct_slices), self.headers[0]["rows"], self.headers[0]["columns"]
+        if self.mpr_view == 2:
+            return cols, depth
+        if self.mpr_view == 3:
+            return rows, depth
+        return cols, rows
 
-        for k in range(len(self.ct_slices)):
-            arr1.append(self.ct_slices[k].pixelarray)
-        newarr = np.stack(arr1, axis=0).astype("int16")
+    def change_view(self, view=1):
+        # the other views need every slice
+        if self.is_loading():
+            log.warning("view", "can not change view while the scan is loading")
+            return
+        log.info("view", "changing view from {} to {}", self.mpr_view, view)
 
-        self.num_slices = newarr.shape[view - 1]
-        # Axial
-        if view == 1:
-            z = 0
-            y = 2
-            x = 1
-        # Coronal
-        elif view == 2:
-            z = 1
-            y = 2
-            x = 0
-            # rotating image by 90 degrees as it is upside down
-            newarr = np.rot90(newarr, 2, (0, 1))
-        # Sagittal
-        elif view == 3:
-            z = 2
-            y = 1
-            x = 0
-            # rotating image by 90 degrees as it is upside down
-            newarr = np.rot90(newarr, 2, (0, 1))
-            newarr = np.flip(newarr, 1)
-        print(newarr.shape)
-        texture_list = []
+        if self.volume is not None:
+            newarr = self.volume
+        else:
+            # lazy scans do not keep a volume so it has to be put together from the slices
+            newarr = np.stack([self.get_pixels(k) for k in range(len(self.ct_slices))], axis=0).astype("int16")
 
         # Usage Instructions----
         #          Z,Y,X
         # Axial:   0,2,1 - newarr[i,:,:]
         # Coronal  1,2,0 - newarr[:, i, :]
         # Sagittal 2,1,0 - newarr[:,:,i]
-        for i in range(newarr.shape[z]):
-            texture = glGenTextures(1)
-            glBindTexture(GL_TEXTURE_2D, texture)
-
-            if view == 1:
-                glTexImage2D(GL_TEXTURE_2D, 0, GL_R16F, newarr.shape[y], newarr.shape[x], 0, GL_RED, GL_FLOAT,
-                             newarr[i, :, :])
-            elif view == 2:
-                glTexImage2D(GL_TEXTURE_2D, 0, GL_R16F, newarr.shape[y], newarr.shape[x], 0, GL_RED, GL_FLOAT,
-                             newarr[:, i, :])
-            elif view == 3:
-                glTexImage2D(GL_TEXTURE_2D, 0, GL_R16F, newarr.shape[y], newarr.shape[x], 0, GL_RED, GL_FLOAT,
-                             newarr[:, :, i])
-            # input('freezing a')
-            # Set the texture wrapping parameters
-            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
-            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)
-            # Set texture filtering parameters
-            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
-            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
-
-            # saving texture ID to be used later for the Draw Function
-            texture_list.append(texture)
+        self.mpr_view = view
+        self.num_slices = newarr.shape[view - 1]
+        self.curr_slice = min(self.curr_slice, self.num_slices - 1)
+        if view == 1 or self.volume_texture:
+            return
 
-            glBindTexture(GL_TEXTURE_2D, 0)
+        self.volume_texture = create_volume_texture(newarr, self)
+        if self.volume_texture:
+            return
 
-            self.new_texture_list = texture_list
+        # the volume does not fit in a 3D texture so the view is made out of 2D textures instead
+        # (the images are rotated and flipped the same way the shader does it for the 3D texture)
+        for texture in self.new_texture_list:
+            textures.delete(texture)
+        if view == 2:
+            newarr = np.rot90(newarr, 2, (0, 1))
+        elif view == 3:
+            newarr = np.rot90(newarr, 2, (0, 1))
+            newarr = np.flip(newarr, 1)
+        texture_list = []
+        for i in range(newarr.shape[view - 1]):
+            if view == 2:
+                image = newarr[:, i, :]
+            elif view == 3:
+                image = newarr[:, :, i]
+            texture_list.append(create_slice_texture(np.ascontiguousarray(image), self))
+        self.new_texture_list = texture_list
 
 
-# this class stores information about individual ct slices
+# this class stores information about individual ct slices (the pixels are a view of the scan's volume)
 class CT_Slice:
     filename = 0
     TextureID = 0
@@ -360,12 +1256,22 @@ class CT_Slice:
     RescaleSlope = 0
     RescaleIntercept = 0
     pixelarray = 0
+    loaded = 0  # whether the pixels have been decoded and the texture created
+    owner = 0  # the CTScan the slice's texture is freed with
 
     # Size  # I dont know if this is needed?
 
-    def __init__(self, filename):
+    # header and pixelarray can be passed in when the file was already read (ie. by scan_headers and
+    # read_dcm_pixels). Passing only the header creates a slice whose pixels are set later with set_pixels
+    def __init__(self, filename, header=None, pixelarray=None, owner=0):
         self.filename = filename
-        self.load_dcm(filename)
+        self.owner = owner
+        if header is None:
+            self.load_dcm(filename)
+            return
+        self.set_header(header)
+        if pixelarray is not None:
+            self.set_pixels(pixelarray, owner)
 
     def load_dcm(self, filename):
         # deprecated code -- usable but is very slow
@@ -376,37 +1282,42 @@ class CT_Slice:
         # # Specifying 2D image (DICOM) to be mapped to the screen (Format: Single Channel)
         # glTexImage2D(GL_TEXTURE_2D, 0, GL_RED, normal.shape[0], normal.shape[1], 0, GL_RED, GL_FLOAT, normal)
 
-        ds = pydicom.dcmread(filename)
-
         # abc = str(ds)  # to get all of the data tags
+        header, pixelarray = read_dcm(filename)
+        self.set_header(header)
+        self.set_pixels(pixelarray, self.owner)
 
-        self.slice_location = ds.get("SliceLocation")
-        self.patient_id = ds.get("PatientID")
-        self.study_date = ds.get("StudyDate")
-        self.RescaleSlope = ds.get("RescaleSlope")
-        self.RescaleIntercept = ds.get("RescaleIntercept")
-
-        normal = ds.pixel_array
+    # stores the header information read from the DICOM file
+    def set_header(self, header):
+        self.slice_location = header["slice_location"]
+        self.patient_id = header["patient_id"]
+        self.study_date = header["study_date"]
+        self.RescaleSlope = header["RescaleSlope"]
+        self.RescaleIntercept = header["RescaleIntercept"]
 
-        self.pixelarray = normal
-       # print("rows: {}, col: {}".format(normal.shape[0], normal.shape[1]))
-        texture = glGenTextures(1)
-        glBindTexture(GL_TEXTURE_2D, texture)
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_R16F, normal.shape[0], normal.shape[1], 0, GL_RED, GL_FLOAT, normal)
+    # stores the decoded pixel data and creates its texture (must be called on the OpenGL thread).
+    # slot is a buffer of the upload ring the pixels were already copied into (see Upload_Ring)
+    def set_pixels(self, pixelarray, owner=0, ring=None, slot=None):
+        self.pixelarray = pixelarray
+        self.owner = owner
+        self.upload_texture(ring, slot)
+        self.loaded = 1
 
-        # input('freezing a')
-        # Set the texture wrapping parameters
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)
-        # Set texture filtering parameters
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+    # creates the OpenGL texture for the slice (must be called on the thread that owns the context)
+    def upload_texture(self, ring=None, slot=None):
+        # saving texture ID to be used later for the Draw Function. The texture manager can evict
+        # it when the GPU budget runs out as it is easy to create again from pixelarray
+        if slot is not None:
+            self.TextureID = ring.upload(slot, lambda pbo: create_slice_texture(self.pixelarray, self.owner, 1,
+                                                                                 self.evict_texture, 1))
+        else:
+            self.TextureID = create_slice_texture(self.pixelarray, self.owner, 1, self.evict_texture)
 
-        # saving texture ID to be used later for the Draw Function
-        self.TextureID = texture
+    # called by the texture manager after it deleted this slice's texture
+    def evict_texture(self, texture):
+        if self.TextureID == texture:
+            self.TextureID = 0
 
         # come back to me
         # storing size of the image (likely width by height but not sure)
         # self.Size = glm.vec2(normal.shape[0], normal.shape[1])
-
-        glBindTexture(GL_TEXTURE_2D, 0)
@@ -0,0 +1,137 @@
+# --------------------
+# File: Shader_Program.py
+# Purpose: A wrapper around an OpenGL shader program that looks up the locations of all of
+#          its uniforms and attributes once when it is compiled, only switches programs when a
+#          different one is in use and only uploads a uniform when its value changed. It also
+#          counts the state changes each frame so the cost of drawing can be checked.
+# Author: Jacob Knop
+# Date: Summer 2020
+# --------------------
+
+# external dependencies
+from OpenGL.GL import *
+from OpenGL.GL.shaders import compileProgram, compileShader
+import glm
+
+
+# -----------------------------------------------------------------------
+# Class: ShaderState
+# Purpose: The program that is in use (every program switch has to go
+#          through ShaderProgram.use for this to be right) and the number
+#          of state changes made this frame and last frame
+# Elements:
+#    current - the ShaderProgram in use (0 if none)
+#    program_changes - glUseProgram calls this frame
+#    uniform_uploads - glUniform calls this frame
+#    uniforms_skipped - uniform uploads that were skipped because the value
+#                       had not changed
+#    last_frame - (program_changes, uniform_uploads, uniforms_skipped) of the
+#                 last frame that was finished with end_frame
+# -----------------------------------------------------------------------
+class ShaderState:
+    current = 0
+    program_changes = 0
+    uniform_uploads = 0
+    uniforms_skipped = 0
+    last_frame = (0, 0, 0)
+
+    # called once the frame is drawn - keeps its counts in last_frame and starts counting again
+    def end_frame(self):
+        self.last_frame = (self.program_changes, self.uniform_uploads, self.uniforms_skipped)
+        self.program_changes = 0
+        self.uniform_uploads = 0
+        self.uniforms_skipped = 0
+
+    # prints the state changes of the last frame
+    def print_report(self):
+        print("last frame: {} program changes, {} uniform uploads, {} uniform uploads skipped".format(
+            *self.last_frame))
+
+
+# what every ShaderProgram uses to keep track of the program in use
+state = ShaderState()
+
+
+# -----------------------------------------------------------------------
+# Class: ShaderProgram
+# Purpose: Compiles a vertex and fragment shader into a program and sets
+#          its uniforms by name. Uniforms that are not in the program (or
+#          that the compiler removed because they are not used) are ignored
+# Elements:
+#    program - the OpenGL program ID
+#    name - name to show in reports
+#    uniforms - uniform name -> location
+#    attributes - attribute name -> location
+# -----------------------------------------------------------------------
+class ShaderProgram:
+    program = 0
+    name = 0
+
+    def __init__(self, vertex_src, fragment_src, name=""):
+        self.program = compileProgram(compileShader(vertex_src, GL_VERTEX_SHADER),
+                                      compileShader(fragment_src, GL_FRAGMENT_SHADER))
+        self.name = name
+        self.uniforms = {}
+        self.attributes = {}
+        self.values = {}  # uniform location -> last value uploaded (as a hashable key)
+
+        for i in range(glGetProgramiv(self.program, GL_ACTIVE_UNIFORMS)):
+            uniform = glGetActiveUniform(self.program, i)[0].decode()
+            # arrays are listed by their first element (ie. "weights[0]")
+            uniform = uniform.split("[")[0]
+            self.uniforms[uniform] = glGetUniformLocation(self.program, uniform)
+        for i in range(glGetProgramiv(self.program, GL_ACTIVE_ATTRIBUTES)):
+            attribute = glGetActiveAttrib(self.program, i)[0].decode()
+            self.attributes[attribute] = glGetAttribLocation(self.program, attribute)
+
+    # makes this the program in use (nothing is done if it already is)
+    def use(self):
+        if state.current is not self:
+            glUseProgram(self.program)
+            state.current = self
+            state.program_changes = state.program_changes + 1
+
+    # returns the location of an attribute (-1 if it is not in the program)
+    def attribute(self, name):
+        return self.attributes.get(name, -1)
+
+    # ------------------------------------------------------------------
+    # Function: set_uniform
+    # Purpose: calls upload(location, *args) with the program in use unless
+    #          the uniform already holds key (a hashable copy of the value).
+    #          The set_ functions below call it for each type of uniform
+    # ------------------------------------------------------------------
+    def set_uniform(self, name, key, upload, *args):
+        location = self.uniforms.get(name, -1)
+        if location < 0:
+            return
+        if self.values.get(location) == key:
+            state.uniforms_skipped = state.uniforms_skipped + 1
+            return
+        self.use()
+        upload(location, *args)
+        self.values[location] = key
+        state.uniform_uploads = state.uniform_uploads + 1
+
+    def set_int(self, name, value):
+        value = int(value)
+        self.set_uniform(name, value, glUniform1i, value)
+
+    def set_float(self, name, value):
+        value = float(value)
+        self.set_uniform(name, value, glUniform1f, value)
+
+    def set_vec2(self, name, x, y):
+        key = (float(x), float(y))
+        self.set_uniform(name, key, glUniform2f, *key)
+
+    def set_ivec2(self, name, x, y):
+        key = (int(x), int(y))
+        self.set_uniform(name, key, glUniform2i, *key)
+
+    def set_vec4(self, name, vector):
+        key = tuple(float(v) for v in vector)
+        self.set_uniform(name, key, glUniform4f, *key)
+
+    def set_mat4(self, name, matrix):
+        self.set_uniform(name, matrix.to_tuple(), glUniformMatrix4fv, 1, GL_FALSE, glm.value_ptr(matrix))
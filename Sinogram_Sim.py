@@ -0,0 +1,210 @@
+# --------------------
+# File: Sinogram_Sim.py
+# Purpose: Low dose simulation in the projection domain. Slices are turned into attenuation,
+#          forward projected into parallel beam sinograms, Poisson noise is added to the
+#          photon counts that reach the detector and the noise is reconstructed back into the
+#          image with filtered back projection (FBP). Unlike the per pixel noise of the shader
+#          this gives the streaky, correlated noise texture of a real low dose scan.
+# Author: Jacob Knop
+# Date: Summer 2020
+# --------------------
+
+# external dependencies
+import numpy as np
+
+# linear attenuation coefficient of water (per mm, around 70 keV) - 0 HU
+MU_WATER = 0.0193
+
+# number of projection angles (over 180 degrees) used when none is given
+DEFAULT_ANGLES = 720
+
+# reconstruction filters - the ramp filter times a window that tames the high frequencies
+FILTERS = ["ramp", "shepp-logan", "hann"]
+
+
+# -----------------------------------------------------------------------
+# Class: ParallelBeamGeometry
+# Purpose: Everything about the scanner that only depends on the image size
+#          and the number of angles: pixel positions, angle cosines and
+#          sines, detector size and the reconstruction filters. It is made
+#          once per image size and angle count (see get_geometry) and then
+#          projects and back projects batches of slices at a time. The
+#          detector bins each pixel falls on are worked out one angle at a
+#          time for the whole batch - keeping them for every angle would take
+#          over a gigabyte for 512 x 512 slices
+# Elements:
+#    shape - (rows, columns) of the slices
+#    angles - number of projection angles over 180 degrees
+#    detectors - number of detector bins (one pixel wide, covering the diagonal)
+#    fft_size - length the projections are padded to for filtering
+# -----------------------------------------------------------------------
+class ParallelBeamGeometry:
+    shape = (0, 0)
+    angles = 0
+    detectors = 0
+    fft_size = 0
+
+    def __init__(self, shape, angles=DEFAULT_ANGLES):
+        self.shape = tuple(shape)
+        self.angles = angles
+        rows, cols = self.shape
+
+        # pixel centers (in pixels) from the middle of the image, y pointing up
+        y, x = np.mgrid[0:rows, 0:cols].astype(np.float32)
+        self.x = (x - (cols - 1) / 2).ravel()
+        self.y = ((rows - 1) / 2 - y).ravel()
+
+        theta = np.arange(angles) * np.pi / angles
+        self.cos = np.cos(theta).astype(np.float32)
+        self.sin = np.sin(theta).astype(np.float32)
+
+        # wide enough that a pixel and the bin after it are always on the detector
+        self.detectors = int(np.ceil(np.hypot(rows, cols))) + 3
+        self.center = (self.detectors - 1) / 2
+        self.fft_size = 1 << int(np.ceil(np.log2(2 * self.detectors)))
+        self.filters = {}
+
+    # returns the detector bin left of every pixel's projection and how far along to the next bin it is
+    def bins(self, angle):
+        t = self.x * self.cos[angle] + self.y * self.sin[angle] + np.float32(self.center)
+        left = np.floor(t)
+        return left.astype(np.intp), t - left
+
+    # ------------------------------------------------------------------
+    # Function: project
+    # Purpose: forward projects a batch of slices (slices, rows, columns)
+    #          into sinograms (slices, angles, detectors). Each pixel is
+    #          split between the two detector bins its center falls between
+    # ------------------------------------------------------------------
+    def project(self, images):
+        batch = images.shape[0]
+        # bincount sums in float64 so the weights are made in float64 to begin with
+        flat = images.reshape(batch, -1).astype(np.float64)
+        size = batch * self.detectors
+        offsets = (np.arange(batch) * self.detectors)[:, None]
+        sinograms = np.empty((batch, self.angles, self.detectors), dtype=np.float32)
+        for angle in range(self.angles):
+            left, frac = self.bins(angle)
+            right_weights = flat * frac
+            index = (left + offsets).ravel()
+            projection = np.bincount(index, (flat - right_weights).ravel(), size)
+            projection[1:] += np.bincount(index, right_weights.ravel(), size)[:-1]
+            sinograms[:, angle] = projection.reshape(batch, self.detectors)
+        return sinograms
+
+    # ------------------------------------------------------------------
+    # Function: back_project
+    # Purpose: the opposite of project - smears each (filtered) projection
+    #          back across the image, with the same weights, and sums the
+    #          angles. Returns (slices, rows, columns)
+    # ------------------------------------------------------------------
+    def back_project(self, sinograms):
+        batch = sinograms.shape[0]
+        images = np.zeros((batch, self.x.size), dtype=np.float32)
+        for angle in range(self.angles):
+            left, frac = self.bins(angle)
+            projection = sinograms[:, angle]
+            below = np.take(projection, left, axis=1)
+            above = np.take(projection[:, 1:], left, axis=1)
+            above -= below
+            above *= frac
+            above += below
+            images += above
+        return images.reshape((batch,) + self.shape) * np.float32(np.pi / self.angles)
+
+    # returns the frequency response of a reconstruction filter (made the first time it is used)
+    def get_filter(self, name):
+        response = self.filters.get(name)
+        if response is None:
+            if name not in FILTERS:
+                raise ValueError("unknown filter {} (use one of {})".format(name, ", ".join(FILTERS)))
+            # the ramp filter in space (Ram-Lak) so its zero frequency comes out right on a finite detector
+            n = np.fft.fftfreq(self.fft_size) * self.fft_size
+            kernel = np.zeros(self.fft_size)
+            kernel[n == 0] = 0.25
+            odd = n % 2 == 1
+            kernel[odd] = -1 / (np.pi * n[odd]) ** 2
+            response = np.fft.rfft(kernel).real
+            frequency = np.fft.rfftfreq(self.fft_size)
+            if name == "shepp-logan":
+                response = response * np.sinc(frequency)
+            elif name == "hann":
+                response = response * 0.5 * (1 + np.cos(2 * np.pi * frequency))
+            response = response.astype(np.float32)
+            self.filters[name] = response
+        return response
+
+    # filters a batch of sinograms along the detector
+    def filter(self, sinograms, name="shepp-logan"):
+        spectrum = np.fft.rfft(sinograms, self.fft_size, axis=-1) * self.get_filter(name)
+        return np.fft.irfft(spectrum, self.fft_size, axis=-1)[..., :self.detectors].astype(np.float32)
+
+    # filtered back projection of a batch of sinograms
+    def reconstruct(self, sinograms, filter_name="shepp-logan"):
+        return self.back_project(self.filter(sinograms, filter_name))
+
+
+geometries = {}  # (rows, columns, angles) -> ParallelBeamGeometry
+
+
+# returns the geometry for a slice size and number of angles (made the first time it is asked for)
+def get_geometry(shape, angles=DEFAULT_ANGLES):
+    key = (shape[0], shape[1], angles)
+    geometry = geometries.get(key)
+    if geometry is None:
+        geometry = ParallelBeamGeometry(shape, angles)
+        geometries[key] = geometry
+    return geometry
+
+
+# ------------------------------------------------------------
+# function: sinogram_noise
+# purpose: simulates a scan of a batch of slices with incident_photons
+#          photons per detector bin and returns the reconstructed noise in
+#          HU (slices, rows, columns). The photon counts are Poisson and
+#          their log is taken like a scanner does (bins that see no photons
+#          count as one). FBP is linear so reconstructing the difference
+#          between the noisy and the clean sinogram gives just the noise,
+#          which is added to the original slices to keep their resolution
+# parameters: hu, incident_photons, pixel_size, angles, filter_name, rngs
+# 1. hu               - (slices, rows, columns) Hounsfield units
+# 2. incident_photons - photons per detector bin per angle with nothing in
+#                       the way (the dose - lower means more noise)
+# 3. pixel_size       - pixel spacing in mm
+# 4. angles           - number of projection angles
+# 5. filter_name      - reconstruction filter (see FILTERS)
+# 6. rngs             - one numpy random Generator per slice
+# ------------------------------------------------------------
+def sinogram_noise(hu, incident_photons, pixel_size, angles, filter_name, rngs):
+    geometry = get_geometry(hu.shape[1:], angles)
+    # attenuation through each pixel (air and anything below it attenuates nothing)
+    mu = np.maximum(MU_WATER * (1 + hu.astype(np.float32) / 1000), 0) * np.float32(pixel_size)
+    sinograms = geometry.project(mu)
+
+    noise = np.empty_like(sinograms)
+    for i in range(len(sinograms)):
+        expected = incident_photons * np.exp(-sinograms[i].astype(np.float64))
+        counts = np.maximum(rngs[i].poisson(expected), 1)
+        noise[i] = np.log(incident_photons / counts) - sinograms[i]
+
+    # back to HU
+    return geometry.reconstruct(noise, filter_name) * np.float32(1000 / (MU_WATER * pixel_size))
+
+
+# ------------------------------------------------------------
+# function: sinogram_volume
+# purpose: adds projection domain low dose noise to a volume of Hounsfield
+#          units, chunk slices at a time, and returns the noisy HU
+#          (float32). Each slice gets its own random numbers from
+#          (seed, slice number) so the result does not depend on chunk
+# parameters: hu, incident_photons, pixel_size, angles, filter_name,
+#             first_slice, seed, chunk
+# ------------------------------------------------------------
+def sinogram_volume(hu, incident_photons, pixel_size=1.0, angles=DEFAULT_ANGLES, filter_name="shepp-logan",
+                    first_slice=0, seed=0, chunk=8):
+    noisy = np.empty(hu.shape, dtype=np.float32)
+    for z in range(0, hu.shape[0], chunk):
+        block = hu[z:z + chunk]
+        rngs = [np.random.default_rng([seed, first_slice + z + i]) for i in range(len(block))]
+        noisy[z:z + chunk] = block + sinogram_noise(block, incident_photons, pixel_size, angles, filter_name, rngs)
+    return noisy
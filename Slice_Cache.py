@@ -0,0 +1,76 @@
+# --------------------
+# File: Slice_Cache.py
+# Purpose: A least recently used (LRU) cache with a size limit in bytes. Used by CTScan
+#          to hold decoded pixel arrays (host memory) and slice textures (GPU memory) when
+#          a scan is loaded lazily.
+# Author: Jacob Knop
+# Date: Summer 2020
+# --------------------
+
+# external dependencies
+from collections import OrderedDict
+
+
+# -----------------------------------------------------------------------
+# Class: LRUCache
+# Purpose: Stores values along with how many bytes they take up. When the
+#          total goes over the budget the least recently used values are
+#          thrown out (on_evict is called for each so that resources like
+#          textures can be freed). Not thread safe - only use it from one
+#          thread.
+# Elements:
+#    budget - maximum number of bytes the cache should hold
+#    size - number of bytes the cache is currently holding
+#    on_evict - function(key, value) called when a value leaves the cache
+# -----------------------------------------------------------------------
+class LRUCache:
+    budget = 0
+    size = 0
+    on_evict = 0
+
+    def __init__(self, budget, on_evict=None):
+        self.budget = budget
+        self.size = 0
+        self.on_evict = on_evict
+        self.entries = OrderedDict()  # key -> (value, nbytes), least recently used first
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    # returns the value for key (or None) and marks it as the most recently used
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    # adds a value to the cache and evicts the least recently used values until the cache is
+    # back within its budget (the value just added is always kept)
+    def put(self, key, value, nbytes):
+        if key in self.entries:
+            self.pop(key)
+        self.entries[key] = (value, nbytes)
+        self.size = self.size + nbytes
+
+        while self.size > self.budget and len(self.entries) > 1:
+            old_key = next(iter(self.entries))
+            self.pop(old_key)
+
+    # removes a value from the cache (calling on_evict) and returns it
+    def pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        self.size = self.size - entry[1]
+        if self.on_evict:
+            self.on_evict(key, entry[0])
+        return entry[0]
+
+    # empties the cache
+    def clear(self):
+        for key in list(self.entries):
+            self.pop(key)
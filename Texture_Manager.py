@@ -0,0 +1,147 @@
+# --------------------
+# File: Texture_Manager.py
+# Purpose: Keeps track of every OpenGL texture the viewer creates (how many bytes it takes
+#          up on the GPU and which object it belongs to) so that textures are freed when
+#          their owner goes away, slice textures can be thrown out when the GPU budget is
+#          used up, and the current GPU memory use can be looked up.
+# Author: Jacob Knop
+# Date: Summer 2020
+# --------------------
+
+# external dependencies
+from OpenGL.GL import *
+
+
+# -----------------------------------------------------------------------
+# Class: TextureInfo
+# Purpose: What the manager knows about one texture
+# Elements:
+#    owner - object the texture belongs to (ie. a CTScan or a Text)
+#    nbytes - bytes the texture takes up on the GPU
+#    evictable - whether the texture can be deleted to stay within the
+#                budget (it has to be possible to create it again)
+#    on_evict - function(texture) called after an evictable texture is
+#               deleted so its owner stops using it
+#    last_used - value of the manager's counter when it was last drawn
+# -----------------------------------------------------------------------
+class TextureInfo:
+    owner = 0
+    nbytes = 0
+    evictable = 0
+    on_evict = 0
+    last_used = 0
+
+    def __init__(self, owner, nbytes, evictable, on_evict, last_used):
+        self.owner = owner
+        self.nbytes = nbytes
+        self.evictable = evictable
+        self.on_evict = on_evict
+        self.last_used = last_used
+
+
+# -----------------------------------------------------------------------
+# Class: TextureManager
+# Purpose: Creates and deletes textures for the rest of the viewer. When
+#          the bytes in use go over the budget the least recently drawn
+#          evictable textures (slice textures that can be made again from
+#          the scan's volume) are deleted. Only use it from the OpenGL thread
+# Elements:
+#    budget - bytes of textures to keep on the GPU before evicting
+#    size - bytes of textures currently on the GPU
+# -----------------------------------------------------------------------
+class TextureManager:
+    budget = 0
+    size = 0
+
+    def __init__(self, budget=2 * 1024 * 1024 * 1024):
+        self.budget = budget
+        self.size = 0
+        self.textures = {}  # texture ID -> TextureInfo
+        self.owners = {}  # id(owner) -> set of texture IDs
+        self.counter = 0  # counts up every time a texture is created or drawn
+
+    # ------------------------------------------------------------------
+    # Function: create
+    # Purpose: generates a texture for owner and returns its ID. nbytes is
+    #          the size of the image that will be stored in it. Evictable
+    #          textures may be deleted later on to make room (on_evict is
+    #          called when that happens)
+    # ------------------------------------------------------------------
+    def create(self, owner, nbytes, evictable=0, on_evict=None):
+        texture = int(glGenTextures(1))
+        self.counter = self.counter + 1
+        self.textures[texture] = TextureInfo(owner, nbytes, evictable, on_evict, self.counter)
+        self.owners.setdefault(id(owner), set()).add(texture)
+        self.size = self.size + nbytes
+        self.evict(texture)
+        return texture
+
+    # marks a texture as drawn so it is the last to be evicted
+    def touch(self, texture):
+        info = self.textures.get(texture)
+        if info:
+            self.counter = self.counter + 1
+            info.last_used = self.counter
+
+    # deletes a texture (textures the manager does not know about, or already deleted, are ignored)
+    def delete(self, texture):
+        info = self.textures.pop(texture, None)
+        if info is None:
+            return None
+        self.size = self.size - info.nbytes
+        owned = self.owners.get(id(info.owner))
+        if owned is not None:
+            owned.discard(texture)
+            if not owned:
+                del self.owners[id(info.owner)]
+        glDeleteTextures([texture])
+        return info
+
+    # deletes every texture that belongs to owner (ie. when a scan is closed)
+    def free_owner(self, owner):
+        for texture in list(self.owners.get(id(owner), ())):
+            self.delete(texture)
+
+    # deletes the least recently drawn evictable textures until the manager is within its budget
+    # (keep is a texture that must not be deleted, ie. the one that was just created)
+    def evict(self, keep=0):
+        if self.size <= self.budget:
+            return
+        candidates = [(info.last_used, texture) for texture, info in self.textures.items()
+                      if info.evictable and texture != keep]
+        candidates.sort()
+        for last_used, texture in candidates:
+            if self.size <= self.budget:
+                break
+            info = self.delete(texture)
+            if info.on_evict:
+                info.on_evict(texture)
+
+    # ------------------------------------------------------------------
+    # Function: usage
+    # Purpose: returns the bytes of textures on the GPU (for one owner if
+    #          it is given, otherwise for everything)
+    # ------------------------------------------------------------------
+    def usage(self, owner=None):
+        if owner is None:
+            return self.size
+        return sum(self.textures[texture].nbytes for texture in self.owners.get(id(owner), ()))
+
+    # returns [(owner type, number of textures, bytes)] for every owner, largest first
+    def report(self):
+        rows = []
+        for owned in self.owners.values():
+            owner = self.textures[next(iter(owned))].owner
+            rows.append((type(owner).__name__, len(owned), sum(self.textures[t].nbytes for t in owned)))
+        rows.sort(key=lambda row: -row[2])
+        return rows
+
+    # prints the GPU memory use by owner
+    def print_report(self):
+        print("textures: {:.1f} MB of {:.1f} MB".format(self.size / 1048576, self.budget / 1048576))
+        for name, count, nbytes in self.report():
+            print("  {}: {} textures, {:.1f} MB".format(name, count, nbytes / 1048576))
+
+
+# the manager every part of the viewer creates its textures through
+textures = TextureManager()
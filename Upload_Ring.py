@@ -0,0 +1,137 @@
+# --------------------
+# File: Upload_Ring.py
+# Purpose: A ring of pixel buffer objects (PBOs) for sending slices to the GPU without
+#          stalling the frame. Background threads copy decoded slices straight into mapped
+#          buffers and the OpenGL thread then starts the texture upload from the buffer, which
+#          the driver finishes on its own time. Fences tell when a buffer can be reused.
+# Author: Jacob Knop
+# Date: Summer 2020
+# --------------------
+
+# external dependencies
+from OpenGL.GL import *
+import numpy as np
+import ctypes
+import queue
+
+
+# -----------------------------------------------------------------------
+# Class: UploadSlot
+# Purpose: One buffer of the ring
+# Elements:
+#    pbo - the pixel buffer object
+#    array - numpy view of the buffer while it is mapped (None otherwise)
+#    fence - sync object of the last upload from the buffer (0 if none)
+# -----------------------------------------------------------------------
+class UploadSlot:
+    pbo = 0
+    array = None
+    fence = 0
+
+    def __init__(self, pbo):
+        self.pbo = pbo
+
+
+# -----------------------------------------------------------------------
+# Class: UploadRing
+# Purpose: Hands mapped buffers to background threads (acquire, write) and
+#          turns the filled buffers into textures on the OpenGL thread
+#          (upload). refill must be called every frame on the OpenGL thread
+#          to map the buffers whose uploads have finished again. Only
+#          refill, upload and close make OpenGL calls
+# Elements:
+#    shape - (rows, columns) of the slices the buffers hold
+#    nbytes - size of each buffer
+# -----------------------------------------------------------------------
+class UploadRing:
+    shape = (0, 0)
+    nbytes = 0
+
+    def __init__(self, shape, count=8):
+        self.shape = tuple(shape)
+        self.nbytes = self.shape[0] * self.shape[1] * 2  # int16 pixels
+        self.slots = []
+        self.ready = queue.Queue()  # mapped buffers waiting for a background thread to fill them
+        self.unmapped = []  # buffers that are not mapped and have no upload in progress
+        self.in_flight = []  # buffers the GPU may still be reading from
+
+        for pbo in np.atleast_1d(glGenBuffers(count)):
+            slot = UploadSlot(int(pbo))
+            glBindBuffer(GL_PIXEL_UNPACK_BUFFER, slot.pbo)
+            glBufferData(GL_PIXEL_UNPACK_BUFFER, self.nbytes, None, GL_STREAM_DRAW)
+            self.slots.append(slot)
+            self.unmapped.append(slot)
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+        self.refill()
+
+    # (OpenGL thread) maps the buffers that are free again so background threads can fill them
+    def refill(self):
+        still_in_flight = []
+        for slot in self.in_flight:
+            status = glClientWaitSync(slot.fence, 0, 0)
+            if status == GL_ALREADY_SIGNALED or status == GL_CONDITION_SATISFIED:
+                glDeleteSync(slot.fence)
+                slot.fence = 0
+                self.unmapped.append(slot)
+            else:
+                still_in_flight.append(slot)
+        self.in_flight = still_in_flight
+
+        for slot in self.unmapped:
+            glBindBuffer(GL_PIXEL_UNPACK_BUFFER, slot.pbo)
+            pointer = glMapBufferRange(GL_PIXEL_UNPACK_BUFFER, 0, self.nbytes,
+                                       GL_MAP_WRITE_BIT | GL_MAP_INVALIDATE_BUFFER_BIT)
+            memory = (ctypes.c_byte * self.nbytes).from_address(pointer)
+            slot.array = np.frombuffer(memory, dtype=np.int16).reshape(self.shape)
+            self.ready.put(slot)
+        self.unmapped = []
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+
+    # (any thread) returns a mapped buffer to write a slice into, or None when every buffer is busy
+    def acquire(self):
+        try:
+            return self.ready.get_nowait()
+        except queue.Empty:
+            return None
+
+    # (any thread) copies a slice into a buffer from acquire
+    def write(self, slot, pixelarray):
+        slot.array[...] = pixelarray
+
+    # (any thread) gives back a buffer from acquire that was not uploaded
+    def release(self, slot):
+        self.ready.put(slot)
+
+    # ------------------------------------------------------------------
+    # Function: upload
+    # Purpose: (OpenGL thread) unmaps a filled buffer and calls
+    #          create(pbo), which creates the texture while the buffer is
+    #          bound to GL_PIXEL_UNPACK_BUFFER (so the pixel data passed to
+    #          glTexImage2D is an offset into it). Returns what create returns
+    # ------------------------------------------------------------------
+    def upload(self, slot, create):
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, slot.pbo)
+        slot.array = None
+        glUnmapBuffer(GL_PIXEL_UNPACK_BUFFER)
+        result = create(slot.pbo)
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+        slot.fence = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self.in_flight.append(slot)
+        return result
+
+    # (OpenGL thread) deletes the buffers - nothing may be writing into them any more
+    def close(self):
+        for slot in self.slots:
+            if slot.fence:
+                glDeleteSync(slot.fence)
+            if slot.array is not None:
+                slot.array = None
+                glBindBuffer(GL_PIXEL_UNPACK_BUFFER, slot.pbo)
+                glUnmapBuffer(GL_PIXEL_UNPACK_BUFFER)
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+        if self.slots:
+            glDeleteBuffers(len(self.slots), [slot.pbo for slot in self.slots])
+        self.slots = []
+        self.in_flight = []
+        self.unmapped = []
+        self.ready = queue.Queue()
@@ -0,0 +1,217 @@
+# --------------------
+# File: Volume_Cache.py
+# Purpose: Keeps sorted CT volumes on disk (as .npy files that can be memory mapped) along
+#          with the slice information the viewer needs, so that opening a series a second
+#          time does not have to read any of the DICOM files again.
+# Author: Jacob Knop
+# Date: Summer 2020
+# --------------------
+
+# external dependencies
+import os
+import json
+import hashlib
+import numpy as np
+
+# internal dependencies
+from Event_Log import log
+
+# where the viewer keeps its caches unless told otherwise
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".dicom_viewer")
+
+
+# ------------------------------------------------------------
+# function: file_stats
+# purpose: returns [path, size, modification time] for every file so that
+#          changes to the source files can be detected (files that do not
+#          exist are left out)
+# parameters: filenames
+# 1. filenames - list of files the volume is made from
+# ------------------------------------------------------------
+def file_stats(filenames):
+    stats = []
+    for filename in sorted(filenames):
+        try:
+            st = os.stat(filename)
+        except FileNotFoundError:
+            continue
+        stats.append([os.path.abspath(filename), st.st_size, st.st_mtime_ns])
+    return stats
+
+
+# ------------------------------------------------------------
+# function: volume_key
+# purpose: builds the cache key of a series from its SeriesInstanceUID and
+#          the list, sizes and modification times of its files. Changing,
+#          adding or removing a file gives a different key
+# parameters: series_uid, stats
+# 1. series_uid - SeriesInstanceUID of the series
+# 2. stats      - output of file_stats
+# ------------------------------------------------------------
+def volume_key(series_uid, stats):
+    sha = hashlib.sha1()
+    sha.update(str(series_uid).encode("utf-8"))
+    for path, size, mtime in stats:
+        sha.update("\n{}|{}|{}".format(path, size, mtime).encode("utf-8"))
+    return sha.hexdigest()
+
+
+# -----------------------------------------------------------------------
+# Class: VolumeCache
+# Purpose: Stores each volume as <key>.npy (int16, slices x rows x columns)
+#          and <key>.json (slice headers and source file stats). The .json
+#          file is written last so an entry only exists once it is complete.
+#          The total size is capped at max_bytes by removing the least
+#          recently used entries.
+# -----------------------------------------------------------------------
+class VolumeCache:
+    cache_dir = 0
+    max_bytes = 0
+
+    def __init__(self, cache_dir=None, max_bytes=8 * 1024 * 1024 * 1024):
+        if cache_dir is None:
+            cache_dir = os.path.join(DEFAULT_CACHE_DIR, "volumes")
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def volume_path(self, key):
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def info_path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    # ------------------------------------------------------------------
+    # Function: lookup
+    # Purpose: returns (volume, headers) for a series if it is cached and
+    #          none of its files have changed, otherwise None. The volume
+    #          is a read only np.memmap so nothing is read until it is used
+    # ------------------------------------------------------------------
+    def lookup(self, series_uid, filenames):
+        try:
+            stats = file_stats(filenames)
+        except OSError:
+            return None
+        key = volume_key(series_uid, stats)
+
+        try:
+            with open(self.info_path(key)) as f:
+                info = json.load(f)
+            # the key already covers the file stats, this guards against a partial or corrupt entry
+            if info["files"] != stats or info["series_uid"] != series_uid:
+                self.remove(key)
+                return None
+            volume = np.load(self.volume_path(key), mmap_mode="r")
+        except (OSError, ValueError, KeyError):
+            return None
+
+        if list(volume.shape) != info["shape"]:
+            self.remove(key)
+            return None
+
+        # marking the entry as recently used for eviction
+        try:
+            os.utime(self.info_path(key))
+        except OSError:
+            pass
+        return volume, info["headers"]
+
+    # ------------------------------------------------------------------
+    # Function: store
+    # Purpose: writes a sorted volume to the cache. pixelarrays is the list
+    #          of slice arrays in order (written one at a time so no extra
+    #          copy of the volume is made) and headers are the matching
+    #          slice headers. Older entries of the same series are removed
+    # ------------------------------------------------------------------
+    def store(self, series_uid, filenames, headers, pixelarrays):
+        if len(pixelarrays) == 0:
+            return
+        # the cache holds int16 so stored values that do not fit are not cached
+        for pixelarray in pixelarrays:
+            if pixelarray.dtype != np.int16 and (pixelarray.min() < -32768 or pixelarray.max() > 32767):
+                return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        stats = file_stats(filenames)
+        key = volume_key(series_uid, stats)
+        shape = (len(pixelarrays),) + tuple(pixelarrays[0].shape)
+
+        tmp_volume = self.volume_path(key) + ".tmp"
+        tmp_info = self.info_path(key) + ".tmp"
+        try:
+            volume = np.lib.format.open_memmap(tmp_volume, mode="w+", dtype=np.int16, shape=shape)
+            for i in range(len(pixelarrays)):
+                volume[i] = pixelarrays[i]
+            volume.flush()
+            del volume
+
+            with open(tmp_info, "w") as f:
+                json.dump({"series_uid": series_uid, "shape": list(shape), "files": stats,
+                           "headers": headers}, f)
+
+            os.replace(tmp_volume, self.volume_path(key))
+            os.replace(tmp_info, self.info_path(key))
+        except (OSError, ValueError) as e:
+            log.warning("cache", "could not write volume cache: {}", e)
+            for path in (tmp_volume, tmp_info):
+                if os.path.exists(path):
+                    os.remove(path)
+            return
+
+        # the series changed since it was last cached so its old entries are stale
+        for other_key, info in self.entries():
+            if other_key != key and info.get("series_uid") == series_uid:
+                self.remove(other_key)
+        self.evict()
+
+    # returns (key, info) for every complete entry in the cache
+    def entries(self):
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".json"):
+                try:
+                    with open(os.path.join(self.cache_dir, name)) as f:
+                        entries.append((name[:-5], json.load(f)))
+                except (OSError, ValueError):
+                    pass
+        return entries
+
+    # removes an entry (the .json first so a half removed entry is never used)
+    def remove(self, key):
+        for path in (self.info_path(key), self.volume_path(key)):
+            try:
+                os.remove(path)
+            except OSError:
+                # missing, or still memory mapped by an open scan (windows) - it will be tried again
+                pass
+
+    # returns the number of bytes used by the cache
+    def usage(self):
+        total = 0
+        for key, info in self.entries():
+            try:
+                total = total + os.path.getsize(self.volume_path(key))
+            except OSError:
+                pass
+        return total
+
+    # removes the least recently used entries until the cache is within max_bytes
+    def evict(self):
+        entries = []
+        total = 0
+        for key, info in self.entries():
+            try:
+                size = os.path.getsize(self.volume_path(key))
+                used = os.path.getmtime(self.info_path(key))
+            except OSError:
+                continue
+            entries.append((used, key, size))
+            total = total + size
+
+        entries.sort()
+        for used, key, size in entries:
+            if total <= self.max_bytes:
+                break
+            self.remove(key)
+            total = total - size
@@ -0,0 +1,15 @@
+# --------------------
+# File: conftest.py
+# Purpose: Setup shared by the tests - the viewer's modules are imported from the folder above and
+#          OpenGL contexts come from EGL (no window). The platform has to be picked before anything
+#          imports OpenGL, so it is set here rather than in the tests that draw
+# Author: Jacob Knop
+# Date: Summer 2020
+# --------------------
+
+import os
+import sys
+
+os.environ.setdefault("PYOPENGL_PLATFORM", "egl")
+os.environ.setdefault("EGL_PLATFORM", "surfaceless")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,67 @@
+# --------------------
+# File: test_dicom_catalog.py
+# Purpose: Checks that crawling an archive again drops the series, studies and patients whose
+#          files were removed, including when another file in the catalog has no UIDs (NULLs in
+#          the tables). Run with python -m pytest tests
+# Author: Jacob Knop
+# Date: Summer 2020
+# --------------------
+
+# external dependencies
+import os
+import pytest
+
+pydicom = pytest.importorskip("pydicom")
+from pydicom.data import get_testdata_file
+from pydicom.uid import generate_uid
+
+# internal dependencies
+from Dicom_Catalog import DicomCatalog
+
+
+# writes a copy of pydicom's small CT file with new UIDs and returns its path
+def write_instance(path, patient_id, study_uid, series_uid):
+    ds = pydicom.dcmread(get_testdata_file("CT_small.dcm"))
+    ds.SOPInstanceUID = generate_uid()
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    ds.PatientID = patient_id
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = series_uid
+    ds.save_as(path)
+    return path
+
+
+def table_keys(catalog, table, column):
+    return {row[0] for row in catalog.connection.execute("SELECT {} FROM {}".format(column, table))}
+
+
+def test_crawl_prunes_removed_series_next_to_headers_without_uids(tmp_path):
+    archive = tmp_path / "archive"
+    archive.mkdir()
+    kept = write_instance(str(archive / "kept.dcm"), "kept", generate_uid(), generate_uid())
+    removed = write_instance(str(archive / "removed.dcm"), "removed", generate_uid(), generate_uid())
+    # a header without any of the UIDs (stored as NULLs)
+    no_uids = pydicom.dcmread(write_instance(str(archive / "no_uids.dcm"), "", "", ""))
+    del no_uids.PatientID
+    del no_uids.StudyInstanceUID
+    del no_uids.SeriesInstanceUID
+    no_uids.save_as(str(archive / "no_uids.dcm"))
+
+    catalog = DicomCatalog(str(tmp_path / "catalog.sqlite"))
+    try:
+        assert catalog.crawl(str(archive)) == (3, 0)
+        assert None in table_keys(catalog, "instances", "series_uid")
+        removed_header = pydicom.dcmread(removed)
+        assert removed_header.SeriesInstanceUID in table_keys(catalog, "series", "series_uid")
+
+        os.remove(removed)
+        assert catalog.crawl(str(archive)) == (0, 1)
+        assert removed_header.SeriesInstanceUID not in table_keys(catalog, "series", "series_uid")
+        assert removed_header.StudyInstanceUID not in table_keys(catalog, "studies", "study_uid")
+        assert "removed" not in table_keys(catalog, "patients", "patient_id")
+
+        kept_header = pydicom.dcmread(kept)
+        assert kept_header.SeriesInstanceUID in table_keys(catalog, "series", "series_uid")
+        assert "kept" in table_keys(catalog, "patients", "patient_id")
+    finally:
+        catalog.close()
@@ -0,0 +1,161 @@
+# --------------------
+# File: test_poisson_noise.py
+# Purpose: Checks the CPU noise engine in Poisson_Noise.py against what the DICOM shader draws.
+#          A small synthetic series is drawn offscreen (EGL, no window) with every noise mode
+#          and compared with noisy_display - the table mode must match bit for bit and the
+#          Box-Muller mode to within BOX_MULLER_TOLERANCE. Skipped when no offscreen OpenGL
+#          context can be made. Run with python -m pytest tests
+# Author: Jacob Knop
+# Date: Summer 2020
+# --------------------
+
+# external dependencies
+import os
+import ctypes
+import numpy as np
+import pytest
+
+pydicom = pytest.importorskip("pydicom")
+from pydicom.data import get_testdata_file
+from pydicom.uid import generate_uid
+from OpenGL import EGL
+from OpenGL.GL import *
+
+SIZE = 512  # slices are drawn 512 x 512 (one screen pixel per image pixel)
+SLICES = 2
+SLIDERS = [5.0, 150.0]
+INTERCEPT = -1024.0
+
+
+# makes an OpenGL 4.2 context with a pbuffer and returns whether it worked
+def make_context():
+    try:
+        display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        major, minor = EGL.EGLint(), EGL.EGLint()
+        if not EGL.eglInitialize(display, ctypes.pointer(major), ctypes.pointer(minor)):
+            return False
+        attributes = (EGL.EGLint * 11)(EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+                                       EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+                                       EGL.EGL_RED_SIZE, 8, EGL.EGL_GREEN_SIZE, 8, EGL.EGL_BLUE_SIZE, 8,
+                                       EGL.EGL_NONE)
+        config = EGL.EGLConfig()
+        count = EGL.EGLint()
+        EGL.eglChooseConfig(display, attributes, ctypes.pointer(config), 1, ctypes.pointer(count))
+        if not count.value:
+            return False
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        context_attributes = (EGL.EGLint * 7)(EGL.EGL_CONTEXT_MAJOR_VERSION, 4, EGL.EGL_CONTEXT_MINOR_VERSION, 2,
+                                              EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK,
+                                              EGL.EGL_CONTEXT_OPENGL_COMPATIBILITY_PROFILE_BIT, EGL.EGL_NONE)
+        context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, context_attributes)
+        surface_attributes = (EGL.EGLint * 5)(EGL.EGL_WIDTH, SIZE, EGL.EGL_HEIGHT, SIZE, EGL.EGL_NONE)
+        surface = EGL.eglCreatePbufferSurface(display, config, surface_attributes)
+        return bool(EGL.eglMakeCurrent(display, surface, surface, context))
+    except Exception:
+        return False
+
+
+# writes SLICES 512 x 512 CT files (random values over the whole HU range, with a strip of low
+# values on the left where lambda is small) and returns their stored pixel values
+def write_series(folder):
+    rng = np.random.default_rng(7)
+    volume = rng.integers(0, 5200, size=(SLICES, SIZE, SIZE)).astype(np.int16)
+    volume[:, :, :64] = 1024 + rng.integers(0, 40, size=(SLICES, SIZE, 64))
+    series_uid = generate_uid()
+    for i in range(SLICES):
+        ds = pydicom.dcmread(get_testdata_file("CT_small.dcm"))
+        ds.SOPInstanceUID = generate_uid()
+        ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+        ds.SeriesInstanceUID = series_uid
+        ds.InstanceNumber = i + 1
+        ds.SliceLocation = float(i)
+        ds.ImagePositionPatient = [0.0, 0.0, float(i)]
+        ds.Rows = SIZE
+        ds.Columns = SIZE
+        ds.RescaleSlope = 1.0
+        ds.RescaleIntercept = INTERCEPT
+        ds.PixelData = volume[i].tobytes()
+        ds.save_as(os.path.join(folder, "slice{:03d}.dcm".format(i)))
+    return volume
+
+
+@pytest.fixture(scope="module")
+def renderer(tmp_path_factory):
+    if not make_context():
+        pytest.skip("no offscreen OpenGL context")
+    import Dicom_Program
+    import Read_Dicom
+    import Poisson_Noise
+    from Shader_Program import ShaderProgram
+
+    folder = str(tmp_path_factory.mktemp("series"))
+    volume = write_series(folder)
+
+    # draw into a float framebuffer so the values are not rounded to 8 bits
+    framebuffer = glGenFramebuffers(1)
+    glBindFramebuffer(GL_FRAMEBUFFER, framebuffer)
+    renderbuffer = glGenRenderbuffers(1)
+    glBindRenderbuffer(GL_RENDERBUFFER, renderbuffer)
+    glRenderbufferStorage(GL_RENDERBUFFER, GL_R32F, SIZE, SIZE)
+    glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_RENDERBUFFER, renderbuffer)
+    glViewport(0, 0, SIZE, SIZE)
+    VBO = glGenBuffers(1)
+    glBindBuffer(GL_ARRAY_BUFFER, VBO)
+    glBufferData(GL_ARRAY_BUFFER, 4 * 28, None, GL_DYNAMIC_DRAW)
+    EBO = glGenBuffers(1)
+    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, EBO)
+    glBufferData(GL_ELEMENT_ARRAY_BUFFER, 4 * 6, None, GL_DYNAMIC_DRAW)
+
+    shader = ShaderProgram(Dicom_Program.vertex_dcm_src, Dicom_Program.fragment_dcm_src, "dicom")
+    scan = Read_Dicom.CTScan(folder, shader, 0, 0, "thread", "eager", volume_cache=0)
+    scan.noise_table = Poisson_Noise.create_poisson_texture()
+    scan.update()
+    # the scan sorts the slices itself
+    assert sorted(map(bytes, scan.volume)) == sorted(map(bytes, volume))
+
+    # returns what the shader draws for a slice (rows from the top like noisy_display)
+    def render(slice, mode, slider):
+        scan.curr_slice = slice
+        scan.noise_mode = mode
+        scan.exposure = slider
+        glClear(GL_COLOR_BUFFER_BIT)
+        scan.draw(VBO, EBO)
+        pixels = np.frombuffer(glReadPixels(0, 0, SIZE, SIZE, GL_RED, GL_FLOAT), np.float32)
+        return pixels.reshape(SIZE, SIZE)[::-1]
+
+    return render, np.array(scan.volume)
+
+
+def expected(volume, slice, mode, slider):
+    import Poisson_Noise
+    return Poisson_Noise.noisy_display(volume[slice:slice + 1], slice, slider, mode, 1.0, INTERCEPT)[0]
+
+
+def test_noise_off_matches_shader(renderer):
+    import Poisson_Noise
+    render, volume = renderer
+    for slice in range(SLICES):
+        gpu = render(slice, Poisson_Noise.NOISE_OFF, 0.0)
+        cpu = expected(volume, slice, Poisson_Noise.NOISE_OFF, 0.0)
+        assert np.abs(gpu - cpu).max() <= 2.5e-7
+
+
+def test_table_mode_matches_shader_bit_for_bit(renderer):
+    import Poisson_Noise
+    render, volume = renderer
+    for slice in range(SLICES):
+        for slider in SLIDERS:
+            gpu = render(slice, Poisson_Noise.NOISE_TABLE, slider)
+            cpu = expected(volume, slice, Poisson_Noise.NOISE_TABLE, slider)
+            assert np.array_equal(gpu, cpu), (slice, slider, np.count_nonzero(gpu != cpu))
+
+
+def test_box_muller_mode_matches_shader_within_tolerance(renderer):
+    import Poisson_Noise
+    render, volume = renderer
+    for slice in range(SLICES):
+        for slider in SLIDERS:
+            gpu = render(slice, Poisson_Noise.NOISE_BOX_MULLER, slider)
+            cpu = expected(volume, slice, Poisson_Noise.NOISE_BOX_MULLER, slider)
+            assert np.isfinite(gpu).all() and np.isfinite(cpu).all()
+            assert np.abs(gpu - cpu).max() <= Poisson_Noise.BOX_MULLER_TOLERANCE, (slice, slider)